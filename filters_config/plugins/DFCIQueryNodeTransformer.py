@@ -13,7 +13,7 @@ from matchengine.internals.typing.matchengine_types import (
 )
 from matchengine.internals.utilities.object_comparison import nested_object_hash
 
-from matchminer.constants import synonyms
+from matchminer.structural_variants import SV_GENES_FIELD, sv_genes_query
 
 if TYPE_CHECKING:
     from matchengine.internals.engine import MatchEngine
@@ -109,8 +109,8 @@ class DFCIQueryNodeTransformer(QueryNodeTransformer):
         """
 
         # If a trial curation calls for a structural variant but does NOT have the structured SV data field
-        # FUSION_PARTNER_HUGO_SYMBOL, then the extended_attributes query is done using a regex search of the free text
-        # STRUCTURAL_VARIANT_COMMENT field on the patient's extended_attributes document.
+        # FUSION_PARTNER_HUGO_SYMBOL, then the extended_attributes query looks the gene up in the gene tokens
+        # extracted from the free text STRUCTURAL_VARIANT_COMMENT field of the patient's genomic documents.
         whole_query = query_node.extract_raw_query()
         # encode as full search criteria
         if 'STRUCTURAL_VARIANT_COMMENT' in whole_query:
@@ -124,18 +124,12 @@ class DFCIQueryNodeTransformer(QueryNodeTransformer):
                 sv_part.mcq_invalidating = True
                 sv_part.render = False
             else:
-                to_add = list()
-                genes = [genes]
-                for gene in genes:
-                    if gene in synonyms:
-                        to_add += synonyms[gene]
-
-                genes = genes + to_add
-
-                abc = '|'.join([rf"(.*\W{gene}\W.*)|(^{gene}\W.*)|(.*\W{gene}$)"
-                                for gene in genes])
-
-                sv_part.set_query_attr('STRUCTURAL_VARIANT_COMMENT', {"$regex": abc})
+                # the genes mentioned by the comment, synonyms included, are indexed at genomic ingest
+                sv_part.render = False
+                query_node.add_query_part(QueryPart({SV_GENES_FIELD: sv_genes_query(genes)},
+                                                    sv_part.negate,
+                                                    True,
+                                                    False))
         # blank-GENE -> Intergenic
         # GENE-blank -> Intergenic
         # GENE1-GENE1 -> GENE1-GENE1 # Intragenic
@@ -8,9 +8,12 @@ import requests
 from flask_cors import CORS
 from functools import wraps, update_wrapper
 from flask import Blueprint, Response, make_response, render_template, request, redirect
+from markupsafe import escape
+from pymongo.errors import OperationFailure
 
 from matchminer.database import get_db
 from matchminer.elasticsearch import remove_trial_from_elasticsearch_by_es_id
+from matchminer.matchengine_v1.engine import MatchEngine
 from matchminer.utilities import set_curated, set_updated
 from matchminer.components.oncore.oncore_utilities import OncoreSync
 from matchminer.settings import API_TOKEN, API_ADDRESS, ONCORE_ADDRESS
@@ -77,6 +80,26 @@ def _render_trials():
     return render_template('curateInterface.html', trials=trials)
 
 
+def _explain_trial(trial):
+    """Explains the leaf queries of an uploaded trial, see MatchEngine.explain_trial"""
+
+    try:
+        return MatchEngine(get_db()).explain_trial(trial)
+    except (OperationFailure, KeyError, TypeError, IndexError) as exc:
+
+        # a trial which can't be explained is left to validation
+        logging.warning("unable to explain trial %s: %s" % (trial.get('protocol_no'), exc))
+        return []
+
+
+def _render_explain(r_code, reports):
+
+    # the reports hold curated values, which must not be rendered as markup
+    flagged = sum(1 for report in reports if report['flags'])
+    return "%s</br></br>%d of %d match criteria flagged</br></br><pre>%s</pre>" % (
+        r_code, flagged, len(reports), escape(json.dumps(reports, indent=4, default=str)))
+
+
 def _handle_exc(trial):
     """Field name "diseasesite_code" can come in from the yaml as string or integer but must be stored as a string"""
 
@@ -139,6 +162,13 @@ def index():
             # Deal with "disease_site_code" type exception
             trial_new = _handle_exc(trial_new)
 
+            # explain the match criteria, refusing pathological ones unless the curator insists
+            reports = _explain_trial(trial_new)
+            flagged = [report for report in reports if report['flags']]
+            if request.form.get('explain') or (flagged and not request.form.get('force')):
+                r_code = 200 if request.form.get('explain') else 513
+                return _render_explain(r_code, reports)
+
             # create the request.
             qstr = "where=%s" % json.dumps(({"protocol_no": trial_new['protocol_no']}))
 
@@ -12,7 +12,6 @@ from bson import ObjectId
 
 from onelogin.saml2.auth import OneLogin_Saml2_Auth
 import simplejson as json
-import oncotreenx
 from requests import post, get
 from requests.auth import HTTPBasicAuth
 
@@ -21,6 +20,9 @@ from matchminer import data_model
 import matchminer.miner
 from matchminer.elasticsearch import reset_elasticsearch
 from matchminer.miner import _count_matches_by_filter
+from matchminer.oncotree import get_oncotree
+from matchminer.jobs import get_job
+from matchminer.locks import RunLock, LockHeld, run_lock, active_locks, FILTERS, MATCHENGINE, ELASTICSEARCH
 from matchminer.settings import *
 from matchminer.utilities import parse_resource_field, nocache, reannotate_trials
 from matchminer.security import auth_required
@@ -162,14 +164,16 @@ def rerun_filters_endpoint(silent=False):
         datapush_id = data.get('data_push_id', None)
         silent = data.get('silent', None)
 
-    is_currently_running = list(db.active_processes.find())
-    if len(is_currently_running) > 0:
+    # the lock is taken here, so concurrent requests can't both start a run, and released by the run
+    lock = RunLock(db, FILTERS)
+    if not lock.acquire():
         msg = "Filters already running"
         response = {msg: True}
     else:
         msg = f"Full filters run started. Datapush id: {str(datapush_id)}. Silent: {str(silent)}"
         response = {msg: True}
-        thread = threading.Thread(target=matchminer.miner.start_filter_run, daemon=True, args=[silent, datapush_id])
+        thread = threading.Thread(target=matchminer.miner.start_filter_run, daemon=True,
+                                  args=[silent, datapush_id], kwargs={'lock': lock})
         thread.start()
 
     logging.info(msg)
@@ -180,20 +184,55 @@ def rerun_filters_endpoint(silent=False):
     return resp
 
 
+@blueprint.route('/api/jobs/<job_id>', methods=['GET'])
+@nocache
+@auth_required
+def job_status(job_id):
+    """
+    Reports the progress of a background job, e.g. the matching of a saved filter, and its result once done.
+    :param job_id: id returned when the job was queued
+    :return:
+    """
+    db = database.get_db()
+    user = db.user.find_one({'token': request.authorization.username})
+
+    # jobs are visible to the members of their team only, like filters
+    job = get_job(db, job_id)
+    if job is None or job.get('TEAM_ID') not in set(user['teams']):
+        return Response(response=json.dumps({"error": "job not found"}),
+                        status=404,
+                        mimetype="application/json")
+
+    fields = ['_id', 'type', 'status', 'stage', 'progress', 'result', 'error', '_created', '_updated', 'finished']
+    response = dict((field, job.get(field)) for field in fields)
+    return Response(response=json.dumps(response, default=str),
+                    status=200,
+                    mimetype="application/json")
+
+
 @blueprint.route('/api/is_matchengine_running', methods=['GET'])
 def is_engine_running():
     db = database.get_db()
 
-    running_processes = list(db.active_processes.find())
+    fields = ['stage', 'progress', 'started', 'heartbeat', 'expires']
+    running_processes = [dict([('name', lock['_id'])] + [(field, lock.get(field)) for field in fields])
+                         for lock in active_locks(db)]
     is_running = True if len(running_processes) > 0 else False
 
     logging.info(f"/api/is_matchengine_running {str(is_running)}")
-    resp = Response(response=json.dumps({"is_running": is_running}),
+    resp = Response(response=json.dumps({"is_running": is_running, "processes": running_processes}, default=str),
                     status=200,
                     mimetype="application/json")
     return resp
 
 
+def _already_running(e):
+    """Response of an operation whose lock is held by another process"""
+    return Response(response=json.dumps({"error": str(e)}),
+                    status=409,
+                    mimetype="application/json")
+
+
 @blueprint.route('/api/reannotate_trials', methods=['POST'])
 @nocache
 @auth_required
@@ -203,7 +242,12 @@ def reannotate_trials_api():
     Regenerates all _summary, _elasticsearch and _suggest fields.
     :return:
     """
-    reannotate_trials()
+    try:
+        with run_lock(database.get_db(), ELASTICSEARCH, 'reannotating trials'):
+            reannotate_trials()
+    except LockHeld as e:
+        return _already_running(e)
+
     resp = Response(response=json.dumps({"success": True}),
                     status=200,
                     mimetype="application/json")
@@ -218,14 +262,25 @@ def run_matchengine():
     NOTE: DO NOT use this in production; use matchengine-runner instead.
     :return:
     """
-    with matchengine.internals.engine.MatchEngine(
-        match_on_deceased=False,
-        match_on_closed=True,
-        db_name="matchminer") as me_prod:
-        me_prod.get_matches_for_all_trials()
-        me_prod.update_all_matches()
-
-    reset_elasticsearch()
+    db = database.get_db()
+    try:
+        # both locks are taken before matching, so a finished run is never refused because the index is being reset
+        with run_lock(db, MATCHENGINE, 'matching trials') as lock, \
+                run_lock(db, ELASTICSEARCH, 'waiting for matchengine') as es_lock:
+            with matchengine.internals.engine.MatchEngine(
+                match_on_deceased=False,
+                match_on_closed=True,
+                db_name="matchminer") as me_prod:
+                me_prod.get_matches_for_all_trials()
+                lock.update('updating matches', 0.8)
+                me_prod.update_all_matches()
+
+            lock.update('resetting elasticsearch', 0.9)
+            es_lock.update('resetting elasticsearch', 0.0)
+            reset_elasticsearch()
+    except LockHeld as e:
+        return _already_running(e)
+
     resp = Response(response=json.dumps({"success": True}),
                     status=200,
                     mimetype="application/json")
@@ -239,7 +294,12 @@ def reset_elasticsearch_endpoint():
     Deletes and recreates elasticsearch index. Reloads settings and mappings
     :return:
     """
-    reset_elasticsearch()
+    try:
+        with run_lock(database.get_db(), ELASTICSEARCH, 'resetting elasticsearch'):
+            reset_elasticsearch()
+    except LockHeld as e:
+        return _already_running(e)
+
     resp = Response(response=json.dumps({"success": True}),
                     status=200,
                     mimetype="application/json")
@@ -539,14 +599,14 @@ def unique_query():
     # special case for oncotree.
     if resource == 'clinical' and field == 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME':
 
-        # make oncotree.
-        onco_tree = oncotreenx.build_oncotree(settings.DATA_ONCOTREE_FILE)
+        # get the shared oncotree.
+        onco_tree = get_oncotree(settings.DATA_ONCOTREE_FILE)
 
         # turn into
         results = list()
-        for n in onco_tree.nodes():
+        for n in onco_tree.codes:
             tmp = {
-                'text': onco_tree.node[n]['text'],
+                'text': onco_tree.text(n),
                 'code': n
             }
             results.append(tmp)
@@ -229,6 +229,10 @@ filter_schema = {
     'filter_hash': {
         'type': 'string',
     },
+    'enrollment_run_id': {
+        'type': 'string',
+        'readonly': True
+    },
     'enrollment': {
         'type': 'dict',
         'schema': {
@@ -607,6 +611,7 @@ genomic_schema = {
     'TRUE_CDNA_TRANSCRIPT_ID': {'type': 'string'},
     'TRUE_ENTREZ_ID': {'type': 'string'},
     'TRUE_PROTEIN_CHANGE': {'type': 'string'},
+    'TRUE_PROTEIN_CHANGE_PREFIX': {'type': 'string', 'nullable': True},
     'TRUE_TRANSCRIPT_EXON': {'type': 'integer'},
     'TRUE_VARIANT_CLASSIFICATION': {'type': 'string'},
     'TRUE_STRAND': {'type': 'string'},
@@ -645,6 +650,7 @@ genomic_schema = {
 
     # structural variables.
     'STRUCTURAL_VARIANT_COMMENT': {'type': 'string'},
+    'STRUCTURAL_VARIANT_GENES': {'type': 'list', 'schema': {'type': 'string'}},
 
     'CYTOBAND': {'type': 'string'},
     'GENETIC_EVENT': {
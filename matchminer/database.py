@@ -1,7 +1,36 @@
+import os
+import threading
+
 from flask import current_app as app
 from pymongo import MongoClient
 
 from matchminer.settings import *
+from matchminer.profiler import get_query_counter
+
+# pymongo only reports the commands of clients created after a listener is registered, so the query counter of
+# profiled runs is registered before this module creates any client, and before Eve and the engines create theirs
+get_query_counter()
+
+# client used outside of a Flask app context, e.g. by background threads and job workers
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def _get_client():
+    """
+    Returns the Mongo client of this process, created on first use. MongoClient is thread-safe and pools its
+    connections, so every thread shares it. Forked processes create their own.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            _client = MongoClient(MONGO_URI)
+            _client_pid = os.getpid()
+
+            if MONGO_USERNAME:
+                _client[MONGO_DBNAME].add_user(MONGO_USERNAME, MONGO_PASSWORD)
+    return _client
 
 
 def get_collection(name):
@@ -15,16 +44,8 @@ def get_collection(name):
         collection = app.data.driver.db[name]
     except RuntimeError as e:
 
-        # connect to database.
-        connection = MongoClient(MONGO_URI)
-
-        if MONGO_USERNAME:
-            connection[MONGO_DBNAME].add_user(MONGO_USERNAME, MONGO_PASSWORD)
-
-        db = connection[MONGO_DBNAME]
-
         # get the collection
-        collection = db[name]
+        collection = _get_client()[MONGO_DBNAME][name]
 
     # return it
     return collection
@@ -41,12 +62,7 @@ def get_db():
     except RuntimeError as e:
 
         # connect to database.
-        connection = MongoClient(MONGO_URI)
-
-        if MONGO_USERNAME:
-            connection[MONGO_DBNAME].add_user(MONGO_USERNAME, MONGO_PASSWORD)
-
-        db = connection[MONGO_DBNAME]
+        db = _get_client()[MONGO_DBNAME]
 
     # return it
     return db
@@ -1,14 +1,13 @@
 import time
 
 import logging
-from oncotreenx import build_oncotree
-import networkx as nx
 
 import requests
 from elasticsearch import Elasticsearch, helpers
 from requests.auth import HTTPBasicAuth
 
 from matchminer import database
+from matchminer.oncotree import get_oncotree
 
 from .settings import *
 
@@ -143,19 +142,17 @@ def reset_elasticsearch_mapping():
     with open(ES_MAPPING) as es_mapping_file_handle:
         json_payload = json.load(es_mapping_file_handle)['trial']
 
-    ot = build_oncotree(TUMOR_TREE)
+    ot = get_oncotree(TUMOR_TREE)
     order = ["All Solid Tumors", "All Liquid Tumors"]
-    top_level_ot = sorted([node for node, path in nx.shortest_path(ot, 'root').items() if len(path) == 2],
-                          key=lambda x: ot.node[x]['text'])
+    top_level_ot = sorted(ot.children(ot.root), key=lambda x: ot.text(x))
     for top_level in top_level_ot:
-        order.append(ot.node[top_level]['text'])
-        if '/' in ot.node[top_level]['text']:
-            order = order + ot.node[top_level]['text'].split('/')
-        second_level_ot = sorted([item for item in nx.descendants(ot, top_level)], key=lambda x: ot.node[x]['text'])
+        order.append(ot.text(top_level))
+        if '/' in ot.text(top_level):
+            order = order + ot.text(top_level).split('/')
+        second_level_ot = sorted(ot.descendants(top_level)[1:], key=lambda x: ot.text(x))
         for second_level in second_level_ot:
-            order.append(ot.node[second_level]['text'])
-            third_level_ot = sorted([item for item in nx.descendants(ot, second_level)],
-                                    key=lambda x: ot.node[x]['text'])
+            order.append(ot.text(second_level))
+            third_level_ot = sorted(ot.descendants(second_level)[1:], key=lambda x: ot.text(x))
             for third_level in third_level_ot:
                 order.append(third_level)
 
@@ -5,6 +5,8 @@ from flask import current_app as app
 
 from matchminer import settings
 from matchminer import database
+from matchminer.structural_variants import SV_GENES_FIELD, sv_comment_genes
+from matchminer.protein_change import PROTEIN_PREFIX_FIELD, protein_change_prefix
 
 def negative_genomic(items):
     """
@@ -65,6 +67,27 @@ def genomic_insert(items):
         # set strings to be object ids
         item['CLINICAL_ID'] = ObjectId(item['CLINICAL_ID'])
 
+        # index the genes mentioned by structural variants
+        if 'STRUCTURAL_VARIANT_COMMENT' in item:
+            item[SV_GENES_FIELD] = sv_comment_genes(item['STRUCTURAL_VARIANT_COMMENT'])
+
+        # index the protein change prefix looked up by wildcard protein change criteria
+        if 'TRUE_PROTEIN_CHANGE' in item:
+            item[PROTEIN_PREFIX_FIELD] = protein_change_prefix(item['TRUE_PROTEIN_CHANGE'])
+
+
+def genomic_replace(item, original):
+    genomic_insert([item])
+
+
+def genomic_update(updates, original):
+
+    # keep the indexed fields in step with edited values
+    if 'STRUCTURAL_VARIANT_COMMENT' in updates:
+        updates[SV_GENES_FIELD] = sv_comment_genes(updates['STRUCTURAL_VARIANT_COMMENT'])
+    if 'TRUE_PROTEIN_CHANGE' in updates:
+        updates[PROTEIN_PREFIX_FIELD] = protein_change_prefix(updates['TRUE_PROTEIN_CHANGE'])
+
 
 def align_matches_genomic(a):
     """
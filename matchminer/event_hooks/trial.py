@@ -115,14 +115,13 @@ def build_trial_elasticsearch_fields(items):
     :param items:
     :return:
     """
-    # get database connection.
-    db = database.get_db()
+    # tree building does not need a database connection.
+    me = MatchEngine()
 
     # loop over each item.
     for item in items:
 
         # build tree.
-        me = MatchEngine(db)
         status, trial_tree = me.create_trial_tree(item, no_validate=True)
 
         # look at every node.
@@ -4,7 +4,8 @@ import logging
 from matchminer.event_hooks.clinical import hide_name, clinical_replace, clinical_update, clinical_delete, clinical_insert, \
     align_other_clinical, align_matches_clinical
 from matchminer.event_hooks.event_utils import dry_flag, entry_insert, entry_replace
-from matchminer.event_hooks.genomic import negative_genomic, genomic_insert, align_matches_genomic
+from matchminer.event_hooks.genomic import negative_genomic, genomic_insert, genomic_replace, genomic_update, \
+    align_matches_genomic
 from matchminer.event_hooks.hipaa import hipaa_logging_item, hipaa_logging_resource
 from matchminer.event_hooks.immunoprofile import immunoprofile_insert
 from matchminer.event_hooks.public_stats import get_public_stats
@@ -57,6 +58,8 @@ def register_hooks(app):
     # genomic
     app.on_fetched_resource_genomic += align_matches_genomic
     app.on_insert_genomic += genomic_insert
+    app.on_replace_genomic += genomic_replace
+    app.on_update_genomic += genomic_update
     app.on_insert_negative_genomic += negative_genomic
 
     # immunoprofile
@@ -0,0 +1,203 @@
+import re
+import json
+import hashlib
+import logging
+import datetime
+
+from pymongo import UpdateOne
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# filter fields copied onto its match documents, upper cased, see the filter projection of the filters config
+FILTER_MATCH_FIELDS = ('TEAM_ID', 'USER_ID', 'status', 'protocol_id', 'label', 'match')
+
+# fields of a stored match document tracking its state in the match collection rather than the matched sample
+MATCH_STATE_FIELDS = ('_id', 'hash', '_me_id', '_updated', '_created', '_etag', 'is_disabled', 'data_push_id',
+                      'MATCH_STATUS')
+
+# state of a copied match kept when the engine stores the same match for its filter, see adopt_copied_matches
+ADOPTED_FIELDS = ('_me_id', 'MATCH_STATUS', 'data_push_id')
+
+# prefix of the hash of copied matches, which the engine does not know, as it hashes matches its own way
+COPY_HASH_PREFIX = 'copy:'
+
+
+def _canonical(obj):
+    """Returns the object with every list sorted, as the order of CTML clauses and values is irrelevant"""
+    if isinstance(obj, dict):
+        return {str(k): _canonical(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        items = [_canonical(v) for v in obj]
+        return sorted(items, key=lambda v: json.dumps(v, sort_keys=True, default=str))
+    return obj
+
+
+def filter_hash(match):
+    """
+    Returns the canonical hash of a compiled filter, equal for filters matching the same samples
+
+    :param match: CTML match clause of a filter
+    """
+    return hashlib.sha1(json.dumps(_canonical(match), sort_keys=True, default=str).encode()).hexdigest()
+
+
+def group_filters(filters):
+    """
+    Groups filters with the same criteria and status. Each group is evaluated once, for its oldest filter,
+    which keeps the group's matches stable while filters are added. The criteria are hashed from the match
+    clause of every filter on each run, never from a stored hash.
+
+    :param filters: filter documents
+    :return: lists of filter documents sharing their criteria keyed by the id of the evaluated filter
+    """
+    groups = {}
+    for item in sorted(filters, key=lambda f: f['_id']):
+        key = (filter_hash(item.get('match', [])), item.get('status'))
+        groups.setdefault(key, []).append(item)
+    return {group[0]['_id']: group for group in groups.values()}
+
+
+def match_hash(match):
+    """Returns the hash of a copied match document, which changes with its content only"""
+    content = {k: v for k, v in match.items() if k not in ('_id', 'hash')}
+    return COPY_HASH_PREFIX + hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def copy_match(match, item):
+    """
+    Returns a match document of the evaluated filter of a group as a match of another filter of the group
+
+    :param match: match document of the evaluated filter, as returned by the engine or stored
+    :param item: filter document to copy the match to
+    """
+    new_match = dict((k, v) for k, v in match.items() if k not in MATCH_STATE_FIELDS)
+    for field in FILTER_MATCH_FIELDS:
+        if field.upper() in new_match:
+            new_match[field.upper()] = item.get(field)
+    new_match['FILTER_ID'] = item['_id']
+    new_match['FILTER_STATUS'] = item['status']
+
+    # the subject ends with the protocol id of the filter
+    subject = new_match.get('EMAIL_SUBJECT')
+    if subject and '(' in subject:
+        new_match['EMAIL_SUBJECT'] = '%s(%s)' % (subject[:subject.rfind('(')], item.get('protocol_id', ''))
+
+    new_match['hash'] = match_hash(new_match)
+    return new_match
+
+
+def copy_matches(matches, groups):
+    """
+    Copies the matches of every evaluated filter returned by an engine run to the other filters of its group
+
+    :param matches: matches of the evaluated filters by filter and sample
+    :param groups: filter groups, see group_filters
+    :return: matches of the other filters by filter and sample
+    """
+    copied = {}
+    for filter_id, group in groups.items():
+        for item in group[1:]:
+            copied[item['_id']] = dict(
+                (sample_id, [copy_match(match, item) for match in sample_matches])
+                for sample_id, sample_matches in matches.get(filter_id, {}).items())
+    return copied
+
+
+def update_copied_matches(db, groups, run_id):
+    """
+    Updates the matches of the other filters of every group to the current matches of its evaluated filter,
+    once the engine updated them in the match collection. Matches are updated the way the engine updates
+    the evaluated filter: new matches are inserted with the run id, matches found again are enabled with
+    the run id and matches not found anymore are disabled. Stored matches are compared by their content, so
+    matches the engine stored while the filter was matched on its own are kept.
+
+    :param db: database connection
+    :param groups: filter groups, see group_filters
+    :param run_id: id of the engine run
+    :return: number of filters whose matches were updated
+    """
+    now = datetime.datetime.now()
+    updated = 0
+    for filter_id, group in groups.items():
+        if len(group) < 2:
+            continue
+
+        source = list(db.match.find({'FILTER_ID': filter_id, 'is_disabled': False}))
+        for item in group[1:]:
+            new_matches = dict((match['hash'], match) for match in (copy_match(m, item) for m in source))
+
+            disable, enable, found = [], [], set()
+            for match in db.match.find({'FILTER_ID': item['_id']}):
+                content_hash = copy_match(match, item)['hash']
+                found.add(content_hash)
+                if content_hash not in new_matches and not match.get('is_disabled'):
+                    disable.append(match['_id'])
+                elif content_hash in new_matches and match.get('is_disabled'):
+                    enable.append(match['_id'])
+            insert = [dict(match, MATCH_STATUS=1, is_disabled=False, _me_id=run_id, _updated=now)
+                      for content_hash, match in new_matches.items() if content_hash not in found]
+
+            if disable:
+                db.match.update_many({'_id': {'$in': disable}}, {'$set': {'is_disabled': True, '_updated': now}})
+            if enable:
+                db.match.update_many({'_id': {'$in': enable}},
+                                     {'$set': {'is_disabled': False, '_me_id': run_id, '_updated': now}})
+            if insert:
+                db.match.insert_many(insert)
+            updated += 1
+
+    logging.info("Updated the copied matches of %d filters" % updated)
+    return updated
+
+
+def find_copied_matches(db, filter_ids=None):
+    """
+    Returns the active copied matches of filters, taken before the engine evaluates the filters themselves
+
+    :param db: database connection
+    :param filter_ids: filters the engine evaluates, all of them if None
+    """
+    query = {'hash': {'$regex': '^%s' % re.escape(COPY_HASH_PREFIX)}, 'is_disabled': False}
+    if filter_ids is not None:
+        query['FILTER_ID'] = {'$in': list(filter_ids)}
+    return list(db.match.find(query))
+
+
+def adopt_copied_matches(db, copied, run_id):
+    """
+    Hands the state of copied matches over to the matches the engine stored for the same samples, once the
+    engine evaluated their filter itself, e.g. after the evaluated filter of their group was deleted or the
+    filter was saved on its own. The engine only knows matches by its own hash, so it disables the copies and
+    stores them again with the run id, as new matches. The engine's matches take over the run id, match status
+    and data push of the copies, and the copies are removed.
+
+    :param db: database connection
+    :param copied: copied matches of the evaluated filters before the engine run, see find_copied_matches
+    :param run_id: id of the engine run
+    :return: number of adopted copies
+    """
+    if not copied:
+        return 0
+
+    filter_ids = list(set(match['FILTER_ID'] for match in copied))
+    filters = dict((item['_id'], item) for item in db.filter.find({'_id': {'$in': filter_ids}}))
+    stored = {}
+    for match in db.match.find({'FILTER_ID': {'$in': list(filters)}, '_me_id': run_id, 'is_disabled': False}):
+        stored.setdefault(copy_match(match, filters[match['FILTER_ID']])['hash'], []).append(match)
+
+    requests = []
+    adopted = []
+    for match in copied:
+        item = filters.get(match['FILTER_ID'])
+        candidates = stored.get(copy_match(match, item)['hash']) if item is not None else None
+        if not candidates:
+            continue
+        state = dict((field, match[field]) for field in ADOPTED_FIELDS if field in match)
+        requests.append(UpdateOne({'_id': candidates.pop()['_id']}, {'$set': state}))
+        adopted.append(match['_id'])
+
+    if requests:
+        db.match.bulk_write(requests, ordered=False)
+        db.match.delete_many({'_id': {'$in': adopted}})
+    logging.info("Adopted %d copied matches" % len(adopted))
+    return len(adopted)
@@ -0,0 +1,186 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import datetime
+import threading
+import traceback
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from matchminer import settings
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# running jobs whose worker has not reported for this many seconds are handed to another worker. Workers renew
+# the jobs they run three times per timeout, however long the job takes.
+JOB_TIMEOUT = 300
+
+# functions running each type of job
+_handlers = {}
+
+
+class JobLost(RuntimeError):
+    """Raised when a running job was claimed by another worker, e.g. after this one stopped reporting"""
+
+
+def job_handler(job_type):
+    """
+    Registers the function running a type of job. It is called with the database connection and the job
+    document, reports its progress with update_job and returns the result stored on the job. update_job raises
+    JobLost when another worker took the job over, which stops the handler.
+    """
+    def register(fn):
+        _handlers[job_type] = fn
+        return fn
+    return register
+
+
+def submit_job(db, job_type, payload, team_id=None):
+    """
+    Queues a job for the job worker. When JOBS_ASYNC is off, the default for deployments without job workers,
+    the job is run right away in the calling process instead.
+
+    :param db: database connection
+    :param job_type: type of the job, see job_handler
+    :param payload: arguments of the job
+    :param team_id: team whose members may read the job's status and result
+    :return: job id
+    """
+
+    now = datetime.datetime.now()
+    job = {
+        'type': job_type,
+        'payload': payload,
+        'TEAM_ID': team_id,
+        'status': QUEUED,
+        'stage': QUEUED,
+        'progress': 0.0,
+        'result': None,
+        'error': None,
+        '_created': now,
+        '_updated': now
+    }
+    job['_id'] = db.jobs.insert_one(job).inserted_id
+
+    if not settings.JOBS_ASYNC:
+        run_job(db, claim_job(db, job['_id']))
+
+    return job['_id']
+
+
+def claim_job(db, job_id=None):
+    """
+    Marks the oldest queued job, or a running job whose worker stopped reporting, as running by this process
+
+    :param db: database connection
+    :param job_id: claim this job only
+    :return: job document or None if there is nothing to run
+    """
+
+    now = datetime.datetime.now()
+    query = {'$or': [
+        {'status': QUEUED},
+        {'status': RUNNING, '_updated': {'$lt': now - datetime.timedelta(seconds=JOB_TIMEOUT)}}
+    ]}
+    if job_id is not None:
+        query['_id'] = job_id
+
+    return db.jobs.find_one_and_update(
+        query,
+        {'$set': {'status': RUNNING, 'worker': '%s:%d' % (socket.gethostname(), os.getpid()),
+                  'owner': uuid.uuid4().hex, 'started': now, '_updated': now}},
+        sort=[('_created', 1)],
+        return_document=ReturnDocument.AFTER)
+
+
+def update_job(db, job, stage, progress, **fields):
+    """
+    Records the progress of a running job, which also tells other workers it is still alive
+
+    :param job: job document as claimed by this worker
+    :raises JobLost: if another worker claimed the job since
+    """
+    fields.update(stage=stage, progress=progress, _updated=datetime.datetime.now())
+    result = db.jobs.update_one({'_id': job['_id'], 'owner': job['owner']}, {'$set': fields})
+    if result.matched_count == 0:
+        raise JobLost('Job %s was claimed by another worker' % job['_id'])
+
+
+def _renew(db, job, stop):
+    """Keeps a running job claimed until stop is set"""
+    while not stop.wait(JOB_TIMEOUT / 3):
+        try:
+            result = db.jobs.update_one({'_id': job['_id'], 'owner': job['owner']},
+                                        {'$set': {'_updated': datetime.datetime.now()}})
+            if result.matched_count == 0:
+                logging.warning('Job %s was claimed by another worker' % job['_id'])
+                return
+        except Exception as e:
+            logging.warning('Error renewing job %s: %s' % (job['_id'], e))
+
+
+def run_job(db, job):
+    """Runs a claimed job and stores its result or error, renewing the claim while it runs"""
+
+    if job is None:
+        return
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_renew, args=(db, job, stop), daemon=True, name='job-%s' % job['_id'])
+    heartbeat.start()
+    try:
+        try:
+            handler = _handlers[job['type']]
+            result = handler(db, job)
+        except JobLost:
+            raise
+        except Exception as e:
+            logging.exception('Job %s failed' % job['_id'])
+            update_job(db, job, FAILED, job.get('progress', 0.0), status=FAILED, error=str(e),
+                       traceback=traceback.format_exc(), finished=datetime.datetime.now())
+            return
+
+        update_job(db, job, DONE, 1.0, status=DONE, result=result, finished=datetime.datetime.now())
+    except JobLost as e:
+        logging.warning(str(e))
+    finally:
+        stop.set()
+        heartbeat.join()
+
+
+def get_job(db, job_id):
+    """Returns a job document, None if the id is unknown"""
+    if not ObjectId.is_valid(job_id):
+        return None
+    return db.jobs.find_one({'_id': ObjectId(job_id)})
+
+
+def run_worker(db, poll_interval=1.0):
+    """
+    Runs queued jobs until interrupted. Start as many worker processes as jobs should run concurrently.
+
+    :param db: database connection
+    :param poll_interval: seconds to wait when the queue is empty
+    """
+
+    # job handlers are registered by the modules defining them
+    import matchminer.miner
+
+    db.jobs.create_index([('status', 1), ('_created', 1)])
+    logging.info('Job worker started')
+    while True:
+        job = claim_job(db)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        logging.info('Running %s job %s' % (job['type'], job['_id']))
+        run_job(db, job)
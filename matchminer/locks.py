@@ -0,0 +1,123 @@
+import os
+import uuid
+import socket
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# names of the locked operations
+FILTERS = 'filters'
+MATCHENGINE = 'matchengine'
+ELASTICSEARCH = 'elasticsearch'
+
+# a lock whose owner has not renewed it for this many seconds is free, e.g. after the owner crashed
+LEASE_SECONDS = 300
+
+
+class LockHeld(RuntimeError):
+    """Raised when a lock is held by another owner"""
+
+
+class RunLock(object):
+    """
+    Lease lock for long running operations shared by every process using the database, e.g. filter runs.
+
+    The lock is a document of the active_processes collection, keyed by the operation name. It is acquired
+    with a single upsert, which fails on the unique _id while another owner's lease is still valid. The owner
+    renews the lease from a heartbeat thread and records the progress of the operation on the document, which
+    /api/is_matchengine_running reports. A crashed owner stops renewing, and the lock is free once its lease
+    expired.
+    """
+
+    def __init__(self, db, name, lease=LEASE_SECONDS):
+        """
+        :param db: database connection
+        :param name: locked operation, e.g. FILTERS
+        :param lease: seconds the lock is held without a heartbeat
+        """
+        self.db = db
+        self.name = name
+        self.lease = datetime.timedelta(seconds=lease)
+        self.owner = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self, stage='started'):
+        """
+        Takes the lock if it is free or its lease expired, and starts renewing it
+
+        :return: True if the lock was acquired
+        """
+
+        now = datetime.datetime.now()
+        try:
+            self.db.active_processes.find_one_and_update(
+                {'_id': self.name, '$or': [{'expires': {'$lt': now}}, {'owner': self.owner}]},
+                {'$set': {'owner': self.owner, 'started': now, 'heartbeat': now, 'expires': now + self.lease,
+                          'stage': stage, 'progress': 0.0}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            return False
+
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True, name='lock-%s' % self.name)
+        self._heartbeat.start()
+        return True
+
+    def update(self, stage, progress, **fields):
+        """Records the progress of the locked operation and renews the lease"""
+        fields.update(stage=stage, progress=progress)
+        return self._touch(fields)
+
+    def release(self):
+        """Stops renewing the lease and frees the lock if it is still held by this owner"""
+        self._stop.set()
+        if self._heartbeat is not None and self._heartbeat is not threading.current_thread():
+            self._heartbeat.join()
+        self._heartbeat = None
+        self.db.active_processes.delete_one({'_id': self.name, 'owner': self.owner})
+
+    def _touch(self, fields=None):
+        now = datetime.datetime.now()
+        update = dict(fields or {}, heartbeat=now, expires=now + self.lease)
+        result = self.db.active_processes.update_one({'_id': self.name, 'owner': self.owner}, {'$set': update})
+        if result.matched_count == 0:
+            logging.warning('Lost the %s lock, its lease expired' % self.name)
+            return False
+        return True
+
+    def _renew(self):
+        interval = self.lease.total_seconds() / 3
+        while not self._stop.wait(interval):
+            try:
+                self._touch()
+            except Exception as e:
+                logging.warning('Error renewing the %s lock: %s' % (self.name, e))
+
+
+@contextmanager
+def run_lock(db, name, stage='started'):
+    """
+    Holds a RunLock for the enclosed block
+
+    :raises LockHeld: if another owner holds the lock
+    """
+    lock = RunLock(db, name)
+    if not lock.acquire(stage):
+        raise LockHeld('%s already running' % name)
+    try:
+        yield lock
+    finally:
+        lock.release()
+
+
+def active_locks(db):
+    """Returns the held locks with the progress of their operations"""
+    return list(db.active_processes.find({'expires': {'$gt': datetime.datetime.now()}}).sort('started', 1))
@@ -2,6 +2,8 @@
 
 from cerberus1 import schema_registry
 import networkx as nx
+import multiprocessing
+from pymongo.errors import OperationFailure, DocumentTooLarge
 import gc
 import logging
 
@@ -9,6 +11,12 @@ from matchminer.matchengine_v1 import schema
 from matchminer.matchengine_v1.validation import ConsentValidatorCerberus
 from matchminer.matchengine_v1.utilities import *
 from matchminer.matchengine_v1.sort import add_sort_order
+from matchminer.matchengine_v1.sampleset import SampleIndex
+from matchminer.matchengine_v1.plan import compile_match_plan
+from matchminer.matchengine_v1.explain import explain_query, leaf_flags
+from matchminer.matchengine_v1.snapshot import GenomicSnapshot, SnapshotGenomicInfo, UnsupportedQuery
+from matchminer.matchengine_v1.settings import MAPPING, MONGO_URI
+from matchminer.profiler import RunProfile, measure
 
 # logging
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(asctime)s: %(message)s', )
@@ -36,77 +44,108 @@ schema_registry.add('yaml_clinical_schema', schema.yaml_clinical_schema)
 schema_registry.add('map', schema.map)
 
 
-class MatchEngine(object):
+# trial fields needed to match a trial
+TRIAL_PROJECTION = {'protocol_no': 1, 'nct_id': 1, 'treatment_list': 1, '_summary': 1}
 
-    def __init__(self, db):
-        # get the database.
-        self.db = db
-
-        # stores the complete list as easy lookup
-        self.all_match = set(self.db.clinical.distinct('SAMPLE_ID'))
-
-        # get mapping values between yml and db
-        self.bootstrap_map()
-        self.mapping = list(self.db.map.find())
-
-        # add mmr/ms status mapping
-        self.mapping.extend([
-            {'key_old': 'MMR_STATUS', 'key_new': 'MMR_STATUS', 'values': {}},
-            {'key_old': 'MS_STATUS', 'key_new': 'MMR_STATUS', 'values': {}}
-        ])
-
-    def bootstrap_map(self):
-        """Loads the map into the database between yaml field names and their corresponding database field names"""
-
-        # define the mapping
-        key_map = {
-            'AGE_NUMERICAL': 'BIRTH_DATE',
-            'EXON': 'TRUE_TRANSCRIPT_EXON',
-            'HUGO_SYMBOL': 'TRUE_HUGO_SYMBOL',
-            'PROTEIN_CHANGE': 'TRUE_PROTEIN_CHANGE',
-            'WILDCARD_PROTEIN_CHANGE': 'TRUE_PROTEIN_CHANGE',
-            'ONCOTREE_PRIMARY_DIAGNOSIS': 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME',
-            'VARIANT_CLASSIFICATION': 'TRUE_VARIANT_CLASSIFICATION',
-            'VARIANT_CATEGORY': 'VARIANT_CATEGORY',
-            'CNV_CALL': 'CNV_CALL',
-            'WILDTYPE': 'WILDTYPE',
-            'GENDER': 'GENDER'
-        }
 
-        val_map = {
-            'VARIANT_CATEGORY': {
-                'Mutation': 'MUTATION',
-                'Copy Number Variation': 'CNV',
-                'Structural Variation': 'SV'
-            },
-            'CNV_CALL': {
-                'Low Amplification': 'Gain',
-                'High Amplification': 'High level amplification',
-                'Homozygous Deletion': 'Homozygous deletion',
-                'Heterozygous Deletion': 'Heterozygous deletion',
-            },
-            'WILDTYPE': {
-                'true': True,
-                'false': False
-            }
-        }
+class MatchEngine(object):
 
-        # create collection
-        mapping = []
-        for old_key, new_key in list(key_map.items()):
-            item = {
-                'key_old': old_key,
-                'key_new': new_key
-            }
-            if old_key in val_map:
-                item['values'] = val_map[old_key]
-            else:
-                item['values'] = {}
-            mapping.append(item)
+    def __init__(self, db=None, snapshot=False, facet=False):
+        """
+        :param db: database connection. Engines created without one can only build trial and match
+            trees, which lets callers parse CTML without touching Mongo.
+        :param snapshot: if True, the genomic collection is loaded into memory once per run and genomic
+            leaves are evaluated against that snapshot. Mongo is then only used to fetch the documents of
+            matched samples.
+        :param facet: if True, the uncached genomic and clinical leaves of a match tree are each run as a
+            single aggregation with one $facet per leaf, instead of one query per leaf.
+        """
 
-        # add to db
-        self.db.drop_collection("map")
-        self.db.map.insert_many(mapping)
+        # get the database.
+        self.db = db
+        self.snapshot = snapshot
+        self._genomic_snapshot = None
+        self.facet = facet
+
+        # complete list of sample ids and their bit positions, loaded on first use by leaf queries
+        self._all_match = None
+        self._sample_index = None
+
+        # SAMPLE_IDs leaf queries are restricted to, None for the whole cohort
+        self.sample_scope = None
+
+        # mapping values between yml and db
+        self.mapping = MAPPING
+
+        # per-run results of leaf queries keyed by their normalized Mongo query
+        self.query_cache = {}
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+
+        # leaf results fetched ahead of traversal by a $facet aggregation
+        self._prefetched = {}
+
+        # clinical leaf queries by match plan and node. They depend on the date and the oncotree, so unlike
+        # genomic queries they are not kept on the plan.
+        self._clinical_queries = {}
+
+        # Mongo usage of the engine, broken down per trial, match level and leaf by profiled runs
+        self.mongo_queries = 0
+        self.docs_examined = 0
+        self.profile = None
+        self._profiled_trial = None
+
+    @property
+    def all_match(self):
+        """All SAMPLE_IDs in the clinical collection. Only engines which run leaf queries need these."""
+        if self._all_match is None:
+            self._all_match = set(self.db.clinical.distinct('SAMPLE_ID', self._scoped({})))
+        return self._all_match
+
+    @property
+    def sample_index(self):
+        """Dense integer positions of all SAMPLE_IDs, used to store matched samples as bit arrays"""
+        if self._sample_index is None:
+            self._sample_index = SampleIndex(self.all_match)
+        return self._sample_index
+
+    @property
+    def genomic_snapshot(self):
+        """Columnar copy of the genomic collection, loaded on first use in snapshot mode"""
+        if self._genomic_snapshot is None:
+            self._count_query(self.db.genomic, self._scoped({}), explain=False)
+            self._genomic_snapshot = GenomicSnapshot(self.db, self.sample_index, self._scoped({}))
+        return self._genomic_snapshot
+
+    def _scoped(self, query):
+        """Restricts a Mongo query to the samples in scope"""
+        if self.sample_scope is None:
+            return query
+        scope = {'SAMPLE_ID': {'$in': sorted(self.sample_scope)}}
+        return {'$and': [query, scope]} if query else scope
+
+    def _count_query(self, collection, query, explain=True):
+        """
+        Counts a Mongo query issued by a leaf. In profiled runs the query is also explained to record how many
+        documents it examined, which runs it a second time.
+        """
+        self.mongo_queries += 1
+        if self.profile is not None and explain:
+            stats = collection.find(query).explain().get('executionStats', {})
+            self.docs_examined += stats.get('totalDocsExamined', 0)
+
+    def _measure(self, level, name, **fields):
+        """Records the wall time and Mongo usage of the enclosed block when the run is profiled"""
+        return measure(self.profile, level, name, **fields)
+
+    def _reset_caches(self):
+        """Drops the sample index, genomic snapshot and leaf query results, which only hold for one cohort"""
+        self._all_match = None
+        self._sample_index = None
+        self._genomic_snapshot = None
+        self.query_cache = {}
+        self._prefetched = {}
+        self._clinical_queries = {}
 
     @staticmethod
     def validate_yaml_format(data):
@@ -157,36 +196,13 @@ class MatchEngine(object):
     @staticmethod
     def create_match_tree(data):
         """
-        Given json object of MATCH clause , the function returns a directed graph
+        Given json object of MATCH clause , the function returns a directed graph. The graph belongs to the
+        clause's compiled match plan and is shared, so it must not be modified.
 
         :param data: json match clause
         :return: diGraph match tree
         """
-
-        key = list(data.keys())[0]
-        value = data[key]
-        global_node = 1
-        g = nx.DiGraph()
-        s = []
-        s.append([0, global_node, key, value])
-
-        while len(s) > 0:
-            current = s.pop(0)
-            parent = current[0]
-            node = current[1]
-            key = current[2]
-            value = current[3]
-            g.add_node(node)
-            g.add_edges_from([(parent, node)])
-            g.nodes[node]['type'] = key
-            if isinstance(value, dict):
-                g.nodes[node]['value'] = value
-            elif isinstance(value, list):
-                for i in range(0, len(value)):
-                    global_node += 1
-                    s.append([node, global_node, list(value[i].keys())[0], value[i][list(value[i].keys())[0]]])
-        g.remove_node(0)
-        return g
+        return compile_match_plan(data).graph
 
     def create_trial_tree(self, raw_data, no_validate=False):
         """ creates networkx tree of trial from a python dictionary
@@ -221,170 +237,314 @@ class MatchEngine(object):
         # return the tree.
         return 0, G
 
-    def run_query(self, node):
+    def run_query(self, plan, node_id):
         """
-        Runs genomic or clinical query against Mongo database and returns a set of sample ids that matched
+        Runs genomic or clinical query against Mongo database and returns a set of sample ids that matched.
+        Results are memoized per run by their normalized Mongo query, so identical leaves across match trees
+        only hit the database once.
 
-        :param node: node location with the trial match tree
-        :param db: database connection
+        :param plan: compiled match plan
+        :param node_id: leaf of the match plan
 
         :returns
-            matched_sample_ids: set of matched sample ids
-            matched_genomic_info: genomic information regarding each match
+            matched_sample_ids: SampleSet of matched samples
+            matched_genomic_info: genomic information regarding each match, looked up by sample id
         """
 
-        matched_genomic_info = []
+        prepared = self._prepare_leaf(plan, node_id)
+        if prepared is None:
+            logging.info("bad match tree")
+            return
 
-        # execute query against genomic table
-        if node['type'] == 'genomic':
+        node = plan.nodes[node_id]
+        criterion = '%s %s' % (node.type, json.dumps(node.value, sort_keys=True, default=str))
+        with self._measure('leaf', criterion, protocol_no=self._profiled_trial) as entry:
 
-            item = node['value']
+            key = prepared[0]
+            entry['cached'] = key in self.query_cache
+            if key in self.query_cache:
+                self.query_cache_hits += 1
+            else:
+                self.query_cache_misses += 1
+                if key in self._prefetched:
+                    self.query_cache[key] = self._prefetched.pop(key)
+                elif node.type == 'genomic':
+                    self.query_cache[key] = self._run_genomic_query(*prepared[1:])
+                else:
+                    self.query_cache[key] = self._run_clinical_query(*prepared[1:])
 
-            # prepare genomic criteria
-            g, neg, sv = self.prepare_genomic_criteria(item)
+            if self.profile is not None:
+                entry['results'] = len(self.query_cache[key][0])
 
-            # execute match
-            if len(list(g.keys())) == 0:
-                matched_sample_ids = list()
-            else:
+        # sample sets are immutable so cached results can be handed out as they are
+        return self.query_cache[key]
 
-                if neg:
-                    proj = {'SAMPLE_ID': 1}  # speeds up query
-                else:
-                    proj = {
-                        'SAMPLE_ID': 1,
-                        'TRUE_HUGO_SYMBOL': 1,
-                        'TRUE_PROTEIN_CHANGE': 1,
-                        'TRUE_VARIANT_CLASSIFICATION': 1,
-                        'VARIANT_CATEGORY': 1,
-                        'CNV_CALL': 1,
-                        'WILDTYPE': 1,
-                        'CHROMOSOME': 1,
-                        'POSITION': 1,
-                        'TRUE_CDNA_CHANGE': 1,
-                        'REFERENCE_ALLELE': 1,
-                        'TRUE_TRANSCRIPT_EXON': 1,
-                        'CANONICAL_STRAND': 1,
-                        'ALLELE_FRACTION': 1,
-                        'TIER': 1,
-                        'CLINICAL_ID': 1,
-                        'MMR_STATUS': 1,
-                        'ACTIONABILITY': 1,
-                        '_id': 1
-                    }
-
-                    # record pathologist's chromosomal rearrangement comment for downstream manual analysis
-                    if sv:
-                        proj['STRUCTURAL_VARIANT_COMMENT'] = 1
-
-                results = list(self.db.genomic.find(g, proj))
-
-                # if a negative query was match, the formatted genomic alteration will reflect the trial criteria
-                # and the genomic information will not be copied into the trial_match document
-                if neg:
+    def _prepare_leaf(self, plan, node_id):
+        """
+        Translates a leaf's criteria into its Mongo query once
 
-                    # If the yaml criterium was negative, then subtract the matched results from the total set
-                    matched_sample_ids = self.all_match - set(x['SAMPLE_ID'] for x in results)
-                    alteration, is_variant = format_not_match(g)
+        :param plan: compiled match plan
+        :param node_id: leaf of the match plan
+        :return: tuple of the cache key and the arguments of the query function, None for unknown leaves
+        """
 
-                    # add genomic alterations per sample id
-                    matched_genomic_info = [{
-                        'sample_id': sample_id,
-                        'match_type': is_variant,
-                        'genomic_alteration': alteration
-                    } for sample_id in matched_sample_ids]
+        node = plan.nodes[node_id]
 
-                else:
-                    for item in results:
+        # prepare genomic criteria
+        if node.type == 'genomic':
+            if node_id not in plan.queries:
+                g, neg, sv = self.prepare_genomic_criteria(node.value)
+                plan.queries[node_id] = (query_key(node.type, g, neg, sv), g, neg, sv)
+            return plan.queries[node_id]
 
-                        # format the genomic alteration that matched
-                        alteration, is_variant = format_genomic_alteration(item, g)
+        # prepare clinical criteria
+        elif node.type == 'clinical':
+            key = (plan.key, node_id)
+            if key not in self._clinical_queries:
+                c = self.prepare_clinical_criteria(node.value)
+                self._clinical_queries[key] = (query_key(node.type, c), c)
+            return self._clinical_queries[key]
 
-                        # add genomic information and alterations that matched per sample id
-                        genomic_info = {
-                            'match_type': is_variant,
-                            'genomic_alteration': alteration
-                        }
+        return None
 
-                        # copy genomic document projection into match
-                        for field in proj:
-                            if field in item:
-                                if field == '_id':
-                                    genomic_info['genomic_id'] = item[field]
-                                else:
-                                    genomic_info[field.lower()] = item[field]
+    def _prefetch_leaves(self, plan):
+        """
+        Runs the uncached leaf queries of a match tree with one aggregation per collection, using one $facet
+        per leaf. Leaves whose results don't fit in a single aggregation result are left to run_query.
 
-                        # add unique matches by sample id
-                        matched_genomic_info.append(genomic_info)
+        :param plan: compiled match plan
+        """
 
-                    matched_sample_ids = set(item['SAMPLE_ID'] for item in results)
+        genomic = {}
+        clinical = {}
+        for node_id in plan.leaves:
+            node = plan.nodes[node_id]
+            prepared = self._prepare_leaf(plan, node_id)
+            if prepared is None or prepared[0] in self.query_cache or prepared[0] in self._prefetched:
+                continue
 
-        # execute query against clinical table
-        elif node['type'] == 'clinical':
+            # empty queries need no round trip and snapshot leaves are evaluated in memory
+            if len(list(prepared[1].keys())) == 0:
+                continue
+            if node.type == 'genomic' and not self.snapshot:
+                genomic[prepared[0]] = prepared[1:]
+            elif node.type == 'clinical':
+                clinical[prepared[0]] = prepared[1:]
+
+        # a single leaf is cheaper as a plain query
+        if len(genomic) > 1:
+            facets = dict(('leaf%d' % i, [{'$match': gq}, {'$project': genomic_projection(neg, sv)}])
+                          for i, (gq, neg, sv) in enumerate(genomic.values()))
+            results = self._run_facets(self.db.genomic, [gq for gq, _, _ in genomic.values()], facets)
+            if results is not None:
+                for i, (key, (gq, neg, sv)) in enumerate(genomic.items()):
+                    self._prefetched[key] = self._genomic_result(gq, neg, genomic_projection(neg, sv),
+                                                                 results['leaf%d' % i])
+
+        if len(clinical) > 1:
+            facets = dict(('leaf%d' % i, [{'$match': c}, {'$group': {'_id': '$SAMPLE_ID'}}])
+                          for i, (c,) in enumerate(clinical.values()))
+            results = self._run_facets(self.db.clinical, [c for c, in clinical.values()], facets)
+            if results is not None:
+                for i, key in enumerate(clinical):
+                    sample_ids = [item['_id'] for item in results['leaf%d' % i]]
+                    self._prefetched[key] = self.sample_index.encode(sample_ids), {}
+
+    def _run_facets(self, collection, queries, facets):
+        """
+        Runs the leaf queries of a collection as one aggregation. The documents matching any leaf are selected
+        up front, so the leaves are evaluated over them only and that first stage can use the indexes.
 
-            item = node['value']
+        :param collection: Mongo collection
+        :param queries: Mongo queries of the leaves
+        :param facets: $facet stage with one pipeline per leaf
+        :return: facet results by name, None if the aggregation failed
+        """
 
-            # prepare clinical criteria
-            c = self.prepare_clinical_criteria(item)
+        pipeline = [{'$match': self._scoped({'$or': queries})}, {'$facet': facets}]
+        self._count_query(collection, pipeline[0]['$match'])
+        try:
+            return list(collection.aggregate(pipeline, allowDiskUse=True))[0]
+        except (OperationFailure, DocumentTooLarge) as e:
 
-            # execute match
-            if len(list(c.keys())) == 0:
-                matched_sample_ids = list()
-            else:
-                matched_sample_ids = set(self.db.clinical.find(c).distinct('SAMPLE_ID'))
+            # the results of all facets are returned as a single document which is limited to 16MB
+            logging.info('Falling back to one query per leaf: %s' % e)
+            return None
+
+    def query_cache_stats(self):
+        """Returns the number of hits and misses of the leaf query cache along with its hit rate"""
+
+        total = self.query_cache_hits + self.query_cache_misses
+        return {
+            'hits': self.query_cache_hits,
+            'misses': self.query_cache_misses,
+            'hit_rate': float(self.query_cache_hits) / total if total else 0.0
+        }
+
+    def _run_genomic_query(self, g, neg, sv):
+        """
+        Runs a prepared genomic query against the genomic collection
+
+        :param g: Mongo query for genomic collection
+        :param neg: True if the query is run negatively
+        :param sv: True if the query is on structural variants
+        :return: matched sample set and genomic information regarding each match by sample id
+        """
+
+        matched_genomic_info = {}
+
+        # execute match
+        if len(list(g.keys())) == 0:
+            return self.sample_index.empty(), matched_genomic_info
+
+        proj = genomic_projection(neg, sv)
+
+        # in snapshot mode the query is evaluated in memory unless it uses something the snapshot can't handle
+        if self.snapshot:
+            try:
+                return self._run_snapshot_query(g, neg, proj)
+            except UnsupportedQuery as e:
+                logging.info('Running genomic query against Mongo: %s' % e)
+
+        self._count_query(self.db.genomic, self._scoped(g))
+        results = list(self.db.genomic.find(self._scoped(g), proj))
+        return self._genomic_result(g, neg, proj, results)
+
+    def _genomic_result(self, g, neg, proj, results):
+        """
+        Builds the leaf result of a genomic query from the matched genomic documents
+
+        :param g: Mongo query for genomic collection
+        :param neg: True if the query is run negatively
+        :param proj: projection of the genomic documents
+        :param results: genomic documents matching the query
+        :return: matched sample set and genomic information regarding each match by sample id
+        """
+
+        matched_genomic_info = {}
+
+        # if a negative query was match, the formatted genomic alteration will reflect the trial criteria
+        # and the genomic information will not be copied into the trial_match document
+        if neg:
+
+            # If the yaml criterium was negative, then the matched results are negated. The negation is
+            # lazy so the complement of the cohort is never materialized.
+            matched_sample_ids = ~self.sample_index.encode(x['SAMPLE_ID'] for x in results)
+            matched_genomic_info = self._negative_genomic_info(g, matched_sample_ids)
 
         else:
-            logging.info("bad match tree")
-            return
+            for item in results:
+
+                # add unique matches by sample id
+                matched_genomic_info.setdefault(item['SAMPLE_ID'], []).append(format_genomic_info(item, g, proj))
+
+            matched_sample_ids = self.sample_index.encode(matched_genomic_info)
 
-        # return a list of sample ids and match information
         return matched_sample_ids, matched_genomic_info
 
-    def traverse_match_tree(self, g):
+    def _run_snapshot_query(self, g, neg, proj):
+        """
+        Evaluates a prepared genomic query against the in memory genomic snapshot
+
+        :param g: Mongo query for genomic collection
+        :param neg: True if the query is run negatively
+        :param proj: projection of the genomic documents copied into the match
+        :return: matched sample set and genomic information regarding each match by sample id
+        :raises UnsupportedQuery: if the snapshot can't evaluate the query
+        """
+
+        mask = self.genomic_snapshot.match(g)
+
+        if neg:
+            matched_sample_ids = ~self.genomic_snapshot.samples(mask)
+            return matched_sample_ids, self._negative_genomic_info(g, matched_sample_ids)
+
+        rows_by_sample = self.genomic_snapshot.rows_by_sample(mask)
+        matched_genomic_info = SnapshotGenomicInfo(self.genomic_snapshot, rows_by_sample, g, proj,
+                                                   format_genomic_info)
+        return self.genomic_snapshot.samples(mask), matched_genomic_info
+
+    @staticmethod
+    def _negative_genomic_info(g, matched_sample_ids):
+        """Genomic information of a negative leaf, only built for the samples which end up matching the tree"""
+
+        alteration, is_variant = format_not_match(g)
+        return NegativeGenomicInfo(matched_sample_ids, {
+            'match_type': is_variant,
+            'genomic_alteration': alteration
+        })
+
+    def _run_clinical_query(self, c):
+        """
+        Runs a prepared clinical query against the clinical collection
+
+        :param c: Mongo query for clinical collection
+        :return: matched sample set and empty genomic information
+        """
+
+        # execute match
+        if len(list(c.keys())) == 0:
+            return self.sample_index.empty(), {}
+
+        self._count_query(self.db.clinical, self._scoped(c))
+        return self.sample_index.encode(self.db.clinical.find(self._scoped(c)).distinct('SAMPLE_ID')), {}
+
+    def traverse_match_tree(self, plan):
         """ Finds matches for a given match tree
 
-        :param g: diGraph match tree
+        :param plan: compiled match plan
         :return: match set for a tree
         """
 
-        tree_genomic = {}
-        for node_id in list(nx.dfs_postorder_nodes(g, source=1)):
+        # fetch the results of all leaves up front in one round trip per collection
+        if self.facet:
+            self._prefetch_leaves(plan)
+
+        # plans are shared, so the sample sets of the nodes are kept apart from them
+        matched = {}
+        leaves = []
+        for node_id in plan.postorder:
 
             # get node and its child
-            node = g.nodes[node_id]
-            successors = g.successors(node_id)
+            node = plan.nodes[node_id]
+            successors = node.children
 
             # if leaf node then execute query
             if len(successors) == 0:
-                matched_sample_ids, matched_genomic_info = self.run_query(node)
-
-                node['matched_sample_ids'] = matched_sample_ids
-                node['matched_genomic_info'] = matched_genomic_info
+                matched_sample_ids, matched_genomic_info = self.run_query(plan, node_id)
 
-                for match in node['matched_genomic_info']:
-                    if match['sample_id'] not in tree_genomic:
-                        tree_genomic[match['sample_id']] = [match]
-                    else:
-                        tree_genomic[match['sample_id']].append(match)
+                matched[node_id] = matched_sample_ids
+                leaves.append(matched_genomic_info)
 
             # else apply logic based on and/or
             else:
 
-                node['matched_sample_ids'] = set([])
-                node['matched_sample_ids'].update(g.nodes[successors[0]]['matched_sample_ids'])
-                node['matched_genomic_info'] = g.nodes[successors[0]]['matched_genomic_info']
+                matched_sample_ids = matched[successors[0]]
 
                 for i in range(1, len(successors)):
-                    s_list = g.nodes[successors[i]]['matched_sample_ids']
+                    s_list = matched[successors[i]]
+
+                    if node.type == 'and':
+                        matched_sample_ids = matched_sample_ids & s_list
 
-                    if node['type'] == 'and':
-                        node['matched_sample_ids'].intersection_update(s_list)
+                    elif node.type == 'or':
+                        matched_sample_ids = matched_sample_ids | s_list
 
-                    elif node['type'] == 'or':
-                        node['matched_sample_ids'].update(s_list)
+                matched[node_id] = matched_sample_ids
 
-        final_sample_ids = g.nodes[1]['matched_sample_ids']
-        final_genomic_infos = [tree_genomic[i] for i in final_sample_ids]
+        # gather the genomic information of every leaf in traversal order for the samples that matched
+        final_sample_ids = self.sample_index.decode(matched[1])
+
+        # snapshot leaves fetch the genomic documents of those samples from Mongo in batches
+        for genomic_info in leaves:
+            if isinstance(genomic_info, SnapshotGenomicInfo):
+                self.genomic_snapshot.hydrate(genomic_info.rows(final_sample_ids), genomic_info.proj)
+        final_genomic_infos = []
+        for sample_id in final_sample_ids:
+            sample_genomic_infos = []
+            for genomic_info in leaves:
+                sample_genomic_infos.extend(genomic_info.get(sample_id, []))
+            final_genomic_infos.append(sample_genomic_infos)
 
         return final_sample_ids, final_genomic_infos
 
@@ -397,6 +557,7 @@ class MatchEngine(object):
         """
 
         c = {}
+        item = dict(item)
 
         # create the oncotree.
         onco_tree = build_oncotree()
@@ -410,7 +571,7 @@ class MatchEngine(object):
                 del item[key]
 
         for field in item:
-            # this maps yaml field names to those stored in the database through the database collection "map"
+            # this maps yaml field names to those stored in the database through the engine's mapping
             norm_field, _ = normalize_fields(self.mapping, field)
             txt = item[field]
 
@@ -436,6 +597,7 @@ class MatchEngine(object):
         """
 
         g = {}
+        item = dict(item)
         track_neg = False
         track_sv = False
         wildtype = False
@@ -455,7 +617,7 @@ class MatchEngine(object):
 
         for field, val in list(item.items()):
 
-            # this maps the yaml field names to those stored in the database through the database collection "map"
+            # this maps the yaml field names to those stored in the database through the engine's mapping
             norm_field, norm_val = normalize_values(self.mapping, field, val)
             txt = norm_val
 
@@ -484,53 +646,38 @@ class MatchEngine(object):
 
         return g, track_neg, track_sv
 
-    def find_trial_matches(self):
+    def find_trial_matches(self, workers=1, uri=None, profile=False, report=None):
         """
         Iterates through all match clauses of all trials located in the database and matches patients to trials
         based on their clinical and genomic documents.
 
+        :param workers: Number of processes to shard the trials across. Each worker process opens its own
+            Mongo connection and compiles its own oncotree, and in snapshot mode loads its own genomic
+            snapshot. Matches are merged back in trial order, so the output is identical to a serial run.
+        :param uri: Mongo URI used by the worker processes. Defaults to the MONGO_URI setting.
+        :param profile: if True, the wall time and Mongo usage of every trial, match level and leaf are stored
+            in the run_profile collection. Leaf queries are explained to count the documents they examine,
+            which slows the run down.
+        :param report: path of a JSON report of the profiled run
         :return: Dictionary containing matches
         """
 
-        # all MRNs and trials in the database
-        mrns = self.db.clinical.distinct('MRN')
-        proj = {'protocol_no': 1, 'nct_id': 1, 'treatment_list': 1, '_summary': 1}
-        all_trials = list(self.db.trial.find({}, proj))
+        self.profile = RunProfile('v1', lambda: (self.mongo_queries, self.docs_examined)) if profile else None
 
-        # create a map between sample id and MRN
-        mrn_map = samples_from_mrns(self.db, mrns)
+        # all trials in the database
+        all_trials = list(self.db.trial.find({}, TRIAL_PROJECTION))
 
-        # initialize trial matches
-        trial_matches = []
+        # start the run with an empty leaf query cache
+        self.sample_scope = None
+        self._reset_caches()
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
 
         # for all trials check for matches on the dose, arm, and step levels and keep track of what is found
-        for trial in all_trials:
-
-            logging.info('Matching trial %s' % trial['protocol_no'])
-
-            # If the trial is not open to accrual, all matches to all match trees in this trial will be marked closed
-            trial_status = 'open'
-            if '_summary' in trial:
-                if 'status' in trial['_summary'] and isinstance(trial['_summary']['status'], list):
-                    if 'value' in trial['_summary']['status'][0]:
-                        if trial['_summary']['status'][0]['value'].lower() != 'open to accrual':
-                            trial_status = 'closed'
-
-            # STEP #
-            for step in trial['treatment_list']['step']:
-                if 'match' in step:
-                    trial_matches = self._assess_match(mrn_map, trial_matches, trial, step, 'step', trial_status)
-
-                # ARM #
-                for arm in step['arm']:
-                    if 'match' in arm:
-                        trial_matches = self._assess_match(mrn_map, trial_matches, trial, arm, 'arm', trial_status)
-
-                    # DOSE #
-                    for dose in arm['dose_level']:
-                        if 'match' in dose:
-                            trial_matches = self._assess_match(mrn_map, trial_matches, trial, dose, 'dose',
-                                                               trial_status)
+        with self._measure('run', 'match trials') as entry:
+            trial_matches = self._match_trials(all_trials, self._mrn_map(), workers, uri)
+            entry['results'] = len(trial_matches)
+        self._log_query_cache_stats()
 
         trial_match_df = pd.DataFrame.from_dict(trial_matches)
 
@@ -540,90 +687,324 @@ class MatchEngine(object):
 
         # sort
         logging.info('Sorting trial matches.')
-        trial_matches_df = add_sort_order(trial_match_df)
+        with self._measure('run', 'sort'):
+            trial_matches_df = add_sort_order(trial_match_df)
         logging.info('Number of trial matches: %s' % str(trial_match_df.shape[0]))
 
         # add to db
         logging.info('Adding trial matches to database')
-        add_matches(trial_matches_df, self.db)
+        with self._measure('run', 'write'):
+            add_matches(trial_matches_df, self.db)
 
-    def _assess_match(self, mrn_map, trial_matches, trial, trial_segment, match_segment, trial_status):
+        if self.profile is not None:
+            self.profile.save(self.db, report)
+            self.profile = None
+
+    def update_trial_matches(self, since=None, data_push_id=None):
+        """
+        Incrementally refreshes the trial_match collection after a data push or trial edits. Trials updated
+        since the given time are matched against all samples, and all other trials are only matched against
+        the samples whose clinical or genomic documents changed. Only the trial_match documents of those
+        trials and samples are upserted or disabled, and their samples are sorted again.
+
+        :param since: datetime of the previous run. Trials, clinical and genomic documents with a later
+            _updated are treated as changed.
+        :param data_push_id: clinical documents of this data push are treated as changed
+        :return: Number of trial matches upserted
+        """
+
+        run_time = dt.datetime.now()
+
+        # find what changed since the previous run
+        changed = []
+        if since is not None:
+            changed.append({'_updated': {'$gte': since}})
+        if data_push_id is not None:
+            changed.append({'data_push_id': data_push_id})
+        if not changed:
+            raise ValueError('an incremental run needs a start time or a data push id')
+
+        changed_samples = set(self.db.clinical.distinct('SAMPLE_ID', {'$or': changed}))
+        changed_trials = []
+        if since is not None:
+            changed_samples.update(self.db.genomic.distinct('SAMPLE_ID', {'_updated': {'$gte': since}}))
+            changed_trials = list(self.db.trial.find({'_updated': {'$gte': since}}, TRIAL_PROJECTION))
+
+        changed_protocol_nos = [trial['protocol_no'] for trial in changed_trials]
+        other_trials = list(self.db.trial.find({'protocol_no': {'$nin': changed_protocol_nos}}, TRIAL_PROJECTION))
+        logging.info('Incremental run: %d changed trials, %d changed samples' % (
+            len(changed_trials), len(changed_samples)))
+
+        mrn_map = self._mrn_map()
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+        trial_matches = []
+        scopes = []
+
+        # changed trials against the whole cohort
+        if changed_trials:
+            self.sample_scope = None
+            self._reset_caches()
+            trial_matches.extend(self._match_trials(changed_trials, mrn_map))
+            scopes.append({'protocol_no': {'$in': changed_protocol_nos}})
+
+        # changed samples against the remaining trials
+        if changed_samples and other_trials:
+            self.sample_scope = changed_samples
+            self._reset_caches()
+            trial_matches.extend(self._match_trials(other_trials, mrn_map))
+            scopes.append({
+                'sample_id': {'$in': sorted(changed_samples)},
+                'protocol_no': {'$nin': changed_protocol_nos}
+            })
+
+        # matches to trials that were removed
+        scopes.append({'protocol_no': {'$nin': changed_protocol_nos + [t['protocol_no'] for t in other_trials]}})
+
+        self.sample_scope = None
+        self._reset_caches()
+        self._log_query_cache_stats()
+
+        # upsert the new matches and disable the ones of the re-evaluated scopes which no longer hold
+        logging.info('Updating %d trial matches in database' % len(trial_matches))
+        affected_samples = update_matches(pd.DataFrame.from_dict(trial_matches), self.db, scopes, run_time)
+
+        # sort order is ranked across all trials of a sample, so the affected samples are sorted again
+        logging.info('Sorting trial matches of %d samples.' % len(affected_samples))
+        update_sort_order(self.db, affected_samples, add_sort_order)
+
+        return len(trial_matches)
+
+    def _mrn_map(self):
+        """Returns a map between the sample ids and MRNs of all patients in the database"""
+        mrns = self.db.clinical.distinct('MRN')
+        return samples_from_mrns(self.db, mrns)
+
+    def _match_trials(self, trials, mrn_map, workers=1, uri=None):
+        """
+        Matches the given trials against the samples in scope
+
+        :param trials: trial documents
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param workers: Number of processes to shard the trials across
+        :param uri: Mongo URI used by the worker processes
+        :return: List of matches in trial order
+        """
+
+        trial_matches = []
+        if workers > 1:
+            uri = uri or os.getenv('MONGO_URI') or MONGO_URI
+            ctx = multiprocessing.get_context('spawn')
+            initargs = (uri, self.db.name, mrn_map, self.snapshot, self.facet, self.profile is not None)
+            with ctx.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+
+                # imap hands back results in trial order regardless of which worker finished first
+                for matches, hits, misses, profile in pool.imap(_match_trial_worker, trials):
+                    trial_matches.extend(matches)
+                    self.query_cache_hits += hits
+                    self.query_cache_misses += misses
+                    if self.profile is not None:
+                        self.profile.extend(profile)
+        else:
+            for trial in trials:
+                trial_matches.extend(self.match_trial(mrn_map, trial))
+
+        return trial_matches
+
+    def _log_query_cache_stats(self):
+        stats = self.query_cache_stats()
+        logging.info('Leaf query cache: %d hits, %d misses (%.1f%% hit rate)' % (
+            stats['hits'], stats['misses'], 100 * stats['hit_rate']))
+
+    def match_trial(self, mrn_map, trial):
+        """
+        Matches patients to the step, arm and dose level match trees of a single trial
+
+        :param mrn_map: Dictionary mapping patient sample ids to MRNs
+        :param trial: Trial document
+        :return: List of matches in step, arm, dose order
+        """
+
+        self._profiled_trial = trial['protocol_no']
+        with self._measure('trial', trial['protocol_no']) as entry:
+            trial_matches = self._match_trial(mrn_map, trial)
+            entry['results'] = len(trial_matches)
+
+        return trial_matches
+
+    def _match_trial(self, mrn_map, trial):
+        """Matches a single trial, see match_trial"""
+
+        logging.info('Matching trial %s' % trial['protocol_no'])
+        trial_matches = []
+
+        # If the trial is not open to accrual, all matches to all match trees in this trial will be marked closed
+        trial_status = 'open'
+        if '_summary' in trial:
+            if 'status' in trial['_summary'] and isinstance(trial['_summary']['status'], list):
+                if 'value' in trial['_summary']['status'][0]:
+                    if trial['_summary']['status'][0]['value'].lower() != 'open to accrual':
+                        trial_status = 'closed'
+
+        # trial attributes shared by all matches of the trial
+        trial_fields = {
+            'trial_accrual_status': trial_status,
+            'cancer_type_match': get_cancer_type_match(trial),
+            'coordinating_center': get_coordinating_center(trial)
+        }
+        trial_keys = ['protocol_no', 'nct_id']
+        for trial_key in trial_keys:
+            if trial_key in list(trial.keys()):
+                trial_fields[trial_key] = trial[trial_key]
+
+        # STEP #
+        for step in trial['treatment_list']['step']:
+            if 'match' in step:
+                trial_matches = self._assess_match(mrn_map, trial_matches, trial_fields, step, 'step')
+
+            # ARM #
+            for arm in step['arm']:
+                if 'match' in arm:
+                    trial_matches = self._assess_match(mrn_map, trial_matches, trial_fields, arm, 'arm')
+
+                # DOSE #
+                for dose in arm['dose_level']:
+                    if 'match' in dose:
+                        trial_matches = self._assess_match(mrn_map, trial_matches, trial_fields, dose, 'dose')
+
+        return trial_matches
+
+    def explain_trial(self, trial):
+        """
+        Dry run of a trial's match trees. Every leaf query is run with Mongo explain to estimate how many
+        samples it matches and what it costs, and leaves which scan the collections are flagged, so that
+        curators see them before the trial is saved. No matches are computed.
+
+        :param trial: trial document, validated or not
+        :return: one report per distinct leaf query, most expensive first
+        """
+
+        segments = []
+        for step in trial.get('treatment_list', {}).get('step', []):
+            segments.append(('step', step))
+            for arm in step.get('arm', []):
+                segments.append(('arm', arm))
+                for dose in arm.get('dose_level', []):
+                    segments.append(('dose', dose))
+
+        sizes = {}
+        reports = {}
+        for match_segment, trial_segment in segments:
+            if not trial_segment.get('match'):
+                continue
+            segment_id = trial_segment.get('%s_internal_id' % ('level' if match_segment == 'dose' else match_segment))
+
+            plan = compile_match_plan(trial_segment['match'][0])
+            for node_id in plan.leaves:
+                prepared = self._prepare_leaf(plan, node_id)
+                if prepared is None or len(list(prepared[1].keys())) == 0:
+                    continue
+
+                key = prepared[0]
+                if key in reports:
+                    reports[key]['segments'].append('%s %s' % (match_segment, segment_id))
+                    continue
+
+                node = plan.nodes[node_id]
+                neg = node.type == 'genomic' and prepared[2]
+                collection = self.db.genomic if node.type == 'genomic' else self.db.clinical
+                if node.type not in sizes:
+                    sizes[node.type] = collection.estimated_document_count()
+
+                query = self._scoped(prepared[1])
+                stats = explain_query(collection, query)
+
+                # documents are an upper bound of the samples of a positive leaf. Negative leaves match the
+                # samples without a matching document, at least the cohort minus the documents found.
+                if neg:
+                    estimated_samples = max(len(self.all_match) - stats['documents'], 0)
+                else:
+                    estimated_samples = stats['documents']
+
+                reports[key] = dict(stats, **{
+                    'segments': ['%s %s' % (match_segment, segment_id)],
+                    'type': node.type,
+                    'criteria': node.value,
+                    'query': json.dumps(query, sort_keys=True, default=str),
+                    'negative': neg,
+                    'estimated_samples': estimated_samples,
+                    'cost': stats['keys_examined'] + stats['docs_examined'],
+                    'flags': leaf_flags(query, neg, stats, sizes[node.type])
+                })
+
+        return sorted(reports.values(), key=lambda report: report['cost'], reverse=True)
+
+    def _assess_match(self, mrn_map, trial_matches, trial_fields, trial_segment, match_segment):
         """
         Given a trial's match tree, finds all patients that matches to it and records the step, arm, or dose
         internal id that it matched to along with the genomic alteration that matched.
 
         :param mrn_map: Dictionary mapping patient sample ids to MRNs
         :param trial_matches: Dictionary containing the matches
-        :param trial: Trial document
+        :param trial_fields: Trial attributes copied into every match of the trial
         :param trial_segment: Either the step, arm, or dose segment of the trial document
         :param match_segment: Marker indicating if segment is step, arm, or dose
-        :param trial_status: Overall trial status. either open or closed.
         :return: Dictionary containing the matches
         """
 
         # get all matches
-        match_tree = self.create_match_tree(trial_segment['match'][0])
-        sample_ids, ginfos = self.traverse_match_tree(match_tree)
-
-        clinical = []
-        if sample_ids:
-            cproj = {
-                'SAMPLE_ID': 1,
-                'ORD_PHYSICIAN_NAME': 1,
-                'ORD_PHYSICIAN_EMAIL': 1,
-                'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 1,
-                'REPORT_DATE': 1,
-                'VITAL_STATUS': 1,
-                'FIRST_LAST': 1,
-                'GENDER': 1,
-                '_id': 1
-            }
-            clinical = list(self.db.clinical.find({'SAMPLE_ID': {'$in': list(sample_ids)}}, cproj))
-
-        # add to master list if any sample ids matched
-        for sample in ginfos:
-            for alteration in sample:
+        segment_id = trial_segment.get('%s_internal_id' % ('level' if match_segment == 'dose' else match_segment))
+        name = '%s %s %s' % (trial_fields.get('protocol_no'), match_segment, segment_id)
+        with self._measure('match_level', name, protocol_no=trial_fields.get('protocol_no')) as entry:
+            plan = compile_match_plan(trial_segment['match'][0])
+            sample_ids, ginfos = self.traverse_match_tree(plan)
+            entry['results'] = len(sample_ids)
+
+        if not sample_ids:
+            return trial_matches
+
+        # clinical fields of each matched sample, indexed by sample id
+        cproj = {
+            'SAMPLE_ID': 1,
+            'ORD_PHYSICIAN_NAME': 1,
+            'ORD_PHYSICIAN_EMAIL': 1,
+            'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 1,
+            'REPORT_DATE': 1,
+            'VITAL_STATUS': 1,
+            'FIRST_LAST': 1,
+            'GENDER': 1,
+            '_id': 1
+        }
+        clinical = {}
+        for citem in self.db.clinical.find({'SAMPLE_ID': {'$in': list(sample_ids)}}, cproj):
+            clinical[citem['SAMPLE_ID']] = dict(
+                ('clinical_id' if field == '_id' else field.lower(), value) for field, value in citem.items())
+
+        # fields of the step, arm or dose level
+        segment_fields = {'match_level': match_segment}
+        if match_segment == 'dose':
+            segment_fields['internal_id'] = str(trial_segment['level_internal_id'])
+            segment_fields['code'] = trial_segment['level_code']
+            if 'level_suspended' in trial_segment and trial_segment['level_suspended'].lower() == 'y':
+                segment_fields['trial_accrual_status'] = 'closed'
+        elif match_segment == 'arm':
+            segment_fields['internal_id'] = str(trial_segment['arm_internal_id'])
+            segment_fields['code'] = str(trial_segment['arm_code'])
+            if 'arm_suspended' in trial_segment and trial_segment['arm_suspended'].lower() == 'y':
+                segment_fields['trial_accrual_status'] = 'closed'
+        elif match_segment == 'step':
+            segment_fields['internal_id'] = str(trial_segment['step_internal_id'])
+            segment_fields['code'] = trial_segment['step_code']
+
+        # add to master list. leaf results are shared between match trees so every match is a new dict
+        for sample_id, sample in zip(sample_ids, ginfos):
+            sample_fields = {'mrn': mrn_map[sample_id]}
+            sample_fields.update(trial_fields)
+            sample_fields.update(clinical.get(sample_id, {}))
+            sample_fields.update(segment_fields)
 
-                # add match document
-                match = alteration
-                match['mrn'] = mrn_map[alteration['sample_id']]
-                match['match_level'] = match_segment
-                match['trial_accrual_status'] = trial_status
-                match['cancer_type_match'] = get_cancer_type_match(trial)
-                match['coordinating_center'] = get_coordinating_center(trial)
-
-                trial_keys = ['protocol_no', 'nct_id']
-                for trial_key in trial_keys:
-                    if trial_key in list(trial.keys()):
-                        match[trial_key] = trial[trial_key]
-
-                # copy clinical document
-                if clinical:
-                    for citem in clinical:
-                        if citem['SAMPLE_ID'] == alteration['sample_id']:
-                            for field in citem:
-                                if field == '_id':
-                                    match['clinical_id'] = citem[field]
-                                else:
-                                    match[field.lower()] = citem[field]
-
-                # add internal id
-                if match_segment == 'dose':
-                    match['internal_id'] = str(trial_segment['level_internal_id'])
-                    match['code'] = trial_segment['level_code']
-                    if 'level_suspended' in trial_segment and trial_segment['level_suspended'].lower() == 'y':
-                        match['trial_accrual_status'] = 'closed'
-                elif match_segment == 'arm':
-                    match['internal_id'] = str(trial_segment['arm_internal_id'])
-                    match['code'] = str(trial_segment['arm_code'])
-                    if 'arm_suspended' in trial_segment and trial_segment['arm_suspended'].lower() == 'y':
-                        match['trial_accrual_status'] = 'closed'
-                elif match_segment == 'step':
-                    match['internal_id'] = str(trial_segment['step_internal_id'])
-                    match['code'] = trial_segment['step_code']
-
-                # add to trial_matches
-                trial_matches.append(match)
+            for alteration in sample:
+                trial_matches.append({**alteration, **sample_fields})
 
         return trial_matches
 
@@ -631,7 +1012,7 @@ class MatchEngine(object):
     def _search_oncotree_diagnosis(onco_tree, c):
         """Add all the oncotree nodes """
 
-        nodes = []
+        nodes_txt = []
         tmpc = {'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': {}}
         for key in list(c['ONCOTREE_PRIMARY_DIAGNOSIS_NAME'].keys()):
 
@@ -643,31 +1024,19 @@ class MatchEngine(object):
             for txt in diagnoses:
                 if txt.endswith("_LIQUID_") or txt.endswith("_SOLID_"):
 
-                    # build the nodes for liquid.
-                    node1 = oncotreenx.lookup_text(onco_tree, "Lymph")
-                    node2 = oncotreenx.lookup_text(onco_tree, "Blood")
-
-                    nodes1 = list(nx.dfs_tree(onco_tree, node1))
-                    nodes2 = list(nx.dfs_tree(onco_tree, node2))
-                    nodes = list(set(nodes1).union(set(nodes2)))
-
                     # if its really solid take the inverse.
                     if txt == "_SOLID_":
-                        all_nodes = set(list(onco_tree.nodes()))
-                        tmp_nodes = all_nodes - set(nodes)
-                        nodes = list(tmp_nodes)
+                        nodes_txt = onco_tree.texts(onco_tree.solid)
+                    else:
+                        nodes_txt = onco_tree.texts(onco_tree.liquid)
 
                 else:
                     # get tree node.
-                    node = oncotreenx.lookup_text(onco_tree, txt)
-
-                    # get its children.
-                    if onco_tree.has_node(node):
-                        # list of nodes.
-                        nodes = list(nx.dfs_tree(onco_tree, node))
+                    node = onco_tree.lookup_text(txt)
 
-                        # replace it with free text.
-                nodes_txt = [onco_tree.node[n]['text'] for n in nodes]
+                    # its children are a contiguous slice of the preorder text array.
+                    if node in onco_tree:
+                        nodes_txt = onco_tree.descendant_texts(node)
 
                 if key == '$eq':
                     key = '$in'
@@ -737,9 +1106,42 @@ class MatchEngine(object):
             if 'match' not in G.nodes[n]:
                 continue
 
-            # create the match-tree.
-            content = {'match': G.nodes[n]['match']}
-            match_tree = self.create_match_tree(content)
+            # create the match-tree. CTML match lists hold a single clause, which compiles to the same plan the
+            # engine and trial search use.
+            match = G.nodes[n]['match']
+            content = match[0] if len(match) == 1 else {'match': match}
+            plan = compile_match_plan(content)
 
             # embed it in trial tree.
-            G.nodes[n]['match_tree'] = match_tree
+            G.nodes[n]['match_tree'] = plan.graph
+            G.nodes[n]['match_plan'] = plan
+
+
+# per-process state of the trial matching workers
+_worker_engine = None
+_worker_mrn_map = None
+
+
+def _init_worker(uri, db_name, mrn_map, snapshot=False, facet=False, profile=False):
+    """Gives each worker process its own Mongo connection and match engine"""
+    global _worker_engine, _worker_mrn_map
+    _worker_engine = MatchEngine(MongoClient(uri)[db_name], snapshot=snapshot, facet=facet)
+    _worker_mrn_map = mrn_map
+    if profile:
+        _worker_engine.profile = RunProfile('v1', lambda: (_worker_engine.mongo_queries, _worker_engine.docs_examined))
+
+
+def _match_trial_worker(trial):
+    """
+    Matches a single trial in a worker process and reports the leaf query cache usage it caused, along with
+    its profile entries in profiled runs
+    """
+    hits = _worker_engine.query_cache_hits
+    misses = _worker_engine.query_cache_misses
+    matches = _worker_engine.match_trial(_worker_mrn_map, trial)
+
+    profile = []
+    if _worker_engine.profile is not None:
+        profile, _worker_engine.profile.entries = _worker_engine.profile.entries, []
+
+    return matches, _worker_engine.query_cache_hits - hits, _worker_engine.query_cache_misses - misses, profile
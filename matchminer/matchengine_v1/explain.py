@@ -0,0 +1,101 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+
+# a negative leaf is broad when its positive query examines more than this fraction of the collection
+BROAD_FRACTION = 0.5
+
+# $nin lists longer than this, typically negated oncotree expansions, can't be answered from an index
+MAX_NIN_VALUES = 50
+
+# leaves flagged as pathological
+COLLECTION_SCAN = 'collection scan'
+UNINDEXED_REGEX = 'unindexed regex'
+BROAD_NEGATION = 'broad negation'
+LARGE_NIN = 'large $nin'
+
+
+def explain_query(collection, query):
+    """
+    Runs a Mongo query with explain. The query is executed server side to collect its statistics, but no
+    documents are returned.
+
+    :param collection: Mongo collection
+    :param query: Mongo query
+    :return: execution statistics and the stages of the winning plan
+    """
+
+    explained = collection.database.command('explain', {'find': collection.name, 'filter': query},
+                                            verbosity='executionStats')
+    stats = explained.get('executionStats', {})
+    return {
+        'stages': plan_stages(explained.get('queryPlanner', {}).get('winningPlan', {})),
+        'keys_examined': stats.get('totalKeysExamined', 0),
+        'docs_examined': stats.get('totalDocsExamined', 0),
+        'documents': stats.get('nReturned', 0),
+        'millis': stats.get('executionTimeMillis', 0)
+    }
+
+
+def plan_stages(plan):
+    """Returns the stages of a query plan, outermost first"""
+
+    stages = [plan['stage']] if 'stage' in plan else []
+    if 'inputStage' in plan:
+        stages.extend(plan_stages(plan['inputStage']))
+    for stage in plan.get('inputStages', []):
+        stages.extend(plan_stages(stage))
+    return stages
+
+
+def query_operators(query):
+    """Yields every (operator, value) pair of a Mongo query, including nested clauses"""
+
+    if isinstance(query, dict):
+        for key, value in query.items():
+            if key.startswith('$'):
+                yield key, value
+            for item in (value if isinstance(value, list) else [value]):
+                for pair in query_operators(item):
+                    yield pair
+
+
+def _is_prefix_regex(pattern, flags=0):
+    """True for case sensitive regexes anchored at the start, which Mongo turns into index bounds"""
+    if isinstance(pattern, re.Pattern):
+        pattern, flags = pattern.pattern, pattern.flags
+    if isinstance(flags, str):
+        flags = re.IGNORECASE if 'i' in flags else 0
+    return pattern.startswith('^') and not flags & re.IGNORECASE
+
+
+def leaf_flags(query, neg, stats, collection_size):
+    """
+    Flags the pathological traits of an explained leaf query
+
+    :param query: Mongo query of the leaf
+    :param neg: True if the leaf is run negatively
+    :param stats: result of explain_query
+    :param collection_size: number of documents in the queried collection
+    :return: list of flags
+    """
+
+    flags = []
+    if 'COLLSCAN' in stats['stages']:
+        flags.append(COLLECTION_SCAN)
+
+    regexes = []
+    for op, value in query_operators(query):
+        if op == '$regex':
+            regexes.append(value)
+        elif op in ('$in', '$nin'):
+            regexes.extend(item for item in value if isinstance(item, re.Pattern))
+        if op == '$nin' and len(value) > MAX_NIN_VALUES and LARGE_NIN not in flags:
+            flags.append(LARGE_NIN)
+    if regexes and (COLLECTION_SCAN in flags or not all(_is_prefix_regex(r) for r in regexes)):
+        flags.append(UNINDEXED_REGEX)
+
+    if neg and collection_size and stats['docs_examined'] > BROAD_FRACTION * collection_size:
+        flags.append(BROAD_NEGATION)
+
+    return flags
@@ -0,0 +1,109 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import copy
+import json
+import hashlib
+import threading
+from collections import deque, OrderedDict
+
+import networkx as nx
+
+# number of compiled match plans kept in memory
+MAX_PLANS = 10000
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+class PlanNode(object):
+    """Node of a compiled match tree"""
+
+    __slots__ = ('node_id', 'type', 'value', 'children')
+
+    def __init__(self, node_id, node_type, value, children):
+        """
+        :param node_id: id of the node in the match tree, the root is 1
+        :param node_type: and, or, genomic or clinical
+        :param value: criteria of genomic and clinical leaves, None otherwise
+        :param children: ids of the child nodes in CTML order
+        """
+        self.node_id = node_id
+        self.type = node_type
+        self.value = value
+        self.children = children
+
+
+class MatchPlan(object):
+    """
+    Compiled, read-only match tree of a CTML match clause.
+
+    Plans are shared by every caller that parses the same clause, so neither the plan nor its graph may be
+    modified. The Mongo queries of the genomic leaves only depend on the clause and are kept on the plan once
+    the engine has built them.
+    """
+
+    __slots__ = ('key', 'graph', 'nodes', 'postorder', 'leaves', 'queries')
+
+    def __init__(self, clause, key=None):
+        """
+        :param clause: CTML match clause, e.g. {'and': [{'genomic': {...}}, {'clinical': {...}}]}
+        :param key: stable hash of the clause
+        """
+        self.key = key or clause_key(clause)
+
+        # breadth first, numbering nodes in the order they are reached
+        key = list(clause.keys())[0]
+        global_node = 1
+        g = nx.DiGraph()
+        queue = deque([(0, global_node, key, clause[key])])
+        while queue:
+            parent, node, key, value = queue.popleft()
+            g.add_node(node)
+            g.add_edge(parent, node)
+            g.nodes[node]['type'] = key
+            if isinstance(value, dict):
+                g.nodes[node]['value'] = value
+            elif isinstance(value, list):
+                for item in value:
+                    global_node += 1
+                    item_key = list(item.keys())[0]
+                    queue.append((node, global_node, item_key, item[item_key]))
+        g.remove_node(0)
+
+        self.graph = g
+        self.nodes = dict((n, PlanNode(n, g.nodes[n]['type'], g.nodes[n].get('value'), tuple(g.successors(n))))
+                          for n in g.nodes())
+        self.postorder = tuple(nx.dfs_postorder_nodes(g, source=1))
+        self.leaves = tuple(n for n in self.postorder if not self.nodes[n].children)
+        self.queries = {}
+
+
+def clause_key(clause):
+    """Returns a stable hash of a CTML match clause"""
+    return hashlib.sha1(json.dumps(clause, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def compile_match_plan(clause):
+    """
+    Returns the compiled match plan of a CTML match clause. Plans are memoized by the hash of the clause, so
+    every clause is parsed once per process.
+
+    :param clause: CTML match clause
+    :return: MatchPlan
+    """
+
+    key = clause_key(clause)
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans.move_to_end(key)
+            return plan
+
+    # the plan keeps its own copy so later edits of the trial document don't leak into it
+    plan = MatchPlan(copy.deepcopy(clause), key)
+    with _plans_lock:
+        plan = _plans.setdefault(key, plan)
+        while len(_plans) > MAX_PLANS:
+            _plans.popitem(last=False)
+
+    return plan
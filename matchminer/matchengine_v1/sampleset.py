@@ -0,0 +1,129 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import numpy as np
+
+
+class SampleIndex(object):
+    """
+    Maps every SAMPLE_ID of a run to a dense integer so that sets of samples can be stored as bit arrays.
+    Sample ids are numbered in sorted order, which makes decoded sets come out sorted.
+    """
+
+    def __init__(self, sample_ids):
+        """
+        :param sample_ids: all SAMPLE_IDs that can take part in a match
+        """
+        self.sample_ids = sorted(sample_ids)
+        self.positions = {sample_id: i for i, sample_id in enumerate(self.sample_ids)}
+        self.size = len(self.sample_ids)
+
+        # pad to whole 64 bit words
+        self.nbytes = ((self.size + 63) // 64) * 8
+
+    def empty(self):
+        """Returns an empty sample set"""
+        return SampleSet(self, np.zeros(self.nbytes // 8, dtype=np.uint64))
+
+    def encode(self, sample_ids):
+        """
+        Returns the sample set holding the given sample ids. Sample ids which are not part of the index
+        are ignored.
+
+        :param sample_ids: iterable of SAMPLE_IDs
+        :return: SampleSet
+        """
+        mask = np.zeros(self.nbytes * 8, dtype=bool)
+        positions = [self.positions[sample_id] for sample_id in sample_ids if sample_id in self.positions]
+        mask[positions] = True
+        return SampleSet(self, np.packbits(mask).view(np.uint64))
+
+    def encode_positions(self, positions):
+        """
+        Returns the sample set holding the samples at the given bit positions
+
+        :param positions: numpy array of positions within the index
+        :return: SampleSet
+        """
+        mask = np.zeros(self.nbytes * 8, dtype=bool)
+        mask[positions] = True
+        return SampleSet(self, np.packbits(mask).view(np.uint64))
+
+    def decode(self, sample_set):
+        """
+        Returns the sample ids held by a sample set in sorted order
+
+        :param sample_set: SampleSet
+        :return: list of SAMPLE_IDs
+        """
+        return [self.sample_ids[i] for i in np.flatnonzero(sample_set.mask())]
+
+
+class SampleSet(object):
+    """
+    Immutable set of samples stored as a bit array over a SampleIndex.
+
+    Negation is lazy: a negated set keeps the bits of the samples it excludes and a flag, so NOT costs
+    no memory and AND/OR fold the flags in with De Morgan's laws while running vectorized word operations.
+    """
+
+    __slots__ = ('index', 'words', 'negated')
+
+    def __init__(self, index, words, negated=False):
+        """
+        :param index: SampleIndex the bits refer to
+        :param words: uint64 bit array, one bit per sample
+        :param negated: True if the set holds every sample except the ones flagged in words
+        """
+        self.index = index
+        self.words = words
+        self.negated = negated
+
+    def __invert__(self):
+        return SampleSet(self.index, self.words, not self.negated)
+
+    def __and__(self, other):
+        a, b = self.words, other.words
+        if not self.negated and not other.negated:
+            return SampleSet(self.index, a & b)
+        elif self.negated and other.negated:
+            return SampleSet(self.index, a | b, True)
+        elif self.negated:
+            return SampleSet(self.index, b & ~a)
+        else:
+            return SampleSet(self.index, a & ~b)
+
+    def __or__(self, other):
+        a, b = self.words, other.words
+        if not self.negated and not other.negated:
+            return SampleSet(self.index, a | b)
+        elif self.negated and other.negated:
+            return SampleSet(self.index, a & b, True)
+        elif self.negated:
+            return SampleSet(self.index, a & ~b, True)
+        else:
+            return SampleSet(self.index, b & ~a, True)
+
+    def __contains__(self, sample_id):
+        pos = self.index.positions.get(sample_id)
+        if pos is None:
+            return False
+
+        # packbits stores the first sample in the most significant bit of each byte
+        byte = int(self.words.view(np.uint8)[pos >> 3])
+        is_set = bool((byte >> (7 - (pos & 7))) & 1)
+        return is_set != self.negated
+
+    def __len__(self):
+        return int(np.count_nonzero(self.mask()))
+
+    def __bool__(self):
+        if self.negated:
+            return len(self) > 0
+        return bool(self.words.any())
+
+    def mask(self):
+        """Returns one boolean per sample of the index, True for the samples held by the set"""
+        mask = np.unpackbits(self.words.view(np.uint8))[:self.index.size].astype(bool)
+        if self.negated:
+            mask = ~mask
+        return mask
@@ -33,3 +33,45 @@ mmr_map_rev = {
     'Proficient (MMR-P / MSS)': 'MMR-P/MSS',
     'Deficient (MMR-D / MSI-H)': 'MMR-D/MSI-H'
 }
+
+# mapping between yaml field names and their corresponding database field names
+key_map = {
+    'AGE_NUMERICAL': 'BIRTH_DATE',
+    'EXON': 'TRUE_TRANSCRIPT_EXON',
+    'HUGO_SYMBOL': 'TRUE_HUGO_SYMBOL',
+    'PROTEIN_CHANGE': 'TRUE_PROTEIN_CHANGE',
+    'WILDCARD_PROTEIN_CHANGE': 'TRUE_PROTEIN_CHANGE',
+    'ONCOTREE_PRIMARY_DIAGNOSIS': 'ONCOTREE_PRIMARY_DIAGNOSIS_NAME',
+    'VARIANT_CLASSIFICATION': 'TRUE_VARIANT_CLASSIFICATION',
+    'VARIANT_CATEGORY': 'VARIANT_CATEGORY',
+    'CNV_CALL': 'CNV_CALL',
+    'WILDTYPE': 'WILDTYPE',
+    'GENDER': 'GENDER'
+}
+
+# mapping between yaml values and their corresponding database values
+val_map = {
+    'VARIANT_CATEGORY': {
+        'Mutation': 'MUTATION',
+        'Copy Number Variation': 'CNV',
+        'Structural Variation': 'SV'
+    },
+    'CNV_CALL': {
+        'Low Amplification': 'Gain',
+        'High Amplification': 'High level amplification',
+        'Homozygous Deletion': 'Homozygous deletion',
+        'Heterozygous Deletion': 'Heterozygous deletion',
+    },
+    'WILDTYPE': {
+        'true': True,
+        'false': False
+    }
+}
+
+# key/value mapping used by the match engine, including the mmr/ms status mapping
+MAPPING = [{'key_old': old_key, 'key_new': new_key, 'values': val_map.get(old_key, {})}
+           for old_key, new_key in key_map.items()]
+MAPPING.extend([
+    {'key_old': 'MMR_STATUS', 'key_new': 'MMR_STATUS', 'values': {}},
+    {'key_old': 'MS_STATUS', 'key_new': 'MMR_STATUS', 'values': {}}
+])
@@ -0,0 +1,290 @@
+"""Copyright 2016 Dana-Farber Cancer Institute"""
+
+import re
+import logging
+
+import numpy as np
+
+# genomic fields that match tree leaves can query
+SNAPSHOT_FIELDS = [
+    'SAMPLE_ID',
+    'TRUE_HUGO_SYMBOL',
+    'TRUE_PROTEIN_CHANGE',
+    'TRUE_VARIANT_CLASSIFICATION',
+    'TRUE_TRANSCRIPT_EXON',
+    'VARIANT_CATEGORY',
+    'CNV_CALL',
+    'WILDTYPE',
+    'MMR_STATUS'
+]
+
+# documents are hydrated from Mongo in batches of this many _ids
+HYDRATE_BATCH_SIZE = 1000
+
+
+class _Missing(object):
+    """Category of documents which lack a field, as opposed to holding null"""
+
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+
+class UnsupportedQuery(ValueError):
+    """Raised for Mongo queries the snapshot cannot evaluate. Callers fall back to Mongo."""
+    pass
+
+
+def _category_key(value):
+    """
+    Dictionary key of a category. Mongo does not treat booleans as numbers, so they are kept apart from
+    the integers they would otherwise hash alike with.
+    """
+    return isinstance(value, bool), value
+
+
+class Column(object):
+    """
+    Dictionary encoded genomic field. Every row stores the integer code of its value and each distinct value
+    is stored once, so a leaf predicate is evaluated once per distinct value and broadcast to the rows.
+    """
+
+    def __init__(self, values):
+        """
+        :param values: field value of every row, MISSING where the document lacks the field
+        """
+        self.categories = [MISSING]
+        positions = {_category_key(MISSING): 0}
+        codes = np.zeros(len(values), dtype=np.int32)
+
+        for i, value in enumerate(values):
+            if isinstance(value, (list, dict)):
+                raise UnsupportedQuery('array and document values are not supported')
+            key = _category_key(value)
+            code = positions.get(key)
+            if code is None:
+                code = positions[key] = len(self.categories)
+                self.categories.append(value)
+            codes[i] = code
+
+        self.codes = codes
+        self.positions = positions
+
+    def select(self, predicate):
+        """
+        Returns the row mask of a predicate evaluated on the distinct values
+
+        :param predicate: function returning True for matching values
+        :return: boolean numpy array, one entry per row
+        """
+        hits = np.fromiter((predicate(value) for value in self.categories), dtype=bool,
+                           count=len(self.categories))
+        return hits[self.codes]
+
+    def equal(self, value):
+        """Returns the row mask of rows holding a value, following Mongo's $eq semantics"""
+        hits = np.zeros(len(self.categories), dtype=bool)
+        if value is None:
+            hits[0] = True
+        code = self.positions.get(_category_key(value))
+        if code is not None:
+            hits[code] = True
+        return hits[self.codes]
+
+
+def _regex_predicate(pattern, options=''):
+    """Returns a predicate testing string values against a regular expression as Mongo's $regex does"""
+
+    if not isinstance(pattern, re.Pattern):
+        flags = 0
+        for option in options:
+            if option not in 'imsx':
+                raise UnsupportedQuery('unsupported $regex option %s' % option)
+            flags |= getattr(re, option.upper())
+        pattern = re.compile(pattern, flags)
+
+    return lambda value: isinstance(value, str) and pattern.search(value) is not None
+
+
+class GenomicSnapshot(object):
+    """
+    Columnar, in memory copy of the genomic collection used by the match engine's snapshot mode.
+
+    The queryable fields are loaded once per run and leaf queries are evaluated as vectorized row masks. Mongo
+    is only used to hydrate the full documents of rows that end up in a match.
+    """
+
+    def __init__(self, db, sample_index, query=None):
+        """
+        :param db: database connection
+        :param sample_index: SampleIndex of the run, used to turn matched rows into sample sets
+        :param query: restricts the snapshot to the genomic documents matching this Mongo query
+        """
+        self.db = db
+        self.sample_index = sample_index
+
+        logging.info('Loading genomic snapshot')
+        proj = dict((field, 1) for field in SNAPSHOT_FIELDS)
+        proj['_id'] = 1
+
+        ids = []
+        values = dict((field, []) for field in SNAPSHOT_FIELDS)
+        for item in self.db.genomic.find(query or {}, proj):
+            ids.append(item['_id'])
+            for field in SNAPSHOT_FIELDS:
+                values[field].append(item.get(field, MISSING))
+
+        self.ids = ids
+        self.size = len(ids)
+        self.columns = {}
+        for field in SNAPSHOT_FIELDS:
+            try:
+                self.columns[field] = Column(values[field])
+            except UnsupportedQuery:
+                logging.info('Genomic snapshot skips %s, leaves on it are run against Mongo' % field)
+
+        # bit position of every row's sample, -1 for samples without a clinical document
+        positions = sample_index.positions
+        self.sample_ids = values['SAMPLE_ID']
+        self.sample_positions = np.fromiter((positions.get(sample_id, -1) for sample_id in self.sample_ids),
+                                            dtype=np.int64, count=self.size)
+
+        # full documents fetched from Mongo so far, by row and projection
+        self._documents = {}
+
+        logging.info('Genomic snapshot holds %d documents' % self.size)
+
+    def match(self, query):
+        """
+        Evaluates a Mongo query against the snapshot
+
+        :param query: Mongo query for genomic collection
+        :return: boolean numpy array, one entry per row
+        :raises UnsupportedQuery: if the query uses fields or operators the snapshot does not handle
+        """
+
+        mask = np.ones(self.size, dtype=bool)
+        for field, condition in query.items():
+            if field == '$and':
+                for clause in condition:
+                    mask &= self.match(clause)
+            elif field == '$or':
+                hits = np.zeros(self.size, dtype=bool)
+                for clause in condition:
+                    hits |= self.match(clause)
+                mask &= hits
+            elif field.startswith('$'):
+                raise UnsupportedQuery('unsupported operator %s' % field)
+            else:
+                mask &= self._match_field(field, condition)
+
+        return mask
+
+    def _match_field(self, field, condition):
+        """Returns the row mask of a single field condition"""
+
+        if field not in self.columns:
+            raise UnsupportedQuery('field %s is not part of the snapshot' % field)
+        column = self.columns[field]
+
+        if not isinstance(condition, dict) or not any(key.startswith('$') for key in condition):
+            return column.equal(condition)
+
+        mask = np.ones(self.size, dtype=bool)
+        for op, value in condition.items():
+            if op == '$eq':
+                mask &= column.equal(value)
+            elif op == '$ne':
+                mask &= ~column.equal(value)
+            elif op in ('$in', '$nin'):
+                hits = np.zeros(self.size, dtype=bool)
+                for item in value:
+                    if isinstance(item, re.Pattern):
+                        hits |= column.select(_regex_predicate(item))
+                    else:
+                        hits |= column.equal(item)
+                mask &= hits if op == '$in' else ~hits
+            elif op == '$regex':
+                mask &= column.select(_regex_predicate(value, condition.get('$options', '')))
+            elif op == '$options':
+                continue
+            elif op == '$exists':
+                present = column.codes != 0
+                mask &= present if value else ~present
+            else:
+                raise UnsupportedQuery('unsupported operator %s' % op)
+
+        return mask
+
+    def samples(self, mask):
+        """Returns the sample set of the samples owning the rows of a mask"""
+        positions = self.sample_positions[mask]
+        return self.sample_index.encode_positions(positions[positions >= 0])
+
+    def rows_by_sample(self, mask):
+        """Returns the matched rows grouped by SAMPLE_ID, in collection order"""
+        rows = {}
+        for row in np.flatnonzero(mask):
+            rows.setdefault(self.sample_ids[row], []).append(int(row))
+        return rows
+
+    def hydrate(self, rows, proj):
+        """
+        Fetches the full documents of rows that are not cached yet with one Mongo query per batch
+
+        :param rows: row numbers
+        :param proj: projection of the documents
+        """
+
+        key = tuple(sorted(proj))
+        missing = sorted(set(row for row in rows if (row, key) not in self._documents))
+        for i in range(0, len(missing), HYDRATE_BATCH_SIZE):
+            batch = missing[i:i + HYDRATE_BATCH_SIZE]
+            rows_by_id = dict((self.ids[row], row) for row in batch)
+            for item in self.db.genomic.find({'_id': {'$in': list(rows_by_id)}}, proj):
+                self._documents[(rows_by_id[item['_id']], key)] = item
+
+    def document(self, row, proj):
+        """Returns the full document of a row, fetching it from Mongo if it was not hydrated yet"""
+        key = tuple(sorted(proj))
+        if (row, key) not in self._documents:
+            self.hydrate([row], proj)
+        return self._documents.get((row, key))
+
+
+class SnapshotGenomicInfo(object):
+    """
+    Genomic information of a positive match tree leaf evaluated against the genomic snapshot. The matched
+    documents are only fetched from Mongo for samples that match the whole tree.
+    """
+
+    def __init__(self, snapshot, rows_by_sample, query, proj, format_info):
+        """
+        :param snapshot: GenomicSnapshot the rows belong to
+        :param rows_by_sample: matched rows by SAMPLE_ID
+        :param query: Mongo query of the leaf, used to format the genomic alteration
+        :param proj: projection of the genomic documents copied into the match
+        :param format_info: function building the genomic information of a document
+        """
+        self.snapshot = snapshot
+        self.rows_by_sample = rows_by_sample
+        self.query = query
+        self.proj = proj
+        self.format_info = format_info
+
+    def rows(self, sample_ids):
+        """Returns the matched rows of the given samples"""
+        return [row for sample_id in sample_ids for row in self.rows_by_sample.get(sample_id, [])]
+
+    def get(self, sample_id, default=None):
+        if sample_id not in self.rows_by_sample:
+            return default
+
+        genomic_infos = []
+        for row in self.rows_by_sample[sample_id]:
+            item = self.snapshot.document(row, self.proj)
+            if item is not None:
+                genomic_infos.append(self.format_info(item, self.query, self.proj))
+        return genomic_infos
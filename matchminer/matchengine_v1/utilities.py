@@ -8,9 +8,10 @@ import json
 import logging
 import pandas as pd
 import datetime as dt
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 
-import oncotreenx
+from matchminer.oncotree import get_oncotree
+from matchminer.structural_variants import SV_GENES_FIELD, sv_genes_query
 from matchminer.matchengine_v1.settings import months, TUMOR_TREE, mmr_map, mmr_map_rev
 
 
@@ -98,9 +99,26 @@ def build_cquery(c, norm_field, txt):
     return c
 
 
+def query_key(node_type, query, *flags):
+    """
+    Returns a hashable key for a prepared Mongo query so that identical match tree leaves can share results.
+    Regular expressions are keyed by pattern and flags, and dates by day, because age criteria are resolved
+    against the current time on every call.
+    """
+
+    def _default(value):
+        if isinstance(value, re.Pattern):
+            return {'$regex': value.pattern, '$options': value.flags}
+        if isinstance(value, dt.datetime):
+            return value.date().isoformat()
+        return str(value)
+
+    return node_type, json.dumps(query, sort_keys=True, default=_default), flags
+
+
 def build_oncotree():
-    """Builds oncotree"""
-    return oncotreenx.build_oncotree(file_path=TUMOR_TREE)
+    """Returns the shared oncotree index, rebuilt only when the tumor tree file changes"""
+    return get_oncotree(TUMOR_TREE)
 
 
 def normalize_fields(mapping, field):
@@ -307,6 +325,86 @@ def format_genomic_alteration(g, query):
     return alteration, is_variant
 
 
+def genomic_projection(neg, sv):
+    """Returns the projection of genomic documents whose fields are copied into trial matches"""
+
+    if neg:
+        return {'SAMPLE_ID': 1}  # speeds up query
+
+    proj = {
+        'SAMPLE_ID': 1,
+        'TRUE_HUGO_SYMBOL': 1,
+        'TRUE_PROTEIN_CHANGE': 1,
+        'TRUE_VARIANT_CLASSIFICATION': 1,
+        'VARIANT_CATEGORY': 1,
+        'CNV_CALL': 1,
+        'WILDTYPE': 1,
+        'CHROMOSOME': 1,
+        'POSITION': 1,
+        'TRUE_CDNA_CHANGE': 1,
+        'REFERENCE_ALLELE': 1,
+        'TRUE_TRANSCRIPT_EXON': 1,
+        'CANONICAL_STRAND': 1,
+        'ALLELE_FRACTION': 1,
+        'TIER': 1,
+        'CLINICAL_ID': 1,
+        'MMR_STATUS': 1,
+        'ACTIONABILITY': 1,
+        '_id': 1
+    }
+
+    # record pathologist's chromosomal rearrangement comment for downstream manual analysis
+    if sv:
+        proj['STRUCTURAL_VARIANT_COMMENT'] = 1
+
+    return proj
+
+
+def format_genomic_info(item, query, proj):
+    """Builds the genomic information of a genomic document that matched a positive clause of a match tree"""
+
+    # format the genomic alteration that matched
+    alteration, is_variant = format_genomic_alteration(item, query)
+
+    # add genomic information and alterations that matched per sample id
+    genomic_info = {
+        'match_type': is_variant,
+        'genomic_alteration': alteration
+    }
+
+    # copy genomic document projection into match
+    for field in proj:
+        if field in item:
+            if field == '_id':
+                genomic_info['genomic_id'] = item[field]
+            else:
+                genomic_info[field.lower()] = item[field]
+
+    return genomic_info
+
+
+class NegativeGenomicInfo(object):
+    """
+    Genomic information of a negative match tree leaf. Every sample held by the leaf's sample set gets the
+    same formatted alteration, so the per sample documents are only built on lookup.
+    """
+
+    def __init__(self, sample_set, template):
+        """
+        :param sample_set: samples matching the negative leaf
+        :param template: match type and genomic alteration shared by all those samples
+        """
+        self.sample_set = sample_set
+        self.template = template
+
+    def get(self, sample_id, default=None):
+        if sample_id not in self.sample_set:
+            return default
+        genomic_info = dict(self.template)
+        genomic_info['sample_id'] = sample_id
+        return [genomic_info]
+
+
 def format_not_match(g):
     """Format the genomic alteration for genomic documents that matched a negative clause of a match tree"""
 
@@ -373,24 +471,169 @@ def format_query(g, gene=False):
     return alteration
 
 
+def format_match_value(field, value):
+    """Converts a value of the match table into one that can be stored in Mongo"""
+
+    # ids and report dates are stored as strings
+    if field in ('clinical_id', 'genomic_id'):
+        return str(value)
+
+    if not isinstance(value, (list, dict)) and pd.isnull(value):
+        return None
+
+    if field == 'report_date' and isinstance(value, dt.datetime):
+        return dt.datetime.strftime(value, '%Y-%m-%d %X')
+
+    # numpy scalars
+    if hasattr(value, 'item'):
+        return value.item()
+
+    return value
+
+
+def match_records(trial_matches_df, batch_size=1000):
+    """
+    Yields the rows of the match table as Mongo documents, one batch at a time, so only a single batch is
+    converted at any point
+
+    :param trial_matches_df: match table
+    :param batch_size: number of documents per batch
+    """
+
+    columns = list(trial_matches_df.columns)
+    for i in range(0, trial_matches_df.shape[0], batch_size):
+        batch = trial_matches_df.iloc[i:i + batch_size]
+        yield [dict((field, format_match_value(field, value)) for field, value in zip(columns, row))
+               for row in batch.itertuples(index=False, name=None)]
+
+
+class MatchWriter(object):
+    """
+    Writes a complete match table into a staging collection and swaps it in place of the live one with a
+    single rename, so readers see either the old or the new table but never a partial one.
+    """
+
+    def __init__(self, db, collection='trial_match'):
+        """
+        :param db: database connection
+        :param collection: name of the live collection
+        """
+        self.db = db
+        self.collection = collection
+        self.staging = '%s_staging' % collection
+        self.count = 0
+
+        # leftovers of an interrupted run
+        self.db.drop_collection(self.staging)
+
+    def insert(self, records):
+        """Inserts a batch of match documents into the staging collection"""
+        if records:
+            self.db[self.staging].insert_many(records, ordered=False)
+            self.count += len(records)
+
+    def commit(self):
+        """
+        Replaces the live collection with the staging collection, carrying over the live collection's indexes.
+        Nothing is replaced when no documents were written.
+        """
+
+        if self.count == 0:
+            self.abort()
+            return
+
+        staging = self.db[self.staging]
+        for name, index in self.db[self.collection].index_information().items():
+            if name == '_id_':
+                continue
+            options = dict((k, v) for k, v in index.items() if k not in ('key', 'v', 'ns'))
+            staging.create_index(index['key'], name=name, **options)
+
+        staging.rename(self.collection, dropTarget=True)
+
+    def abort(self):
+        """Drops the staging collection and leaves the live collection untouched"""
+        self.db.drop_collection(self.staging)
+
+
 def add_matches(trial_matches_df, db):
-    """Add the match table to the database or update what already exists theres"""
+    """Replaces the trial_match collection with the match table. An empty table leaves the collection as is."""
+
+    writer = MatchWriter(db)
+    try:
+        for records in match_records(trial_matches_df):
+            writer.insert(records)
+    except Exception:
+        writer.abort()
+        raise
+    writer.commit()
+
+
+# fields identifying a trial match across runs
+MATCH_KEY = ['protocol_no', 'sample_id', 'match_level', 'internal_id', 'genomic_alteration', 'genomic_id']
+
+
+def update_matches(trial_matches_df, db, scopes, run_time):
+    """
+    Upserts the matches of an incremental run and disables the existing matches of the re-evaluated scopes
+    which were not found again.
+
+    :param trial_matches_df: match table of the incremental run
+    :param db: database connection
+    :param scopes: trial_match queries covering the trials and samples that were re-evaluated
+    :param run_time: start of the run, stamped on every upserted match
+    :return: SAMPLE_IDs whose matches changed
+    """
+
+    # samples which held a match in the re-evaluated scopes before the run
+    affected_samples = set()
+    for scope in scopes:
+        active = {'$and': [scope, {'is_disabled': {'$ne': True}}]}
+        affected_samples.update(db.trial_match.distinct('sample_id', active))
+
+    for records in match_records(trial_matches_df):
+        operations = []
+        for record in records:
+            record['is_disabled'] = False
+            record['_updated'] = run_time
+            key = dict((field, record.get(field)) for field in MATCH_KEY)
+            operations.append(UpdateOne(key, {'$set': record}, upsert=True))
+            affected_samples.add(record['sample_id'])
 
-    if 'clinical_id' in trial_matches_df.columns:
-        trial_matches_df['clinical_id'] = trial_matches_df['clinical_id'].apply(lambda x: str(x))
+        db.trial_match.bulk_write(operations, ordered=False)
 
-    if 'genomic_id' in trial_matches_df.columns:
-        trial_matches_df['genomic_id'] = trial_matches_df['genomic_id'].apply(lambda x: str(x))
+    # matches of the re-evaluated trials and samples that were not upserted by this run no longer hold
+    for scope in scopes:
+        db.trial_match.update_many(
+            {'$and': [scope, {'_updated': {'$ne': run_time}}, {'is_disabled': {'$ne': True}}]},
+            {'$set': {'is_disabled': True, '_updated': run_time}}
+        )
 
-    if 'report_date' in trial_matches_df.columns:
-        trial_matches_df['report_date'] = trial_matches_df['report_date'].apply(
-            lambda x: dt.datetime.strftime(x, '%Y-%m-%d %X') if pd.notnull(x) else x)
+    return affected_samples
 
-    if len(trial_matches_df.index) > 0:
-        db.trial_match.drop()
-        for i in range(0, trial_matches_df.shape[0], 1000):
-            records = list(json.loads(trial_matches_df[i:i + 1000].T.to_json()).values())
-            db.trial_match.insert_many(records)
+
+def update_sort_order(db, sample_ids, sort):
+    """
+    Recomputes the sort order of all active matches of the given samples
+
+    :param db: database connection
+    :param sample_ids: SAMPLE_IDs to sort again
+    :param sort: function adding the sort_order column to a match table
+    """
+
+    sample_ids = sorted(sample_ids)
+    for i in range(0, len(sample_ids), 1000):
+        matches = list(db.trial_match.find({
+            'sample_id': {'$in': sample_ids[i:i + 1000]},
+            'is_disabled': {'$ne': True}
+        }))
+        if not matches:
+            continue
+
+        trial_matches_df = sort(pd.DataFrame.from_dict(matches))
+        operations = [UpdateOne({'_id': row['_id']}, {'$set': {'sort_order': int(row['sort_order'])}})
+                      for _, row in trial_matches_df[['_id', 'sort_order']].iterrows()]
+        db.trial_match.bulk_write(operations, ordered=False)
 
 
 def get_db(uri):
@@ -429,7 +672,7 @@ def get_db(uri):
 
 def get_structural_variants(g):
     """
-    Performs a string search for the structural variant.
+    Looks the genes of a structural variant up in the gene tokens extracted from its comment.
 
     :param g: Genomic query in
     :return: Genomic query out
@@ -443,17 +686,9 @@ def get_structural_variants(g):
     if not isinstance(genes, list):
         genes = [genes]
 
-    # TODO add synonyms
-
-    # encode as full search criteria.
-    sv_clauses = []
-    for gene in genes:
-        abc = "(.*\W{0}\W.*)|(^{0}\W.*)|(.*\W{0}$)".format(gene)
-        sv_clauses.append(re.compile(abc, re.IGNORECASE))
-
-    # add it to filter and remove gene criteria.
+    # look the genes up in the indexed gene tokens of the comment, which include synonyms
     del g['TRUE_HUGO_SYMBOL']
-    g['STRUCTURAL_VARIANT_COMMENT'] = {"$in": sv_clauses}
+    g[SV_GENES_FIELD] = sv_genes_query(genes)
 
     return g
 
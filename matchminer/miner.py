@@ -1,51 +1,190 @@
+import json
+import uuid
 import logging
 import datetime
-import copy
+import itertools
+import multiprocessing
 
-import pandas as pd
+import numpy as np
+from pymongo import UpdateOne
 from dateutil.relativedelta import relativedelta
 
 from matchminer.templates.emails import emails
 from matchminer import settings, database
+from matchminer.profiler import RunProfile, get_query_counter, measure
 from matchengine.internals.engine import MatchEngine
+from matchminer.filter_dedup import group_filters, copy_matches, update_copied_matches, find_copied_matches, \
+    adopt_copied_matches
+from matchminer.locks import RunLock, FILTERS
+from matchminer.jobs import job_handler, submit_job, update_job, DONE, FAILED
 
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
 
+# options of every V2 engine matching filters
+FILTER_ENGINE_OPTIONS = {
+    'plugin_dir': './filters_config/plugins',
+    'match_on_closed': False,
+    'config': './filters_config/filters_config.json',
+    'match_document_creator_class': "DFCIFilterMatchDocumentCreator",
+    'report_all_clinical_reasons': True,
+    'trial_match_collection': "match",
+    'chunk_size': 5000
+}
 
-def rerun_filters(filters=None, do_update=True, datapush_id=None):
+
+def create_filter_engine(protocol_nos=None, **options):
+    """
+    Returns a new V2 MatchEngine matching the given filters, all of them if None
+
+    :param options: overrides of FILTER_ENGINE_OPTIONS, e.g. chunk_size
+    """
+    return MatchEngine(protocol_nos=protocol_nos, db_name=settings.MONGO_DBNAME,
+                       **dict(FILTER_ENGINE_OPTIONS, **options))
+
+
+def rerun_filters(filters=None, do_update=True, datapush_id=None, profile=False, report=None, workers=1,
+                  chunk_size=None):
     """
     Update all filters, or individual filters accepted as an array of ids
     :param filters: Array of filter IDs or None to run all filters
     :param do_update: When finding matches for temporary filters do not update db
     :param datapush_id: When all filters are rerun as part of the oncopanel datapush,
     flag new matches as 'new' and not 'pending', add datapush ID to matches
+    :param profile: Store the wall time, Mongo commands and result sizes of the run in the run_profile
+    collection. Commands are counted process-wide, so concurrent runs are counted together.
+    :param report: Path of a JSON report of the profiled run
+    :param workers: Number of processes to shard a run of all filters across. Each process matches its share of
+    the filters with its own engine, and the matches of all shards are tagged with one run id. Matches are
+    returned with their REPORT_DATE only.
+    :param chunk_size: Number of samples each engine queries at once, see FILTER_ENGINE_OPTIONS
     """
 
-    with MatchEngine(
-            plugin_dir='./filters_config/plugins',
-            protocol_nos=filters,
-            match_on_closed=False,
-            config='./filters_config/filters_config.json',
-            db_name=settings.MONGO_DBNAME,
-            match_document_creator_class="DFCIFilterMatchDocumentCreator",
-            report_all_clinical_reasons=True,
-            trial_match_collection="match",
-            chunk_size=5000
-    ) as me:
+    # filters with the same criteria are evaluated once, for the first filter of their group
+    groups = None
+    protocol_nos = filters
+    if settings.FILTER_DEDUPLICATION and (filters is None or len(filters) > 1):
+        query = {} if filters is None else {'_id': {'$in': list(filters)}}
+        groups = group_filters(database.get_db().filter.find(query))
+        protocol_nos = list(groups)
+        logging.info("Matching %d distinct criteria for %d filters" % (
+            len(groups), sum(len(group) for group in groups.values())))
+
+    run_profile = None
+    if profile:
+        counter = get_query_counter()
+        run_profile = RunProfile('v2', counter.counters)
+        command_seconds = dict(counter.seconds)
+
+    options = {} if chunk_size is None else {'chunk_size': chunk_size}
+
+    # full runs may be sharded across processes
+    if filters is None and workers > 1:
+        if protocol_nos is None:
+            protocol_nos = [item['_id'] for item in database.get_db().filter.find({}, {'_id': 1})]
+        matches, run_id = _match_filter_shards(protocol_nos, groups, do_update, run_profile, workers, options)
+    else:
+        with create_filter_engine(protocol_nos, **options) as me:
+            matches, run_id = _match_filters(me, protocol_nos, groups, do_update, run_profile)
+
+    # the work saved by deduplication is reported with the run
+    if groups is not None:
+        database.get_db().filter_run.update_one({'_id': run_id}, {'$set': {
+            'filters': sum(len(group) for group in groups.values()),
+            'distinct_criteria': len(groups),
+            '_updated': datetime.datetime.now()
+        }}, upsert=True)
+
+    update = {"data_push_id": datapush_id}
+
+    # set match status to "new" only when running filters as part of
+    # new data ingestion
+    if datapush_id:
+        update["MATCH_STATUS"] = 0
+
+    database.get_collection("match").update_many({"_me_id": run_id}, {"$set": update})
+
+    if run_profile is not None:
+        run_profile.run_id = run_id
+        for protocol_no, protocol_matches in matches.items():
+            run_profile.record('trial', str(protocol_no), results=len(protocol_matches))
+        for command, seconds in counter.seconds.items():
+            if seconds > command_seconds.get(command, 0.0):
+                run_profile.record('command', command, seconds=seconds - command_seconds.get(command, 0.0))
+        run_profile.save(database.get_db(), report)
+
+    return matches, run_id
+
+
+def _match_filters(me, protocol_nos, groups, do_update, run_profile):
+    """
+    Matches the filters of an engine, updates the match collection and copies the matches to the filters
+    sharing their criteria
+    :param protocol_nos: filters the engine evaluates, all of them if None
+    :return: matches by filter and sample, engine run id
+    """
+    with measure(run_profile, 'run', 'match filters'):
         me.get_matches_for_all_trials()
-        if do_update:
+    if do_update:
+        with measure(run_profile, 'run', 'update matches'):
+            db = database.get_db()
+            copies = find_copied_matches(db, protocol_nos)
             me.update_all_matches()
+            adopt_copied_matches(db, copies, me.run_id.hex)
+
+    matches = me.matches
+    if groups:
+        with measure(run_profile, 'run', 'copy matches', filters=len(groups)) as fields:
+            copied = copy_matches(matches, groups)
+            if do_update:
+                update_copied_matches(database.get_db(), groups, me.run_id.hex)
+            fields['copied_filters'] = len(copied)
+        matches = dict(matches)
+        matches.update(copied)
+
+    return matches, me.run_id.hex
+
+
+def _match_filter_shards(protocol_nos, groups, do_update, run_profile, workers, options):
+    """
+    Matches the filters in worker processes, each matching every n-th filter by id, and merges the engine
+    runs of all shards into one run
+    :return: matches by filter and sample with their REPORT_DATE only, run id
+    """
+    protocol_nos = sorted(protocol_nos)
+    shards = [protocol_nos[i::workers] for i in range(min(workers, len(protocol_nos)))]
+    args = [(shard, groups and dict((filter_id, groups[filter_id]) for filter_id in shard), do_update,
+             run_profile is not None, options) for shard in shards]
+
+    logging.info("Matching %d filters in %d processes" % (len(protocol_nos), len(shards)))
+    matches = {}
+    shard_run_ids = []
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(max(len(shards), 1)) as pool:
+        for shard_matches, shard_run_id, profile in pool.starmap(_match_filter_shard, args):
+            matches.update(shard_matches)
+            shard_run_ids.append(shard_run_id)
+            if run_profile is not None:
+                run_profile.extend(profile)
+
+    # one run id for the whole run, e.g. for email_matches and data push tagging
+    run_id = uuid.uuid4().hex
+    db = database.get_db()
+    db.filter_run.insert_one({'_id': run_id, 'shard_run_ids': shard_run_ids, '_created': datetime.datetime.now()})
+    db.match.update_many({'_me_id': {'$in': shard_run_ids}}, {'$set': {'_me_id': run_id}})
+    return matches, run_id
 
-        run_id = me.run_id.hex
-        update = {"data_push_id": datapush_id}
 
-        # set match status to "new" only when running filters as part of
-        # new data ingestion
-        if datapush_id:
-            update["MATCH_STATUS"] = 0
+def _match_filter_shard(protocol_nos, groups, do_update, profile, options):
+    """Matches a shard of the filters in a worker process, see _match_filter_shards"""
+    run_profile = RunProfile('v2', get_query_counter().counters) if profile else None
+    with create_filter_engine(protocol_nos, **options) as me:
+        matches, run_id = _match_filters(me, protocol_nos, groups, do_update, run_profile)
 
-        database.get_collection("match").update_many({"_me_id": run_id}, {"$set": update})
-    return me.matches, run_id
+    # only what the filter counts of the run need is sent back
+    matches = dict((filter_id, dict((sample_id, [{'REPORT_DATE': match.get('REPORT_DATE')} for match in sample_matches])
+                                    for sample_id, sample_matches in filter_matches.items()))
+                   for filter_id, filter_matches in matches.items())
+    return matches, run_id, run_profile.entries if run_profile is not None else []
 
 
 def _email_text(user, cur_stamp, new_filter_match_counts):
@@ -91,32 +230,30 @@ def email_matches(run_id=None):
     if run_id is None:
         run_id = list(db.run_log_match.find({}, {'run_id': 1}).sort('_id', -1).limit(1))[0]['run_id']
 
+        # sharded runs are logged per shard
+        filter_run = db.filter_run.find_one({'shard_run_ids': run_id})
+        if filter_run is not None:
+            run_id = filter_run['_id']
+
     if isinstance(run_id, str):
         run_id = [run_id]
 
     logging.info(f"Filter engine run_id: {' ,'.join(run_id)}")
-    team_query = {
-        "_me_id": {"$in": run_id},
-        "is_disabled": False,
-        "FILTER_STATUS": 1,
-    }
-    teams = list(db.match.find(team_query, {"TEAM_ID": 1}).distinct("TEAM_ID"))
-    for team_id in teams:
-        filters_new_matches_query = {"TEAM_ID": team_id, "is_disabled": False, "FILTER_STATUS": 1}
-        filters_with_new_matches = list(db.match.find(filters_new_matches_query, {"FILTER_ID": 1}).distinct("FILTER_ID"))
-        new_filters_match_counts = _get_new_filters_match_counts(team_id, filters_with_new_matches, run_id[0])
-
-        team_members = list(db.user.find({'teams': {'$elemMatch': {'$in': [team_id]}}}))
-        for user in team_members:
-            if 'silent' in user and user['silent']:
+    new_match_counts = _get_new_match_counts_by_team(db, run_id)
+
+    # users are emailed once for every team of theirs with new matches
+    email_items = []
+    cur_date = datetime.date.today().strftime("%B %d, %Y")
+    cur_stamp = datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y")
+    users = list(db.user.find({'teams': {'$in': list(new_match_counts)}, 'silent': {'$ne': True}}))
+    for team_id, new_filters_match_counts in new_match_counts.items():
+        for user in users:
+            if team_id not in user['teams']:
                 continue
 
-            cur_date = datetime.date.today().strftime("%B %d, %Y")
-            cur_stamp = datetime.datetime.now().strftime("%I:%M%p on %B %d, %Y")
             html = _email_text(user, cur_stamp, new_filters_match_counts)
             logging.info(f"Generated email for {user['email']}")
-
-            email_item = {
+            email_items.append({
                 'email_from': settings.EMAIL_AUTHOR_PROTECTED,
                 'email_to': user['email'],
                 'subject': 'New Patient Matches - %s' % cur_date,
@@ -127,41 +264,77 @@ def email_matches(run_id=None):
                 'errors': [],
                 '_created': datetime.datetime.now(),
                 '_me_id': run_id
-            }
-            db.email.insert(email_item)
+            })
+
+    if email_items:
+        db.email.insert_many(email_items)
     logging.info("DONE")
 
 
-def _get_new_filters_match_counts(team_id, filters_with_new_matches, run_id):
+def _get_new_match_counts_by_team(db, run_ids):
     """
-    Aggregate new filter match counts by team
+    Aggregate the new match counts of active filters by team and filter in a single pipeline
 
-    :param team_id: Team with associated filters
-    :param filters_with_new_matches: List of filter IDs associated with single team
-    :return:
+    :param db: database connection
+    :param run_ids: List of filter engine run ids
+    :return: filter counts, labels and protocols keyed by filter id, keyed by team id
     """
-    db = database.get_db()
-    new_filter_match_counts = {}
-    for filter_id in filters_with_new_matches:
-        matches_query = {
-            "TEAM_ID": team_id,
-            "FILTER_ID": filter_id,
-            "is_disabled": False,
-            "_me_id": run_id
+    pipeline = [
+        {'$match': {'_me_id': {'$in': run_ids}, 'is_disabled': False, 'FILTER_STATUS': 1}},
+        {'$group': {'_id': {'TEAM_ID': '$TEAM_ID', 'FILTER_ID': '$FILTER_ID'}, 'num_matches': {'$sum': 1}}},
+        {'$lookup': {'from': 'filter', 'localField': '_id.FILTER_ID', 'foreignField': '_id', 'as': 'filter'}},
+        {'$unwind': '$filter'},
+        {'$sort': {'_id.TEAM_ID': 1, '_id.FILTER_ID': 1}},
+        {'$project': {'num_matches': 1, 'filter.description': 1, 'filter.label': 1, 'filter.protocol_id': 1}}
+    ]
+
+    new_match_counts = {}
+    for item in db.match.aggregate(pipeline, allowDiskUse=True):
+        filter_ = item['filter']
+        new_match_counts.setdefault(item['_id']['TEAM_ID'], {})[item['_id']['FILTER_ID']] = {
+            "num_matches": item['num_matches'],
+            "description": filter_.get('description'),
+            "label": filter_.get('label'),
+            "protocol_id": filter_.get('protocol_id')
         }
-        num_matches = len(list(db.match.find(matches_query, {"_id": 1})))
+    return new_match_counts
 
-        if num_matches < 1:
-            continue
-        else:
-            filter_ = list(db.filter.find({'_id': filter_id}))[0]
-            new_filter_match_counts[filter_id] = {
-                "num_matches": num_matches,
-                "description": filter_['description'],
-                "label": filter_['label'],
-                "protocol_id": filter_['protocol_id']
-            }
-    return new_filter_match_counts
+
+def _expand_genomic_or_clauses(genomic_and, genomic_filter, multis):
+    """
+    Generate one genomic OR clause for every combination of the values of the multi value criteria.
+
+    Clauses are shallow copies of the AND criteria, invalid combinations are pruned before they are generated,
+    CNV_CALL is left out of MUTATION and SV clauses, and duplicate clauses are dropped by their canonical JSON.
+    :param genomic_and: single value criteria shared by all clauses
+    :param genomic_filter: genomic criteria of the filter
+    :param multis: criteria with multiple values
+    :return: list of OR clauses
+    """
+    # CNV calls only apply to CNV clauses, so they are combined last
+    outer = [k for k in multis if k != 'CNV_CALL']
+    cnv_calls = genomic_filter['CNV_CALL'] if 'CNV_CALL' in multis else [None]
+
+    seen = set()
+    or_clauses = []
+    for values in itertools.product(*[genomic_filter[k] for k in outer]):
+        combination = dict(zip(outer, values))
+        variant_category = combination.get('VARIANT_CATEGORY', genomic_and.get('VARIANT_CATEGORY'))
+        no_cnv_call = variant_category == 'MUTATION' or variant_category == 'SV'
+
+        for cnv_call in cnv_calls[:1] if no_cnv_call else cnv_calls:
+            or_node = dict(genomic_and)
+            for k in multis:
+                or_node[k] = cnv_call if k == 'CNV_CALL' else combination[k]
+            if no_cnv_call:
+                or_node.pop('CNV_CALL', None)
+
+            key = json.dumps(or_node, sort_keys=True, default=str)
+            if key not in seen:
+                seen.add(key)
+                or_clauses.append({"genomic": or_node})
+
+    return or_clauses
 
 
 def transform_filter_to_CTML(items, save=False):
@@ -233,43 +406,9 @@ def transform_filter_to_CTML(items, save=False):
                     genomic_and[k] = v
 
             # If a user has selected multiple criteria, generate all possible
-            # OR CTML nodes. Filter out error clauses later.
-            # A user may select multiple genes, variant categories, or multiples
-            # of both categories.
-            if len(multis) == 1:
-                for val in genomic_filter[multis[0]]:
-                    or_clause = copy.deepcopy(genomic_and)
-                    or_clause[multis[0]] = val
-                    or_clauses.append({"genomic": or_clause})
-            elif len(multis) == 2:
-                for val in genomic_filter[multis[0]]:
-                    for i_val in genomic_filter[multis[1]]:
-                        or_clause = copy.deepcopy(genomic_and)
-                        or_clause[multis[0]] = val
-                        or_clause[multis[1]] = i_val
-                        or_clauses.append({"genomic": or_clause})
-            elif len(multis) == 3:
-                for val in genomic_filter[multis[0]]:
-                    for i_val in genomic_filter[multis[1]]:
-                        for i_i_val in genomic_filter[multis[2]]:
-                            or_clause = copy.deepcopy(genomic_and)
-                            or_clause[multis[0]] = val
-                            or_clause[multis[1]] = i_val
-                            or_clause[multis[2]] = i_i_val
-                            or_clauses.append({"genomic": or_clause})
-
-        # remove CNV_CALL's when VARIANT_CATEGORY is MUTATION or SV
-        for or_clause in or_clauses:
-            or_node = or_clause['genomic']
-            if 'VARIANT_CATEGORY' in or_node and 'CNV_CALL' in or_node and \
-                    (or_node['VARIANT_CATEGORY'] == 'MUTATION' or or_node['VARIANT_CATEGORY'] == 'SV'):
-                del or_node['CNV_CALL']
-
-        # remove duplicate nodes
-        cleaned_or_clauses = []
-        for i in range(len(or_clauses)):
-            if or_clauses[i] not in or_clauses[i + 1:]:
-                cleaned_or_clauses.append(or_clauses[i])
+            # OR CTML nodes, e.g. for multiple genes, variant categories or both.
+            if multis:
+                or_clauses = _expand_genomic_or_clauses(genomic_and, genomic_filter, multis)
 
         clinical_and = {}
         if 'clinical_filter' in item:
@@ -291,16 +430,13 @@ def transform_filter_to_CTML(items, save=False):
         and_clause = {"and": []}
         and_clause['and'].append({"clinical": clinical_and})
 
-        if genomic_and:
+        # If new OR clauses have been generated, leave out the
+        # AND clause as it is already included on all OR clauses
+        if or_clauses:
+            and_clause["and"].append({"or": or_clauses})
+        elif genomic_and:
             and_clause['and'].append({"genomic": genomic_and})
 
-        if cleaned_or_clauses:
-            and_clause["and"].append({"or": cleaned_or_clauses})
-
-            # If new OR clauses have been generated, remove
-            # extra AND clause as it is already included on all OR clauses
-            del and_clause['and'][1]
-
         item['match'] = [and_clause]
         item['description'] = get_filter_description(item)
 
@@ -451,17 +587,59 @@ def get_filter_description(item):
 
 
 def find_filter_matches(items):
+    """
+    Queues the matching of saved filters so the request returns right away. Each filter is returned with
+    the id of its job, /api/jobs/<id> reports the job's progress and, once done, the number of matched
+    samples and the enrollment histogram.
+    :param items: List of filters
+    :return:
+    """
     db = database.get_db()
     for item in items:
-        do_update = False if item['temporary'] else True
-        num_matches, run_id = rerun_filters(filters=[item['_id']], do_update=do_update, datapush_id=None)
-        enrollments = get_enrollment(num_matches[item['_id']])
-        item['num_samples'] = len(num_matches[item['_id']])
-        item['enrollment'] = enrollments
+        job_id = submit_job(db, 'filter_match', {'filter_id': item['_id']}, team_id=item.get('TEAM_ID'))
+        item['job_id'] = str(job_id)
+
+        # jobs run synchronously when JOBS_ASYNC is off, their results or errors are returned with the filter
+        job = db.jobs.find_one({'_id': job_id})
+        if job['status'] == DONE:
+            item['num_samples'] = job['result']['num_samples']
+            item['enrollment'] = job['result']['enrollment']
+        elif job['status'] == FAILED:
+            raise RuntimeError("Matching filter %s failed: %s" % (item['_id'], job['error']))
 
-        # don't persist temporary filters
-        if item['status'] == 2 and item['temporary'] == True:
-            db.filter.remove({"_id": item['_id']})
+
+@job_handler('filter_match')
+def match_filter(db, job):
+    """
+    Finds the matches of a saved filter and stores its sample count and enrollment
+    :param db: database connection
+    :param job: filter_match job
+    :return: job result
+    """
+    filter_id = job['payload']['filter_id']
+    item = db.filter.find_one({'_id': filter_id})
+    if item is None:
+        raise ValueError("filter %s no longer exists" % filter_id)
+
+    update_job(db, job, 'matching', 0.1)
+    do_update = False if item['temporary'] else True
+    num_matches, run_id = rerun_filters(filters=[item['_id']], do_update=do_update, datapush_id=None)
+
+    update_job(db, job, 'counting', 0.9)
+    counts = store_filter_counts(db, [filter_id], num_matches, run_id)[filter_id]
+    result = {
+        'filter_id': filter_id,
+        'run_id': run_id,
+        'num_samples': counts['num_samples'],
+        'num_matches': sum(len(sample_matches) for sample_matches in num_matches.get(filter_id, {}).values()),
+        'enrollment': counts['enrollment']
+    }
+
+    # don't persist temporary filters
+    if item['status'] == 2 and item['temporary'] == True:
+        db.filter.remove({"_id": item['_id']})
+
+    return result
 
 
 def get_enrollment(matches):
@@ -470,57 +648,96 @@ def get_enrollment(matches):
     :param matches:
     :return:
     """
-    # Generate date list from first of the month
-    today = datetime.date.today() + datetime.timedelta(1 * 365 / 12)
-    all_dates = pd.date_range(datetime.datetime(2013, 7, 1), today, freq='BM')
-    all_dates = all_dates.map(lambda x: datetime.datetime(x.year, x.month, 1))
-    all_dates = pd.Series(all_dates)
+    # Generate month list, every month from July 2013 whose last business day is before a month from now
+    today = np.datetime64(datetime.date.today() + datetime.timedelta(1 * 365 / 12), 'D')
+    last_month = today.astype('datetime64[M]')
+    last_business_day = np.busday_offset((last_month + 1).astype('datetime64[D]') - 1, 0, roll='backward')
+    if last_business_day > today:
+        last_month -= 1
+    base_months = np.arange(np.datetime64('2013-07'), last_month + 1, dtype='datetime64[M]')
+
+    # Get report dates bucketed by month
+    report_months = np.array([match['REPORT_DATE']
+                              for sample_id in matches
+                              for match in matches[sample_id]
+                              if match.get('REPORT_DATE') is not None], dtype='datetime64[M]')
+
+    # count the reports of every month, months without reports included
+    months = np.union1d(base_months, report_months)
+    counts = np.bincount(np.searchsorted(months, report_months), minlength=len(months))
 
-    # Get report dates with days reset to first of the month
-    report_dates = []
-    for sample_id in matches:
-        for match in matches[sample_id]:
-            if 'REPORT_DATE' in match and match['REPORT_DATE'] is not None:
-                tmp_date = pd.Series(datetime.datetime(match['REPORT_DATE'].year, match['REPORT_DATE'].month, 1))
-                all_dates = all_dates.append(tmp_date)
-
-    # combine them and remove base counts.
-    total_dates = all_dates.append(report_dates)
-    counts = total_dates.value_counts()
-    counts = counts - 1
-    counts = counts.sort_index()
+    return {
+        "x_axis": [month.strftime("%y-%m-%d") for month in months.astype(datetime.date)],
+        "y_axis": [int(count) for count in counts]
+    }
 
-    # convert to lists.
-    x_axis = list(counts.index)
-    y_axis = list(counts)
 
-    x_axis = [d.strftime("%y-%m-%d") for d in x_axis]
+def store_filter_counts(db, filter_ids, matches, run_id):
+    """
+    Stores the number of matched samples and the enrollment histogram of every filter of a run on the
+    filter, so they are computed once per run rather than whenever filters are listed.
+    :param db: database connection
+    :param filter_ids: filters of the run
+    :param matches: matches of the run by filter and sample
+    :param run_id: id of the run
+    :return: counts by filter id
+    """
+    counts = {}
+    requests = []
+    for filter_id in filter_ids:
+        filter_matches = matches.get(filter_id, {})
+        counts[filter_id] = {
+            'num_samples': len(filter_matches),
+            'enrollment': get_enrollment(filter_matches),
+            'enrollment_run_id': run_id
+        }
+        requests.append(UpdateOne({'_id': filter_id}, {'$set': counts[filter_id]}))
 
-    return {
-        "x_axis": x_axis,
-        "y_axis": y_axis
-    }
+    if requests:
+        db.filter.bulk_write(requests, ordered=False)
+    return counts
 
 
-def start_filter_run(silent=False, datapush_id=None):
+def start_filter_run(silent=False, datapush_id=None, workers=None, chunk_size=None, lock=None, profile=False,
+                     report=None):
     """
     Wrapper function which calls rerun filters.
-    Creates a record in active_process collection to make sure multiple filter
+    Holds the filters run lock to make sure multiple filter
     matching runs are not created simultaneously.
 
     :param silent: Whether to send emails or not
     :param datapush_id: ID to append to output matches if relevant
-    :return:
+    :param workers: Number of processes matching the filters, FILTER_RUN_WORKERS by default
+    :param chunk_size: Number of samples each engine queries at once
+    :param lock: RunLock already acquired by the caller, released when the run ends
+    :param profile: Profile the run, see rerun_filters
+    :param report: Path of a JSON report of the profiled run
+    :return: run id or None if filters are already running
     """
     db = database.get_db()
-    db.active_processes.insert({"filters_running": True})
-    filters = list(db.filter.find({"temporary": False, "status": {"$in": [0, 1]}}))
-    transform_filter_to_CTML(filters, save=True)
-    _, run_id = rerun_filters(datapush_id=datapush_id)
-    db.active_processes.drop()
-
-    if not silent:
-        email_matches(run_id)
+    if lock is None:
+        lock = RunLock(db, FILTERS)
+        if not lock.acquire():
+            logging.info("Filters already running")
+            return None
+
+    try:
+        lock.update('transforming filters', 0.0)
+        filters = list(db.filter.find({"temporary": False, "status": {"$in": [0, 1]}}))
+        transform_filter_to_CTML(filters, save=True)
+
+        lock.update('matching filters', 0.1, filters=len(filters))
+        matches, run_id = rerun_filters(datapush_id=datapush_id, workers=workers or settings.FILTER_RUN_WORKERS,
+                                        chunk_size=chunk_size, profile=profile, report=report)
+
+        lock.update('counting matches', 0.8, run_id=run_id)
+        store_filter_counts(db, [item['_id'] for item in filters], matches, run_id)
+
+        if not silent:
+            lock.update('emailing matches', 0.9)
+            email_matches(run_id)
+    finally:
+        lock.release()
 
     return run_id
 
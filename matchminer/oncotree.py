@@ -0,0 +1,219 @@
+import os
+import logging
+import threading
+from array import array
+
+import oncotreenx
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# top level oncotree nodes whose subtrees make up the liquid tumors
+LIQUID_ROOTS = ['Lymph', 'Blood']
+
+_oncotrees = {}
+_oncotrees_lock = threading.Lock()
+
+
+class OncoTree(object):
+    """
+    Read-only, precomputed index over an oncotree file.
+
+    Built once per source file and shared by the match engine, trial search and API. Nodes are laid
+    out in DFS preorder and every node stores the [enter, exit] positions of its subtree, so
+    "is X under Y" is an integer comparison and the subtree of a node is a contiguous slice of the
+    preorder code and text arrays.
+    """
+
+    __slots__ = ('file_path', 'mtime', 'root', '_codes', '_texts', '_enter', '_exit', '_parent',
+                 '_codes_by_text', '_children', '_liquid', '_solid', '_primary_tumors')
+
+    def __init__(self, graph, primary_tumors=(), file_path=None, mtime=None, root='root'):
+        """
+        :param graph: oncotree DiGraph as built by oncotreenx
+        :param primary_tumors: primary tumor names (without oncotree codes)
+        :param file_path: source file of the oncotree
+        :param mtime: modification time of the source file when it was read
+        :param root: root node of the oncotree
+        """
+        self.file_path = file_path
+        self.mtime = mtime
+        self.root = root
+
+        # first node wins, as with oncotreenx.lookup_text
+        self._codes_by_text = {}
+        for code in graph.nodes():
+            self._codes_by_text.setdefault(graph.nodes[code]['text'], code)
+
+        self._children = {code: tuple(graph.successors(code)) for code in graph.nodes()}
+
+        # euler tour: a node is entered before its children and exited after its last descendant
+        starts = [root] if graph.has_node(root) else []
+        starts += [code for code in graph.nodes() if code != root and graph.in_degree(code) == 0]
+
+        codes = []
+        enter = {}
+        exits = []
+        parent = []
+        for start in starts:
+            stack = [(start, -1, False)]
+            while stack:
+                code, parent_idx, done = stack.pop()
+                if done:
+                    exits[enter[code]] = len(codes) - 1
+                    continue
+                enter[code] = len(codes)
+                codes.append(code)
+                exits.append(-1)
+                parent.append(parent_idx)
+                stack.append((code, parent_idx, True))
+                for child in reversed(self._children[code]):
+                    stack.append((child, enter[code], False))
+
+        self._codes = tuple(codes)
+        self._texts = tuple(graph.nodes[code]['text'] for code in codes)
+        self._enter = enter
+        self._exit = array('l', exits)
+        self._parent = array('l', parent)
+
+        liquid = set()
+        for txt in LIQUID_ROOTS:
+            code = self.lookup_text(txt)
+            if code is not None:
+                liquid.update(self.descendants(code))
+        self._liquid = frozenset(liquid)
+        self._solid = frozenset(self._codes) - self._liquid
+        self._primary_tumors = tuple(primary_tumors)
+
+    def __contains__(self, code):
+        return code in self._enter
+
+    def __len__(self):
+        return len(self._codes)
+
+    @property
+    def codes(self):
+        """All oncotree codes in DFS preorder"""
+        return self._codes
+
+    @property
+    def liquid(self):
+        """Codes of all liquid tumor types"""
+        return self._liquid
+
+    @property
+    def solid(self):
+        """Codes of all tumor types which are not liquid"""
+        return self._solid
+
+    @property
+    def primary_tumors(self):
+        """Primary tumor names without their oncotree codes"""
+        return self._primary_tumors
+
+    def interval(self, code):
+        """Returns the [enter, exit] preorder positions spanned by the subtree of an oncotree code"""
+        idx = self._enter[code]
+        return idx, self._exit[idx]
+
+    def text(self, code):
+        """Returns the display text of an oncotree code"""
+        return self._texts[self._enter[code]]
+
+    def texts(self, codes):
+        """Returns the display text of each oncotree code"""
+        return [self._texts[self._enter[code]] for code in codes]
+
+    def lookup_text(self, txt):
+        """Returns the oncotree code for a display text, or None when the text is unknown"""
+        return self._codes_by_text.get(txt)
+
+    def children(self, code):
+        """Returns the direct children of an oncotree code"""
+        return self._children[code]
+
+    def is_descendant(self, code, ancestor):
+        """Returns True when code lies in the subtree of ancestor, ancestor itself included"""
+        idx = self._enter[code]
+        start = self._enter[ancestor]
+        return start <= idx <= self._exit[start]
+
+    def descendants(self, code):
+        """
+        Returns the subtree rooted at an oncotree code in preorder, the code itself first.
+        As with nx.dfs_tree, a missing code expands to the whole tree.
+        """
+        if code is None:
+            return self._codes
+        start, end = self.interval(code)
+        return self._codes[start:end + 1]
+
+    def descendant_texts(self, code):
+        """Returns the display text of every node in the subtree of an oncotree code, in preorder"""
+        if code is None:
+            return list(self._texts)
+        start, end = self.interval(code)
+        return list(self._texts[start:end + 1])
+
+    def ancestors(self, code):
+        """Returns the ancestors of an oncotree code ordered from its parent up to the root"""
+        ancestors = []
+        idx = self._parent[self._enter[code]]
+        while idx != -1:
+            ancestors.append(self._codes[idx])
+            idx = self._parent[idx]
+        return tuple(ancestors)
+
+
+def _read_primary_tumors(file_path):
+    """Returns the unique primary tumor names listed in an oncotree file"""
+
+    primary_tumors = []
+    with open(file_path) as fin:
+        header = fin.readline().rstrip('\n').split('\t')
+        idx = header.index('primary') if 'primary' in header else 0
+        for line in fin:
+            cols = line.rstrip('\n').split('\t')
+            if len(cols) <= idx or not cols[idx]:
+                continue
+            primary = cols[idx].split('(')[0].strip()
+            if primary not in primary_tumors:
+                primary_tumors.append(primary)
+
+    return primary_tumors
+
+
+def build_oncotree_index(file_path):
+    """
+    Parses an oncotree file and compiles it into an OncoTree index
+
+    :param file_path: path of the tab separated oncotree file
+    :return: OncoTree
+    """
+    mtime = os.path.getmtime(file_path)
+    graph = oncotreenx.build_oncotree(file_path=file_path)
+    return OncoTree(graph, _read_primary_tumors(file_path), file_path=file_path, mtime=mtime)
+
+
+def get_oncotree(file_path):
+    """
+    Returns the process-wide OncoTree index for an oncotree file.
+    The file is only parsed again when its modification time changes.
+
+    :param file_path: path of the tab separated oncotree file
+    :return: OncoTree
+    """
+    file_path = os.path.abspath(file_path)
+    mtime = os.path.getmtime(file_path)
+
+    onco_tree = _oncotrees.get(file_path)
+    if onco_tree is not None and onco_tree.mtime == mtime:
+        return onco_tree
+
+    with _oncotrees_lock:
+        onco_tree = _oncotrees.get(file_path)
+        if onco_tree is None or onco_tree.mtime != mtime:
+            logging.info("building oncotree index from %s" % file_path)
+            onco_tree = build_oncotree_index(file_path)
+            _oncotrees[file_path] = onco_tree
+
+    return onco_tree
@@ -0,0 +1,207 @@
+import json
+import time
+import uuid
+import logging
+import datetime
+import threading
+from contextlib import contextmanager, nullcontext
+
+from pymongo import monitoring
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# commands which read documents, with the reply field holding them
+READ_COMMANDS = {
+    'find': 'cursor',
+    'aggregate': 'cursor',
+    'getMore': 'cursor',
+    'distinct': 'values',
+    'count': 'n'
+}
+
+
+class RunProfile(object):
+    """
+    Wall time and Mongo usage of one matching run, recorded per trial, match level and criterion.
+
+    Every measurement is kept as a flat entry with its level ('run', 'trial', 'match_level', 'leaf', ...),
+    a name and the counts of the Mongo queries issued and documents examined while it ran.
+    """
+
+    def __init__(self, engine, counters):
+        """
+        :param engine: name of the profiled engine, v1 or v2
+        :param counters: function returning the current (queries, documents examined) totals of the run
+        """
+        self.engine = engine
+        self.counters = counters
+        self.run_id = uuid.uuid4().hex
+        self.started = datetime.datetime.now()
+        self.entries = []
+
+    @contextmanager
+    def measure(self, level, name, **fields):
+        """
+        Records the wall time and Mongo usage of the enclosed block. Values added to the yielded entry
+        are stored with it.
+
+        :param level: granularity of the measurement
+        :param name: what is measured, e.g. a protocol number or a criterion
+        """
+
+        entry = dict(fields, level=level, name=name)
+        queries, docs_examined = self.counters()
+        start = time.time()
+        try:
+            yield entry
+        finally:
+            end_queries, end_docs_examined = self.counters()
+            entry['seconds'] = time.time() - start
+            entry['queries'] = end_queries - queries
+            entry['docs_examined'] = end_docs_examined - docs_examined
+            self.entries.append(entry)
+
+    def record(self, level, name, **fields):
+        """Adds an entry for something that was not measured as a block, e.g. the result size of a trial"""
+        self.entries.append(dict(fields, level=level, name=name))
+
+    def extend(self, entries):
+        """Adds entries recorded by another process"""
+        self.entries.extend(entries)
+
+    def top(self, n=10, level='leaf'):
+        """Returns the n entries of a level which took the longest, with repeated names summed up"""
+        return _summarize(self.entries, n, level)
+
+    def save(self, db, report_path=None):
+        """
+        Stores the entries in the run_profile collection, one document per entry, and optionally writes
+        them to a JSON report.
+
+        :param db: database connection
+        :param report_path: path of the JSON report
+        """
+
+        documents = [dict(entry, run_id=self.run_id, engine=self.engine, started=self.started)
+                     for entry in self.entries]
+        for i in range(0, len(documents), 1000):
+            db.run_profile.insert_many(documents[i:i + 1000])
+
+        if report_path:
+            with open(report_path, 'w') as fout:
+                json.dump({
+                    'run_id': self.run_id,
+                    'engine': self.engine,
+                    'started': self.started,
+                    'top_criteria': self.top(),
+                    'entries': self.entries
+                }, fout, indent=2, default=str)
+
+        logging.info('Saved %d profile entries of run %s' % (len(documents), self.run_id))
+
+
+def measure(profile, level, name, **fields):
+    """Measures the enclosed block with a RunProfile, or does nothing when the run is not profiled"""
+    if profile is None:
+        return nullcontext({})
+    return profile.measure(level, name, **fields)
+
+
+def _summarize(entries, n, level):
+    totals = {}
+    for entry in entries:
+        if entry['level'] != level:
+            continue
+        total = totals.setdefault(entry['name'], {
+            'name': entry['name'], 'count': 0, 'seconds': 0.0, 'queries': 0, 'docs_examined': 0, 'results': 0})
+        total['count'] += 1
+        for field in ('seconds', 'queries', 'docs_examined', 'results'):
+            total[field] += entry.get(field) or 0
+
+    return sorted(totals.values(), key=lambda total: total['seconds'], reverse=True)[:n]
+
+
+def top_criteria(db, n=10, run_id=None, level='leaf'):
+    """
+    Returns the most expensive criteria of a profiled run
+
+    :param db: database connection
+    :param n: number of criteria
+    :param run_id: profiled run, defaults to the latest one
+    :param level: granularity to rank, e.g. leaf, match_level or trial
+    :return: run id and the summed up entries, most expensive first
+    """
+
+    if run_id is None:
+        latest = list(db.run_profile.find({}, {'run_id': 1}).sort('started', -1).limit(1))
+        if not latest:
+            return None, []
+        run_id = latest[0]['run_id']
+
+    return run_id, _summarize(db.run_profile.find({'run_id': run_id, 'level': level}), n, level)
+
+
+class QueryCounter(monitoring.CommandListener):
+    """
+    Counts the Mongo commands issued by clients created after it was registered, along with the documents
+    they returned. The server does not report documents examined to clients, so returned documents are the
+    closest measure available.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.docs_returned = 0
+        self.seconds = {}
+        self._commands = {}
+
+    def counters(self):
+        return self.queries, self.docs_returned
+
+    def started(self, event):
+        if event.command_name not in READ_COMMANDS:
+            return
+
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+
+        with self.lock:
+            self.queries += 1
+            self._commands[event.request_id] = (event.command_name, collection)
+
+    def succeeded(self, event):
+        with self.lock:
+            command = self._commands.pop(event.request_id, None)
+            if command is None:
+                return
+
+            field = READ_COMMANDS[command[0]]
+            reply = event.reply.get(field)
+            if isinstance(reply, dict):
+                reply = reply.get('firstBatch', reply.get('nextBatch', []))
+            self.docs_returned += len(reply) if isinstance(reply, list) else 0
+
+            key = '%s %s' % command
+            self.seconds[key] = self.seconds.get(key, 0.0) + event.duration_micros / 1e6
+
+    def failed(self, event):
+        with self.lock:
+            self._commands.pop(event.request_id, None)
+
+
+_query_counter = None
+_query_counter_lock = threading.Lock()
+
+
+def get_query_counter():
+    """
+    Returns the process-wide QueryCounter. It is registered with pymongo on first use, so only clients
+    created afterwards report to it. matchminer.database registers it on import, before any client exists.
+    """
+    global _query_counter
+    with _query_counter_lock:
+        if _query_counter is None:
+            _query_counter = QueryCounter()
+            monitoring.register(_query_counter)
+    return _query_counter
@@ -0,0 +1,73 @@
+import logging
+
+from pymongo import UpdateOne
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# indexed protein change without its alternate residue, e.g. P.R132 for p.R132H
+PROTEIN_PREFIX_FIELD = 'TRUE_PROTEIN_CHANGE_PREFIX'
+
+# one letter codes of the amino acids a wildcard protein change may end in
+AMINO_ACIDS = set('ACDEFGHIKLMNPQRSTVWY')
+
+
+def protein_change_prefix(protein_change):
+    """
+    Returns the normalized prefix of a single residue protein change, the reference residue and position,
+    or None if the protein change is not a single residue change.
+
+    :param protein_change: TRUE_PROTEIN_CHANGE of a genomic document, e.g. p.R132H
+    :return: upper cased prefix, e.g. P.R132
+    """
+
+    if not isinstance(protein_change, str) or len(protein_change) < 4:
+        return None
+
+    protein_change = protein_change.upper()
+    if not protein_change.startswith('P.') or protein_change[-1] not in AMINO_ACIDS:
+        return None
+    return protein_change[:-1]
+
+
+def wildcard_prefix(trial_value):
+    """
+    Returns the PROTEIN_PREFIX_FIELD value matched by a WILDCARD_PROTEIN_CHANGE criterion
+
+    :param trial_value: curated wildcard, e.g. R132 or p.R132
+    """
+
+    # by convention, all protein changes begin with "p."
+    if not trial_value.startswith('p.'):
+        trial_value = 'p.' + trial_value
+    return trial_value.upper()
+
+
+def backfill_protein_change_prefix(db, batch_size=1000):
+    """
+    Sets PROTEIN_PREFIX_FIELD on every genomic document with a protein change, e.g. for documents inserted
+    before the field existed, and makes sure the field is indexed.
+
+    :param db: database connection
+    :param batch_size: number of documents updated per bulk write
+    :return: number of documents updated
+    """
+
+    db.genomic.create_index(PROTEIN_PREFIX_FIELD)
+
+    updated = 0
+    requests = []
+    query = {'TRUE_PROTEIN_CHANGE': {'$type': 'string'}}
+    for item in db.genomic.find(query, {'TRUE_PROTEIN_CHANGE': 1, PROTEIN_PREFIX_FIELD: 1}):
+        prefix = protein_change_prefix(item['TRUE_PROTEIN_CHANGE'])
+        if item.get(PROTEIN_PREFIX_FIELD) != prefix:
+            requests.append(UpdateOne({'_id': item['_id']}, {'$set': {PROTEIN_PREFIX_FIELD: prefix}}))
+
+        if len(requests) == batch_size:
+            updated += db.genomic.bulk_write(requests, ordered=False).modified_count
+            requests = []
+
+    if requests:
+        updated += db.genomic.bulk_write(requests, ordered=False).modified_count
+
+    logging.info('Backfilled %s on %d genomic documents' % (PROTEIN_PREFIX_FIELD, updated))
+    return updated
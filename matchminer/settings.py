@@ -49,6 +49,10 @@ MATTERMOST_PW = ""
 MATTERMOST_CHANNEL = ""
 MATTERMOST_TEAM = ""
 SAML_SECRET = ""
+# queue background jobs for `pymm_run.py jobs-worker` processes, only enable where workers are deployed
+JOBS_ASYNC = False
+FILTER_DEDUPLICATION = True
+FILTER_RUN_WORKERS = 1
 SWAGGER_INFO = {
     'title': 'Matchminer API',
     'version': '1.0',
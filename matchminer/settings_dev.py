@@ -118,6 +118,10 @@ genomic = {
     'schema': matchminer.data_model.genomic_schema,
     "allowed_read_roles": ["admin", "service", "user"],
     "allowed_write_roles": ["admin", "service"],
+    'mongo_indexes': {
+        'STRUCTURAL_VARIANT_GENES': [('STRUCTURAL_VARIANT_GENES', 1)],
+        'TRUE_PROTEIN_CHANGE_PREFIX': [('TRUE_PROTEIN_CHANGE_PREFIX', 1)]
+    },
     'item_methods': ['GET', 'PATCH', 'PUT', 'DELETE']
 }
 
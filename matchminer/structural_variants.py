@@ -0,0 +1,106 @@
+import re
+import logging
+import threading
+
+from pymongo import UpdateOne
+
+from matchminer.constants import synonyms
+
+logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s', )
+
+# indexed array of the gene names mentioned in STRUCTURAL_VARIANT_COMMENT
+SV_GENES_FIELD = 'STRUCTURAL_VARIANT_GENES'
+
+# gene names span at most this many words of a comment, e.g. "HER-2/neu"
+MAX_TOKEN_WORDS = 3
+
+_words = re.compile(r'\w+')
+
+_canonical = None
+_canonical_lock = threading.Lock()
+
+
+def _canonical_genes():
+    """Returns the hugo symbols of every synonym, keyed by the upper cased synonym"""
+    global _canonical
+    with _canonical_lock:
+        if _canonical is None:
+            canonical = {}
+            for gene, gene_synonyms in synonyms.items():
+                for synonym in gene_synonyms:
+                    canonical.setdefault(synonym.upper(), set()).add(gene.upper())
+            _canonical = canonical
+    return _canonical
+
+
+def sv_comment_genes(comment):
+    """
+    Extracts the gene tokens of a structural variant comment.
+
+    The comment used to be searched with regexes matching a gene between non word characters or the ends of the
+    comment. The same tokens are every run of up to MAX_TOKEN_WORDS consecutive words, taken verbatim with the
+    separators in between, so "EML4-ALK fusion" holds EML4, ALK, FUSION, EML4-ALK, ALK FUSION and
+    EML4-ALK FUSION. Tokens are upper cased and the hugo symbols of synonyms are added, so SV criteria are
+    answered by an indexed $in on the gene and its synonyms alike.
+
+    :param comment: STRUCTURAL_VARIANT_COMMENT of a genomic document
+    :return: sorted list of tokens
+    """
+
+    if not isinstance(comment, str):
+        return []
+
+    spans = [m.span() for m in _words.finditer(comment)]
+    tokens = set()
+    for i, (start, _) in enumerate(spans):
+        for _, end in spans[i:i + MAX_TOKEN_WORDS]:
+            tokens.add(comment[start:end].upper())
+
+    canonical = _canonical_genes()
+    for token in list(tokens):
+        tokens.update(canonical.get(token, ()))
+
+    return sorted(tokens)
+
+
+def sv_genes_query(genes):
+    """
+    Returns the Mongo condition on SV_GENES_FIELD matching structural variants which mention any of the genes
+
+    :param genes: hugo symbol or list of hugo symbols
+    """
+
+    if not isinstance(genes, list):
+        genes = [genes]
+    return {'$in': sorted(set(str(gene).upper() for gene in genes))}
+
+
+def backfill_sv_genes(db, batch_size=1000):
+    """
+    Sets SV_GENES_FIELD on every genomic document with a structural variant comment, e.g. after the synonyms
+    changed or for documents inserted before the field existed, and makes sure the field is indexed.
+
+    :param db: database connection
+    :param batch_size: number of documents updated per bulk write
+    :return: number of documents updated
+    """
+
+    db.genomic.create_index(SV_GENES_FIELD)
+
+    updated = 0
+    requests = []
+    query = {'STRUCTURAL_VARIANT_COMMENT': {'$type': 'string'}}
+    for item in db.genomic.find(query, {'STRUCTURAL_VARIANT_COMMENT': 1, SV_GENES_FIELD: 1}):
+        genes = sv_comment_genes(item['STRUCTURAL_VARIANT_COMMENT'])
+        if item.get(SV_GENES_FIELD) != genes:
+            requests.append(UpdateOne({'_id': item['_id']}, {'$set': {SV_GENES_FIELD: genes}}))
+
+        if len(requests) == batch_size:
+            updated += db.genomic.bulk_write(requests, ordered=False).modified_count
+            requests = []
+
+    if requests:
+        updated += db.genomic.bulk_write(requests, ordered=False).modified_count
+
+    logging.info('Backfilled %s on %d genomic documents' % (SV_GENES_FIELD, updated))
+    return updated
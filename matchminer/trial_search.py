@@ -1,10 +1,8 @@
-import oncotreenx
-import pandas as pd
 import networkx as nx
 
 from matchminer.settings import TUMOR_TREE
+from matchminer.oncotree import get_oncotree
 from matchminer.matchengine_v1.engine import MatchEngine
-from .database import get_db
 
 
 class Summary:
@@ -193,7 +191,7 @@ class Summary:
         :param item: Trial document
         """
 
-        m = MatchEngine(get_db())
+        m = MatchEngine()
         for step in item['treatment_list']['step']:
             if 'match' in step:
                 g = m.create_match_tree(step['match'][0])
@@ -310,7 +308,7 @@ class Autocomplete:
         }
         self.genes = []
         self.cancer_type_dict = dict()
-        self.m = MatchEngine(get_db())
+        self.m = MatchEngine()
 
     @staticmethod
     def _get_cancer_type_weight(cancer_type, hierarchy='default'):
@@ -648,7 +646,7 @@ class ParseMatchTree:
         cancer_types_expanded = []
         primary_cancer_types = []
         excluded_cancer_types = []
-        onco_tree = oncotreenx.build_oncotree(file_path=TUMOR_TREE)
+        onco_tree = get_oncotree(TUMOR_TREE)
         liquid_children_txt, solid_children_txt = expand_liquid_oncotree(onco_tree)
 
         # iterate through the graph
@@ -659,8 +657,7 @@ class ParseMatchTree:
 
                     diagnosis = node['value']['oncotree_primary_diagnosis']
 
-                    n = oncotreenx.lookup_text(onco_tree, diagnosis.replace('!', ''))
-                    children = list(nx.dfs_tree(onco_tree, n))
+                    n = onco_tree.lookup_text(diagnosis.replace('!', ''))
 
                     if diagnosis == '_SOLID_':
                         children_txt = solid_children_txt
@@ -671,7 +668,7 @@ class ParseMatchTree:
                         primary_parent = 'All Liquid Tumors'
                         parents_txt = ['All Liquid Tumors']
                     else:
-                        children_txt = [onco_tree.nodes[nn]['text'] for nn in children]
+                        children_txt = onco_tree.descendant_texts(n)
 
                         if n is not None:
                             parents, parents_txt, primary_parent = get_parents(onco_tree, n)
@@ -806,34 +803,17 @@ def expand_liquid_oncotree(onco_tree):
     """
     Expand the _LIQUID_ oncotree node to all of its children
 
-    :param onco_tree: Digraph of the Oncotree
+    :param onco_tree: OncoTree index
     :returns liquid_children: All liquid tumor types in the Oncotree
              solid_children: All tumor types in the Oncotree minus "liquid_children"
     """
 
-    # build the nodes for liquid.
-    node1 = oncotreenx.lookup_text(onco_tree, "Lymph")
-    node2 = oncotreenx.lookup_text(onco_tree, "Blood")
+    primary_tumors = set(onco_tree.primary_tumors)
 
-    nodes1 = list(nx.dfs_tree(onco_tree, node1))
-    nodes2 = list(nx.dfs_tree(onco_tree, node2))
-    nodes = list(set(nodes1).union(set(nodes2)))
-
-    primary_tumors = get_primary_tumors()
-
-    liquid_children_codes = []
-    for n in nodes:
-        liquid_children_codes.extend(list(nx.dfs_tree(onco_tree, n)))
-
-    liquid_children = [onco_tree.nodes[nn]['text'] for nn in liquid_children_codes
-                       if onco_tree.nodes[nn]['text'].strip() not in primary_tumors]
+    liquid_children = [txt for txt in onco_tree.texts(onco_tree.liquid) if txt.strip() not in primary_tumors]
 
     # solid nodes are all other nodes
-    all_nodes = set(list(onco_tree.nodes()))
-    tmp_nodes = all_nodes - set(nodes)
-    solid_children_codes = list(tmp_nodes)
-    solid_children = [onco_tree.nodes[nn]['text'] for nn in solid_children_codes
-                      if onco_tree.nodes[nn]['text'].strip() not in primary_tumors]
+    solid_children = [txt for txt in onco_tree.texts(onco_tree.solid) if txt.strip() not in primary_tumors]
 
     return liquid_children, solid_children
 
@@ -842,7 +822,7 @@ def get_parents(onco_tree, node):
     """
     Retrive all parents of a given onco tree node
 
-    :param onco_tree: Oncotree directed graph object
+    :param onco_tree: OncoTree index
     :param node: Location within the oncotree
     :return: List of all parents
     """
@@ -850,18 +830,19 @@ def get_parents(onco_tree, node):
     if not node:
         return [], []
 
-    predecessors = list(onco_tree.predecessors(node))
-    parents_txt = [onco_tree.nodes._nodes[n]['text'] for n in predecessors]
-    check = onco_tree.nodes._nodes[predecessors[0]]['text']
+    # the primary parent is the last ancestor below the root
+    predecessors = list(onco_tree.ancestors(node))
+    primary_parent = node
+    for i, parent in enumerate(predecessors):
+        check = onco_tree.text(parent)
+        if not check or 'root' in check:
+            predecessors = predecessors[:i + 1]
+            break
+        primary_parent = parent
 
-    if check and 'root' not in check:
-        pr, pa, primary_parent = get_parents(onco_tree, predecessors[0])
-        predecessors.extend(pr)
-        parents_txt.extend(pa)
-    else:
-        primary_parent = node.title()
+    parents_txt = onco_tree.texts(predecessors)
 
-    return predecessors, parents_txt, primary_parent
+    return predecessors, parents_txt, primary_parent.title()
 
 
 def parse_diagnosis(diagnosis):
@@ -886,5 +867,4 @@ def get_primary_tumors():
     """
     Returns a list of all primary tumor types
     """
-    oncotree_df = pd.read_csv(TUMOR_TREE, sep='\t')
-    return [i.split('(')[0].strip() for i in oncotree_df.primary.unique().tolist()]
+    return list(get_oncotree(TUMOR_TREE).primary_tumors)
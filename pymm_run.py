@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 import argparse
+import datetime
 from eve import Eve
 from flask import redirect
 
 from matchminer.elasticsearch import reset_elasticsearch
+from matchminer.profiler import top_criteria
+from matchminer.jobs import run_worker
+from matchminer.locks import run_lock, LockHeld, ELASTICSEARCH
+from matchminer.miner import start_filter_run
+from matchminer.matchengine_v1.engine import MatchEngine
+from matchminer.structural_variants import backfill_sv_genes
+from matchminer.protein_change import backfill_protein_change_prefix
 from matchminer.utilities import *
 from matchminer.custom import blueprint
 from matchminer import settings, security
@@ -63,6 +71,36 @@ def run_server(args):
     app.run(host='0.0.0.0', port=settings.API_PORT, threaded=True)
 
 
+def run_locked(name, stage, fn):
+    try:
+        with run_lock(database.get_db(), name, stage):
+            fn()
+    except LockHeld as e:
+        logging.error(str(e))
+
+
+def run_matchengine_v1(args):
+    me = MatchEngine(database.get_db(), snapshot=args.snapshot, facet=args.facet)
+    if args.since is not None or args.data_push_id is not None:
+        num_matches = me.update_trial_matches(since=args.since, data_push_id=args.data_push_id)
+        logging.info("Incremental run updated %d trial matches" % num_matches)
+    else:
+        me.find_trial_matches(workers=args.workers, profile=args.profile, report=args.report)
+
+
+def print_profile(args):
+    run_id, criteria = top_criteria(database.get_db(), n=args.top, run_id=args.run_id, level=args.level)
+    if run_id is None:
+        print("no profiled runs found")
+        return
+
+    print("run %s: top %d %s entries by wall time" % (run_id, len(criteria), args.level))
+    print("%10s %8s %8s %14s %10s  %s" % ('seconds', 'count', 'queries', 'docs examined', 'results', 'name'))
+    for c in criteria:
+        print("%10.3f %8d %8d %14d %10d  %s" % (
+            c['seconds'], c['count'], c['queries'], c['docs_examined'], c['results'], c['name']))
+
+
 # main
 if __name__ == '__main__':
     main_p = argparse.ArgumentParser()
@@ -75,10 +113,50 @@ if __name__ == '__main__':
     subp_p.set_defaults(func=run_server)
 
     subp_p = subp.add_parser('reset-elasticsearch', help='resets elasticsearch')
-    subp_p.set_defaults(func=lambda x: reset_elasticsearch())
+    subp_p.set_defaults(func=lambda x: run_locked(ELASTICSEARCH, 'resetting elasticsearch', reset_elasticsearch))
 
     subp_p = subp.add_parser('reannotate-trials', help='regenerates elasticsearch fields on all trials')
-    subp_p.set_defaults(func=lambda x: reannotate_trials())
+    subp_p.set_defaults(func=lambda x: run_locked(ELASTICSEARCH, 'reannotating trials', reannotate_trials))
+
+    subp_p = subp.add_parser('jobs-worker', help='runs queued background jobs, e.g. filter matching')
+    subp_p.add_argument("--poll-interval", dest='poll_interval', type=float, default=1.0)
+    subp_p.set_defaults(func=lambda x: run_worker(database.get_db(), x.poll_interval))
+
+    subp_p = subp.add_parser('run-filters', help='matches all filters, sharded across processes with --workers')
+    subp_p.add_argument("--workers", dest='workers', type=int, default=settings.FILTER_RUN_WORKERS)
+    subp_p.add_argument("--chunk-size", dest='chunk_size', type=int, default=None)
+    subp_p.add_argument("--datapush-id", dest='datapush_id', default=None)
+    subp_p.add_argument("--silent", dest='silent', action='store_const', const=True, default=False)
+    subp_p.add_argument("--profile", dest='profile', action='store_const', const=True, default=False)
+    subp_p.add_argument("--report", dest='report', default=None, help='path of a JSON report of the profiled run')
+    subp_p.set_defaults(func=lambda x: start_filter_run(x.silent, x.datapush_id, x.workers, x.chunk_size,
+                                                        profile=x.profile, report=x.report))
+
+    subp_p = subp.add_parser('matchengine', help='matches all trials with the v1 engine')
+    subp_p.add_argument("--workers", dest='workers', type=int, default=1)
+    subp_p.add_argument("--snapshot", dest='snapshot', action='store_const', const=True, default=False)
+    subp_p.add_argument("--facet", dest='facet', action='store_const', const=True, default=False)
+    subp_p.add_argument("--profile", dest='profile', action='store_const', const=True, default=False)
+    subp_p.add_argument("--report", dest='report', default=None, help='path of a JSON report of the profiled run')
+    subp_p.add_argument("--since", dest='since', default=None,
+                        type=lambda value: datetime.datetime.strptime(value, '%Y-%m-%d %X'),
+                        help='only rematch trials and samples updated since, e.g. "2020-01-31 18:00:00"')
+    subp_p.add_argument("--data-push-id", dest='data_push_id', default=None,
+                        help='only rematch the samples of this data push')
+    subp_p.set_defaults(func=run_matchengine_v1)
+
+    subp_p = subp.add_parser('backfill-sv-genes', help='indexes the genes mentioned by structural variant comments')
+    subp_p.set_defaults(func=lambda x: backfill_sv_genes(database.get_db()))
+
+    subp_p = subp.add_parser('backfill-protein-prefixes', help='indexes the prefixes of single residue protein changes')
+    subp_p.set_defaults(func=lambda x: backfill_protein_change_prefix(database.get_db()))
+
+    subp_p = subp.add_parser('profile', help='prints the most expensive criteria of a profiled matching run')
+    subp_p.add_argument("-n", dest='top', type=int, default=10)
+    subp_p.add_argument("--run-id", dest='run_id', default=None)
+    subp_p.add_argument("--level", dest='level', default='leaf',
+                        choices=['leaf', 'match_level', 'trial', 'run', 'command'])
+    subp_p.set_defaults(func=print_profile)
 
     args = main_p.parse_args()
     args.func(args)
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# Times add_sort_order against the row by row version it replaced, on generated match tables. Nothing is asserted,
+# run it by hand:
+#
+#   python -m tests.benchmark_sort --samples 1000 --matches 20000
+#
+# The generator also writes the fixture tests/unit/test_sort.py checks the current version against:
+#
+#   python -m tests.benchmark_sort --write-fixture
+import os
+import json
+import time
+import random
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from matchminer.matchengine_v1.sort import add_sort_order
+
+FIXTURE = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data', 'sort_order.json'))
+
+
+def random_matches(num_samples, num_matches, seed=0):
+    """Returns a match table with the columns add_sort_order reads"""
+    r = random.Random(seed)
+    return pd.DataFrame([{
+        'sample_id': 'SAMPLE-%d' % r.randrange(num_samples),
+        'protocol_no': '%d-%03d' % (r.choice([12, 13, 16, 17]), r.randrange(40)),
+        'vital_status': r.choice(['alive', 'alive', 'alive', 'deceased']),
+        'trial_accrual_status': r.choice(['open', 'open', 'closed']),
+        'genomic_alteration': r.choice(['BRAF p.V600E', ' Structural Variation', 'EGFR', 'wt KRAS']),
+        'tier': r.choice([1, 2, 3, 4, np.nan]),
+        'mmr_status': r.choice([np.nan] * 9 + ['Proficient (MMR-P / MSS)']),
+        'variant_category': r.choice(['MUTATION', 'CNV', 'SV', None]),
+        'wildtype': r.choice([True, False, None]),
+        'match_type': r.choice(['variant', 'gene']),
+        'cancer_type_match': r.choice(['specific', 'all_solid', 'all_liquid', 'unknown']),
+        'coordinating_center': r.choice(['Dana-Farber Cancer Institute', 'MGH', 'unknown'])
+    } for _ in range(num_matches)])
+
+
+# add_sort_order as it was before it was vectorized, unchanged
+def baseline_add_sort_order(trial_match_df):
+    """
+    Aggregate all the trial matches by MRN and provide a sort order using the following logic:
+    (1) First sort by tier
+    (2) Then sort by match_type (variant > gene)
+    (3) Then sort by cancer type (specific cancer type > all solid/liquid)
+    (4) Then sort by coordinating center (DFCI > MGH)
+    (5) Then sort by reverse protocol number (high > low)
+
+    :param trial_matches: List of trial match dictionaries
+    :return: List of trial match dictionaries with two additional columns:
+        (1) sort_order: Order in which to display the matches
+        (2) freq: Frequency with which this trial match appears throughout the entire patient cohort
+    """
+
+    if len(trial_match_df.index) == 0:
+        return trial_match_df
+
+    f1 = (trial_match_df['vital_status'] == 'alive')
+    f2 = (trial_match_df['trial_accrual_status'] == 'open')
+    f3 = (trial_match_df['genomic_alteration'].str.strip().str.title() != 'Structural Variation')
+    all_sample_ids = trial_match_df.sample_id.unique().tolist()
+    master_sort_order = {}
+
+    for sample_id in all_sample_ids:
+        f4 = (trial_match_df['sample_id'] == sample_id)
+        df = trial_match_df[f1 & f2 & f3 & f4]
+        matches = list(df.T.to_dict().values())
+
+        # The sort order dictionary keeps track of the priority for each sort category for each match
+        # Index 0 is sorted by tier with values 0 to 7
+        # Index 1 is sorted by match type with values 0 to 1
+        # Index 2 is sorted by cancer type match with values 0 to 2
+        # Index 3 is sorted by coordinating center with values 0 to 1
+        # Index 4 is sorted by reverse protocol number
+        sort_order = {}
+
+        for match in matches:
+
+            idx = (match['sample_id'], match['protocol_no'])
+            if idx not in sort_order:
+                sort_order[idx] = []
+
+            sort_order = sort_by_tier(match, sort_order)
+            sort_order = sort_by_match_type(match, sort_order)
+            sort_order = sort_by_cancer_type(match, sort_order)
+            sort_order = sort_by_coordinating_center(match, sort_order)
+
+        sort_order = sort_by_reverse_protocol_no(matches, sort_order)
+
+        # for k, v in sort_order.iteritems():
+        #     print '%s | %s' % (k, v)
+
+        master_sort_order = final_sort(sort_order, master_sort_order)
+
+    trial_match_df['sort_order'] = trial_match_df.apply(lambda x: master_sort_order[(x['sample_id'], x['protocol_no'])]
+                                                        if (x['sample_id'], x['protocol_no']) in master_sort_order
+                                                        else -1, axis=1)
+    return trial_match_df
+
+
+def sort_by_tier(match, sort_order):
+    """
+    Highest priority sorting
+    """
+
+    idx = (match['sample_id'], match['protocol_no'])
+
+    if 'mmr_status' in match and pd.notnull(match['mmr_status']):
+        sort_order[idx] = add_sort_value(sort_value=0,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'tier' in match and match['tier'] == 1:
+        sort_order[idx] = add_sort_value(sort_value=1,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'tier' in match and match['tier'] == 2:
+        sort_order[idx] = add_sort_value(sort_value=2,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'variant_category' in match and match['variant_category'] == 'CNV':
+        sort_order[idx] = add_sort_value(sort_value=3,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'tier' in match and match['tier'] == 3:
+        sort_order[idx] = add_sort_value(sort_value=4,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'tier' in match and match['tier'] == 4:
+        sort_order[idx] = add_sort_value(sort_value=5,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'wildtype' in match and match['wildtype'] is True:
+        sort_order[idx] = add_sort_value(sort_value=6,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    else:
+        sort_order[idx] = add_sort_value(sort_value=7,
+                                         priority=0,
+                                         sort_order_li=sort_order[idx])
+
+    return sort_order
+
+
+def sort_by_match_type(match, sort_order):
+    """
+    Second highest priority sorting
+    """
+
+    idx = (match['sample_id'], match['protocol_no'])
+
+    if 'match_type' in match and match['match_type'] == 'variant':
+        sort_order[idx] = add_sort_value(sort_value=0,
+                                         priority=1,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'match_type' in match and match['match_type'] == 'gene':
+        sort_order[idx] = add_sort_value(sort_value=1,
+                                         priority=1,
+                                         sort_order_li=sort_order[idx])
+    else:
+        sort_order[idx] = add_sort_value(sort_value=2,
+                                         priority=1,
+                                         sort_order_li=sort_order[idx])
+
+    return sort_order
+
+
+def sort_by_cancer_type(match, sort_order):
+    """
+    Third highest priority sorting
+    """
+
+    idx = (match['sample_id'], match['protocol_no'])
+
+    if 'cancer_type_match' in match and match['cancer_type_match'] == 'specific':
+        sort_order[idx] = add_sort_value(sort_value=0,
+                                         priority=2,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'cancer_type_match' in match and match['cancer_type_match'] == 'all_solid':
+        sort_order[idx] = add_sort_value(sort_value=1,
+                                         priority=2,
+                                         sort_order_li=sort_order[idx])
+
+    elif 'cancer_type_match' in match and match['cancer_type_match'] == 'all_liquid':
+        sort_order[idx] = add_sort_value(sort_value=1,
+                                         priority=2,
+                                         sort_order_li=sort_order[idx])
+
+    else:
+        sort_order[idx] = add_sort_value(sort_value=2,
+                                         priority=2,
+                                         sort_order_li=sort_order[idx])
+
+    return sort_order
+
+
+def sort_by_coordinating_center(match, sort_order):
+    """
+    Fourth highest priority sorting
+    """
+
+    idx = (match['sample_id'], match['protocol_no'])
+
+    if 'coordinating_center' in match and match['coordinating_center'] == 'Dana-Farber Cancer Institute':
+        sort_order[idx] = add_sort_value(sort_value=0,
+                                         priority=3,
+                                         sort_order_li=sort_order[idx])
+    else:
+        sort_order[idx] = add_sort_value(sort_value=1,
+                                         priority=3,
+                                         sort_order_li=sort_order[idx])
+
+    return sort_order
+
+
+def sort_by_reverse_protocol_no(matches, sort_order):
+    """
+    Lowest priority sorting
+    """
+
+    rev_prot_no_sort = sorted(matches, key=lambda k: int(k['protocol_no'].split('-')[0]))
+    i = 0
+
+    for match in rev_prot_no_sort[::-1]:
+
+        if len(sort_order[(match['sample_id'], match['protocol_no'])]) == 4:
+            sort_order[(match['sample_id'], match['protocol_no'])].append(i)
+            i += 1
+
+    return sort_order
+
+
+def final_sort(sort_order, master_sort_order):
+
+    cols = ['tier', 'match_type', 'cancer_type', 'coordinating_center', 'rev_protocol_no']
+    sort_order_df = pd.DataFrame(list(sort_order.values()), columns=cols, index=list(sort_order.keys()))
+    sort_order_df.sort_values(by=cols, axis=0, ascending=True, inplace=True)
+
+    j = 0
+    for idx, row in sort_order_df.iterrows():
+        master_sort_order[idx] = j
+        j += 1
+
+    return master_sort_order
+
+
+def add_sort_value(sort_value, priority, sort_order_li):
+    """
+    Adds the sort value, independent of the logic required to assess and determine that value.
+    Accepts the lowest sort_value when there are multiple matches.
+
+    :param sort_value: Integer value that determines sort order
+    :param priority: Integer that determines which column to assign the sort value
+        (e.g. tier, match_type, etc.)
+    :param sort_order_li: The match-specific sort order list so far
+    """
+
+    if len(sort_order_li) >= priority + 1:
+
+        if sort_value < sort_order_li[priority]:
+            sort_order_li[priority] = sort_value
+    else:
+        sort_order_li.append(sort_value)
+
+    return sort_order_li
+
+
+def write_fixture():
+    """Writes small match tables with the sort orders the baseline computes for them"""
+    cases = []
+    for seed in range(3):
+        records = json.loads(random_matches(30, 200, seed).to_json(orient='records'))
+        sort_order = baseline_add_sort_order(pd.DataFrame(records))['sort_order'].tolist()
+        cases.append({'matches': records, 'sort_order': [int(x) for x in sort_order]})
+    with open(FIXTURE, 'w') as f:
+        json.dump(cases, f)
+
+
+def benchmark(num_samples, num_matches, seed):
+    df = random_matches(num_samples, num_matches, seed)
+
+    start = time.time()
+    expected = baseline_add_sort_order(df.copy())['sort_order'].tolist()
+    baseline_time = time.time() - start
+
+    start = time.time()
+    sort_order = add_sort_order(df.copy())['sort_order'].tolist()
+    vectorized_time = time.time() - start
+
+    print("add_sort_order on %d matches of %d samples" % (num_matches, num_samples))
+    print("  baseline:   %8.3fs" % baseline_time)
+    print("  vectorized: %8.3fs (%.0fx)" % (vectorized_time, baseline_time / max(vectorized_time, 1e-9)))
+    print("  same sort order: %s" % (sort_order == expected))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", dest='samples', type=int, default=1000)
+    parser.add_argument("--matches", dest='matches', type=int, default=20000)
+    parser.add_argument("--seed", dest='seed', type=int, default=7)
+    parser.add_argument("--write-fixture", dest='write_fixture', action='store_const', const=True, default=False)
+    args = parser.parse_args()
+
+    if args.write_fixture:
+        write_fixture()
+    else:
+        benchmark(args.samples, args.matches, args.seed)
@@ -16,6 +16,7 @@ from matchminer.custom import blueprint
 from matchminer.validation import ConsentValidatorEve
 from matchminer.settings import *
 from matchminer.events import register_hooks
+import matchminer.settings
 from matchminer import security
 
 
@@ -150,6 +151,9 @@ class TestMinimal(unittest.TestCase):
         # initialize the database if necessary.
         self.initDB()
 
+        # run background jobs, e.g. filter matching, within the request
+        matchminer.settings.JOBS_ASYNC = False
+
         # clear backup.
         # shutil.rmtree(BACKUP_DIR)
         # os.makedirs(BACKUP_DIR)
@@ -1,13 +1,14 @@
 from __future__ import annotations
 
 import datetime
-import re
 
 from dateutil.relativedelta import relativedelta
 
 from matchengine.internals.query_transform import QueryTransformerContainer
 from matchengine.internals.typing.matchengine_types import QueryTransformerResult
 
+from matchminer.protein_change import PROTEIN_PREFIX_FIELD, wildcard_prefix
+
 
 class DFCIQueryTransformers(QueryTransformerContainer):
     def tmb_range_to_query(self, **kwargs):
@@ -83,8 +84,9 @@ class DFCIQueryTransformers(QueryTransformerContainer):
 
     def wildcard_regex(self, **kwargs):
         """
-        When trial curation criteria include a wildcard prefix (e.g. WILDCARD_PROTEIN_CHANGE), a extended_attributes query must
-        use a $regex to search for all extended_attributes documents which match the protein prefix.
+        When trial curation criteria include a wildcard prefix (e.g. WILDCARD_PROTEIN_CHANGE), a extended_attributes query
+        searches for all extended_attributes documents which match the protein prefix followed by a single residue.
+        The prefix is indexed at genomic ingest, so this is an equality lookup rather than a $regex.
 
         E.g.
         Trial curation match clause:
@@ -95,17 +97,16 @@ class DFCIQueryTransformers(QueryTransformerContainer):
         |    true_protein_change: p.R132H
 
         The above should match in a mongo query.
-        """
-        trial_value = kwargs['trial_value']
 
-        # By convention, all protein changes being with "p."
+        The query is always on PROTEIN_PREFIX_FIELD, the indexed prefix of TRUE_PROTEIN_CHANGE, so the criterion
+        must be mapped to the TRUE_PROTEIN_CHANGE sample key.
+        """
+        if kwargs['sample_key'] != 'TRUE_PROTEIN_CHANGE':
+            raise ValueError("wildcard_regex only matches TRUE_PROTEIN_CHANGE, not %s" % kwargs['sample_key'])
 
+        trial_value = kwargs['trial_value']
         trial_value, negate = self.transform.is_negate(trial_value)
-        if not trial_value.startswith('p.'):
-            trial_value = re.escape('p.' + trial_value)
-        trial_value = f'^{trial_value}[ACDEFGHIKLMNPQRSTVWY]$'
-        return QueryTransformerResult({kwargs['sample_key']: {'$regex': re.compile(trial_value, re.IGNORECASE)}},
-                                      negate)
+        return QueryTransformerResult({PROTEIN_PREFIX_FIELD: wildcard_prefix(trial_value)}, negate)
 
     def mmr_ms_map(self, **kwargs):
         mmr_map = {
@@ -2,6 +2,7 @@ from bson.objectid import ObjectId
 
 from tests.test_matchminer import TestMinimal
 from matchminer.event_hooks.user import email_user
+from matchminer.miner import email_matches
 from matchminer import settings
 
 
@@ -73,3 +74,28 @@ class TestEmail(TestMinimal):
         }])
         emails = list(self.db.email.find())
         assert len(emails) == 0
+
+    def test_email_matches(self):
+        self.db['email'].drop()
+        filter_id = self.db['filter'].insert_one({
+            'label': 'new matches', 'description': 'test', 'protocol_id': '11-1111', 'TEAM_ID': self.team_id
+        }).inserted_id
+        other_team_id = ObjectId()
+        match = {'FILTER_ID': filter_id, 'TEAM_ID': self.team_id, 'is_disabled': False, 'FILTER_STATUS': 1,
+                 '_me_id': 'run1'}
+
+        # three new matches, one disabled, one of an older run and one of another team.
+        self.db['match'].insert_many([dict(match) for _ in range(3)] + [
+            dict(match, is_disabled=True), dict(match, _me_id='run0'), dict(match, TEAM_ID=other_team_id)])
+        self.db['user'].insert_one({'first_name': 'silent', 'last_name': 'user', 'email': 'silent@test.test',
+                                    'teams': [self.team_id], 'silent': True})
+
+        email_matches(['run1'])
+
+        emails = list(self.db['email'].find())
+        assert len(emails) == len(list(self.db['user'].find({'teams': self.team_id, 'silent': {'$ne': True}})))
+        assert emails
+        for email in emails:
+            assert email['email_to'] != 'silent@test.test'
+            assert int(email['body'].split('identified ')[1].split(' new')[0]) == 3
+            assert 'new matches' in email['body']
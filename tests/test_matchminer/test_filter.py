@@ -1,5 +1,11 @@
 import json
+import datetime
 from bson.objectid import ObjectId
+import matchminer.settings
+from matchminer.jobs import claim_job, run_job
+from matchminer.miner import get_enrollment, transform_filter_to_CTML, rerun_filters, update_filter_post, \
+    email_matches
+from matchminer.filter_dedup import group_filters, update_copied_matches, COPY_HASH_PREFIX
 from tests.test_matchminer import TestMinimal
 
 
@@ -54,6 +60,184 @@ class TestFilter(TestMinimal):
             assert str(x['USER_ID']) == str(self.user_id)
 
 
+    def test_post_async(self):
+
+        c = {
+            "BIRTH_DATE": {"^gt": "1926-02-03T11:28:34.144Z"},
+        }
+        rule = {
+            'USER_ID': self.user_id,
+            'TEAM_ID': self.team_id,
+            'clinical_filter': c,
+            'label': 'test',
+            'temporary': False,
+            'status': 1
+        }
+
+        # the filter is saved right away and matched by a queued job.
+        matchminer.settings.JOBS_ASYNC = True
+        try:
+            r, status_code = self.post('filter', rule)
+        finally:
+            matchminer.settings.JOBS_ASYNC = False
+        self.assert201(status_code)
+        assert self.db['match'].count() == 0
+
+        r, status_code = self.get('jobs/%s' % r['job_id'])
+        self.assert200(status_code)
+        assert r['status'] == 'queued' and r['result'] is None
+
+        # run it as the job worker would.
+        run_job(self.db, claim_job(self.db))
+        r, status_code = self.get('jobs/%s' % r['_id'])
+        self.assert200(status_code)
+        assert r['status'] == 'done', r
+        assert r['result']['num_samples'] > 0
+        assert len(r['result']['enrollment']['x_axis']) == len(r['result']['enrollment']['y_axis'])
+        assert self.db['match'].count() > 0
+        item = self.db['filter'].find_one()
+        assert item['num_samples'] == r['result']['num_samples']
+        assert item['enrollment'] == r['result']['enrollment']
+        assert item['enrollment_run_id'] == r['result']['run_id']
+
+    def test_enrollment(self):
+
+        report = datetime.datetime(2015, 3, 17)
+        matches = {
+            'sample1': [{'REPORT_DATE': report}, {'REPORT_DATE': report + datetime.timedelta(days=10)}],
+            'sample2': [{'REPORT_DATE': datetime.datetime(2015, 5, 2)}, {'REPORT_DATE': None}, {}],
+        }
+        enrollment = get_enrollment(matches)
+
+        # every month since July 2013 is present, months without reports included.
+        assert enrollment['x_axis'][0] == '13-07-01'
+        assert len(enrollment['x_axis']) == len(enrollment['y_axis'])
+        counts = dict(zip(enrollment['x_axis'], enrollment['y_axis']))
+        assert counts['15-03-01'] == 2 and counts['15-04-01'] == 0 and counts['15-05-01'] == 1
+        assert sum(enrollment['y_axis']) == 3
+        assert get_enrollment({})['x_axis'] == enrollment['x_axis']
+
+    def test_transform_multis(self):
+
+        item = {
+            'genomic_filter': {
+                'TRUE_HUGO_SYMBOL': ['BRAF', 'EGFR'],
+                'VARIANT_CATEGORY': ['MUTATION', 'CNV'],
+                'CNV_CALL': ['High Amplification', 'Homozygous Deletion'],
+                'TRUE_PROTEIN_CHANGE': ['p.V600E', 'p.V600E', 'p.L858R'],
+                'WILDTYPE': False
+            }
+        }
+        transform_filter_to_CTML([item])
+        or_clauses = item['match'][0]['and'][1]['or']
+
+        # 2 genes x 2 protein changes, with one MUTATION clause and two CNV clauses each.
+        assert len(or_clauses) == 12
+        assert len(set(json.dumps(c, sort_keys=True) for c in or_clauses)) == 12
+        for or_clause in or_clauses:
+            node = or_clause['genomic']
+            assert ('CNV_CALL' in node) == (node['VARIANT_CATEGORY'] == 'CNV')
+
+    def test_rerun_sharded(self):
+
+        for diagnosis in ["_SOLID_", "_LIQUID_"]:
+            rule = {
+                'USER_ID': self.user_id,
+                'TEAM_ID': self.team_id,
+                'clinical_filter': {"ONCOTREE_PRIMARY_DIAGNOSIS_NAME": diagnosis},
+                'label': diagnosis,
+                'temporary': False,
+                'status': 1
+            }
+            r, status_code = self.post('filter', rule)
+            self.assert201(status_code)
+        self.db['match'].drop()
+
+        # both shards' matches belong to a single run.
+        matches, run_id = rerun_filters(datapush_id='push1', workers=2)
+        assert len(matches) == 2
+        assert self.db['match'].count() > 0
+        assert self.db['match'].distinct('_me_id') == [run_id]
+        assert self.db['match'].distinct('data_push_id') == ['push1']
+        assert len(self.db['filter_run'].find_one({'_id': run_id})['shard_run_ids']) == 2
+
+    def test_rerun_deduplicated(self):
+
+        filter_ids = []
+        for label in ["first", "second"]:
+            rule = {
+                'USER_ID': self.user_id,
+                'TEAM_ID': self.team_id,
+                'clinical_filter': {"ONCOTREE_PRIMARY_DIAGNOSIS_NAME": "_LIQUID_"},
+                'label': label,
+                'temporary': False,
+                'status': 1
+            }
+            r, status_code = self.post('filter', rule)
+            self.assert201(status_code)
+            filter_ids.append(ObjectId(r['_id']))
+        matched = self.db['match'].count({'FILTER_ID': filter_ids[1], 'is_disabled': False})
+        assert matched > 0
+
+        # the second filter gets copies of the matches of the first, which equal the matches it had.
+        matches, run_id = rerun_filters()
+        assert sorted(matches[filter_ids[0]]) == sorted(matches[filter_ids[1]])
+        assert self.db['match'].count({'FILTER_ID': filter_ids[1]}) == matched
+        assert self.db['match'].count({'FILTER_ID': filter_ids[1], 'is_disabled': False}) == matched
+
+        # matches the first filter loses are disabled for the second, and enabled again when found again.
+        lost = self.db['match'].find_one({'FILTER_ID': filter_ids[0]})
+        self.db['match'].update_one({'_id': lost['_id']}, {'$set': {'is_disabled': True}})
+        groups = group_filters(self.db['filter'].find())
+        update_copied_matches(self.db, groups, 'run1')
+        assert self.db['match'].count({'FILTER_ID': filter_ids[1], 'is_disabled': False}) == matched - 1
+
+        self.db['match'].update_one({'_id': lost['_id']}, {'$set': {'is_disabled': False}})
+        update_copied_matches(self.db, groups, 'run2')
+        assert self.db['match'].count({'FILTER_ID': filter_ids[1], 'is_disabled': False}) == matched
+        assert self.db['match'].count({'FILTER_ID': filter_ids[1], '_me_id': 'run2'}) == 1
+        assert self.db['match'].count({'FILTER_ID': filter_ids[1]}) == matched
+
+    def test_rerun_evaluated_deleted(self):
+
+        rule = {
+            'USER_ID': self.user_id,
+            'TEAM_ID': self.team_id,
+            'clinical_filter': {"ONCOTREE_PRIMARY_DIAGNOSIS_NAME": "_LIQUID_"},
+            'label': 'first',
+            'temporary': False,
+            'status': 1
+        }
+        r, status_code = self.post('filter', rule)
+        self.assert201(status_code)
+        first = self.db['filter'].find_one({'_id': ObjectId(r['_id'])})
+
+        # a second filter with the same criteria, which only ever got copies of the first filter's matches
+        second = dict(first, _id=ObjectId(), label='second')
+        self.db['filter'].insert_one(second)
+        rerun_filters()
+        copies = list(self.db['match'].find({'FILTER_ID': second['_id'], 'is_disabled': False}))
+        assert copies and all(match['hash'].startswith(COPY_HASH_PREFIX) for match in copies)
+        self.db['match'].update_one({'_id': copies[0]['_id']}, {'$set': {'MATCH_STATUS': 2}})
+
+        # the second filter is evaluated itself once the first is deleted, its matches stay as they were.
+        first['status'] = 3
+        self.db['filter'].update_one({'_id': first['_id']}, {'$set': {'status': 3}})
+        update_filter_post(first, None)
+        matches, run_id = rerun_filters()
+
+        assert self.db['match'].count({'FILTER_ID': second['_id']}) == len(copies)
+        assert self.db['match'].count({'FILTER_ID': second['_id'], 'is_disabled': False}) == len(copies)
+        assert self.db['match'].count({'FILTER_ID': second['_id'], '_me_id': run_id}) == 0
+        assert self.db['match'].count({'FILTER_ID': second['_id'], 'MATCH_STATUS': 2}) == 1
+
+        emails = self.db['email'].count()
+        email_matches(run_id)
+        assert self.db['email'].count() == emails
+
+        filter_run = self.db['filter_run'].find_one({'_id': run_id})
+        assert filter_run['filters'] == 2 and filter_run['distinct_criteria'] == 2
+
     def test_post_time(self):
 
         # make a complex query.
@@ -0,0 +1,76 @@
+import datetime
+from bson import ObjectId
+
+from tests.test_matchminer import TestMinimal
+from matchminer.jobs import job_handler, submit_job, claim_job, run_job, update_job, JobLost, JOB_TIMEOUT, \
+    RUNNING, DONE
+import matchminer.settings
+from matchminer.miner import find_filter_matches
+
+
+@job_handler('test_echo')
+def echo(db, job):
+    update_job(db, job, 'echoing', 0.5)
+    return job['payload']
+
+
+class TestJobs(TestMinimal):
+
+    def setUp(self, settings_file=None, url_converters=None):
+        super(TestJobs, self).setUp(settings_file=None, url_converters=None)
+        self.db['jobs'].drop()
+        matchminer.settings.JOBS_ASYNC = True
+
+    def tearDown(self):
+        matchminer.settings.JOBS_ASYNC = False
+        self.db['jobs'].drop()
+
+    def test_run(self):
+
+        job_id = submit_job(self.db, 'test_echo', {'value': 1})
+        job = claim_job(self.db)
+        assert job['_id'] == job_id and job['status'] == RUNNING and job['owner']
+        assert claim_job(self.db) is None
+
+        run_job(self.db, job)
+        job = self.db['jobs'].find_one({'_id': job_id})
+        assert job['status'] == DONE and job['result'] == {'value': 1}
+
+    def test_lost(self):
+
+        # a worker which stopped reporting loses the job to another worker.
+        job_id = submit_job(self.db, 'test_echo', {'value': 2})
+        stalled = claim_job(self.db)
+        self.db['jobs'].update_one({'_id': job_id}, {'$set': {
+            '_updated': datetime.datetime.now() - datetime.timedelta(seconds=JOB_TIMEOUT + 1)}})
+        job = claim_job(self.db)
+        assert job['_id'] == job_id and job['owner'] != stalled['owner']
+
+        # the stalled worker can neither report nor store a result.
+        with self.assertRaises(JobLost):
+            update_job(self.db, stalled, 'echoing', 0.5)
+        run_job(self.db, stalled)
+        assert self.db['jobs'].find_one({'_id': job_id})['status'] == RUNNING
+
+        run_job(self.db, job)
+        assert self.db['jobs'].find_one({'_id': job_id})['status'] == DONE
+
+    def test_status_scoped(self):
+
+        # only the members of a job's team see it.
+        job_id = submit_job(self.db, 'test_echo', {'value': 3}, team_id=self.team_id)
+        r, status_code = self.get('jobs/%s' % job_id)
+        self.assert200(status_code)
+        assert r['status'] == 'queued'
+
+        job_id = submit_job(self.db, 'test_echo', {'value': 4}, team_id=ObjectId())
+        r, status_code = self.get('jobs/%s' % job_id)
+        assert status_code == 404
+
+    def test_sync_failure(self):
+
+        # a filter match failing while jobs run synchronously fails the request saving the filter.
+        matchminer.settings.JOBS_ASYNC = False
+        with self.assertRaises(RuntimeError):
+            find_filter_matches([{'_id': ObjectId(), 'TEAM_ID': self.team_id}])
+        assert self.db['jobs'].find_one()['status'] == 'failed'
@@ -0,0 +1,72 @@
+import datetime
+
+from tests.test_matchminer import TestMinimal
+from matchminer.locks import RunLock, LockHeld, run_lock, FILTERS, MATCHENGINE, ELASTICSEARCH
+
+
+class TestLocks(TestMinimal):
+
+    def setUp(self, settings_file=None, url_converters=None):
+        super(TestLocks, self).setUp(settings_file=None, url_converters=None)
+        self.db['active_processes'].drop()
+
+    def tearDown(self):
+        self.db['active_processes'].drop()
+
+    def test_exclusive(self):
+
+        lock = RunLock(self.db, FILTERS)
+        assert lock.acquire()
+        assert not RunLock(self.db, FILTERS).acquire()
+        with self.assertRaises(LockHeld):
+            with run_lock(self.db, FILTERS):
+                pass
+
+        # only the owner releases the lock.
+        other = RunLock(self.db, FILTERS)
+        other.release()
+        assert self.db['active_processes'].count() == 1
+
+        lock.release()
+        assert self.db['active_processes'].count() == 0
+        with run_lock(self.db, FILTERS) as other:
+            assert self.db['active_processes'].find_one()['owner'] == other.owner
+
+    def test_expired(self):
+
+        # a crashed owner's lock is taken over once its lease expired.
+        crashed = RunLock(self.db, FILTERS)
+        assert crashed.acquire()
+        crashed._stop.set()
+        self.db['active_processes'].update_one(
+            {'_id': FILTERS}, {'$set': {'expires': datetime.datetime.now() - datetime.timedelta(seconds=1)}})
+
+        lock = RunLock(self.db, FILTERS)
+        assert lock.acquire()
+        assert not crashed.update('matching', 0.5)
+        crashed.release()
+        assert self.db['active_processes'].find_one()['owner'] == lock.owner
+        lock.release()
+
+    def test_is_running(self):
+
+        r, status_code = self.get('is_matchengine_running')
+        self.assert200(status_code)
+        assert r['is_running'] is False and r['processes'] == []
+
+        with run_lock(self.db, FILTERS) as lock:
+            lock.update('matching filters', 0.5)
+            r, status_code = self.get('is_matchengine_running')
+            self.assert200(status_code)
+            assert r['is_running'] is True
+            assert r['processes'][0]['name'] == FILTERS
+            assert r['processes'][0]['stage'] == 'matching filters'
+            assert r['processes'][0]['progress'] == 0.5
+
+    def test_matchengine_locks(self):
+
+        # a matchengine run does not start while the index is being reset, and leaves no lock behind.
+        with run_lock(self.db, ELASTICSEARCH):
+            r, status_code = self.post('run_matchengine', {})
+            assert status_code == 409
+            assert self.db['active_processes'].find_one({'_id': MATCHENGINE}) is None
@@ -1,8 +1,18 @@
-import oncotreenx
+import os
+import yaml
+import datetime
+import simplejson as json
+from bson import ObjectId
 
 from matchminer.utilities import *
+from matchminer.oncotree import get_oncotree
+from matchminer.matchengine_v1.sampleset import SampleIndex
+from matchminer.matchengine_v1.engine import MatchEngine
+from matchminer.matchengine_v1.plan import compile_match_plan
+from matchminer.structural_variants import sv_comment_genes, backfill_sv_genes
+from matchminer.protein_change import protein_change_prefix, wildcard_prefix
 from matchminer.validation import check_valid_email_address
-from tests.test_matchminer import TestMinimal
+from tests.test_matchminer import TestMinimal, MONGO_URI
 from matchminer.trial_search import Autocomplete, expand_liquid_oncotree
 
 
@@ -104,11 +114,211 @@ class TestUtilities(TestMinimal):
 
     def test_expand_liquid_oncotree(self):
 
-        onco_tree = oncotreenx.build_oncotree(file_path=TUMOR_TREE)
+        onco_tree = get_oncotree(TUMOR_TREE)
         l, s, = expand_liquid_oncotree(onco_tree)
         assert 'Leukemia' in l
         assert 'Leukemia' not in s
 
+    def test_get_oncotree(self):
+
+        onco_tree = get_oncotree(TUMOR_TREE)
+        assert get_oncotree(TUMOR_TREE) is onco_tree
+
+        code = onco_tree.lookup_text('Leukemia')
+        assert code is not None
+        assert onco_tree.text(code) == 'Leukemia'
+        assert code in onco_tree.descendants(code)
+        assert code in onco_tree.liquid
+        assert code not in onco_tree.solid
+        assert onco_tree.ancestors(code)[-1] == onco_tree.root
+
+        # subtrees are contiguous preorder intervals
+        parent = onco_tree.ancestors(code)[0]
+        start, end = onco_tree.interval(parent)
+        assert onco_tree.is_descendant(code, parent)
+        assert not onco_tree.is_descendant(parent, code)
+        assert onco_tree.descendants(parent) == onco_tree.codes[start:end + 1]
+        assert onco_tree.descendant_texts(parent) == onco_tree.texts(onco_tree.descendants(parent))
+        assert onco_tree.lookup_text('not a cancer type') is None
+
+        # touching the file rebuilds the index
+        os.utime(TUMOR_TREE, (onco_tree.mtime + 1, onco_tree.mtime + 1))
+        try:
+            assert get_oncotree(TUMOR_TREE) is not onco_tree
+        finally:
+            os.utime(TUMOR_TREE, (onco_tree.mtime, onco_tree.mtime))
+
+    def test_sample_set(self):
+
+        index = SampleIndex(['S%d' % i for i in range(100)])
+        a = index.encode(['S1', 'S2', 'S70', 'unknown'])
+        b = index.encode(['S2', 'S3'])
+
+        assert index.decode(a) == ['S1', 'S2', 'S70']
+        assert index.decode(a & b) == ['S2']
+        assert index.decode(a | b) == ['S1', 'S2', 'S3', 'S70']
+
+        # negation is lazy and folds into and/or
+        assert len(~a) == 97
+        assert 'S1' not in ~a and 'S4' in ~a
+        assert index.decode(~a & b) == ['S3']
+        assert index.decode(~a & ~b) == index.decode(~(a | b))
+        assert index.decode(~a | b) == index.decode(~index.encode(['S1', 'S70']))
+        assert not index.empty()
+        assert not (a & ~a)
+
+    def test_genomic_snapshot(self):
+
+        # the snapshot must select the same genomic documents as Mongo
+        me = MatchEngine(self.db, snapshot=True)
+        wildtype = {'$or': [{'WILDTYPE': False}, {'WILDTYPE': {'$exists': False}}]}
+        queries = [
+            {'$and': [{'TRUE_HUGO_SYMBOL': {'$eq': 'BRAF'}}, wildtype]},
+            {'$and': [{'TRUE_HUGO_SYMBOL': {'$eq': 'BRAF'}, 'TRUE_PROTEIN_CHANGE': {'$regex': '^p.V600[A-Z]'}},
+                      wildtype]},
+            {'VARIANT_CATEGORY': {'$in': ['MUTATION', 'CNV']}, 'CNV_CALL': {'$ne': None}},
+            {'WILDTYPE': True}
+        ]
+        for query in queries:
+            expected = [x['_id'] for x in self.db.genomic.find(query, {'_id': 1})]
+            rows = me.genomic_snapshot.rows_by_sample(me.genomic_snapshot.match(query))
+            assert sorted(me.genomic_snapshot.ids[row] for r in rows.values() for row in r) == sorted(expected)
+
+    def _insert_trials(self):
+        yaml_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../', 'data/yaml'))
+        trials = []
+        for name in ['00-001.yml', '00-002.yml', '00-003.yml']:
+            with open(os.path.join(yaml_dir, name)) as fin:
+                trials.append(yaml.safe_load(fin))
+        self.db.trial.insert_many(trials)
+        return [trial['protocol_no'] for trial in trials]
+
+    def test_parallel_matching(self):
+
+        protocol_nos = self._insert_trials()
+
+        # a run sharded across processes writes the same trial matches as a serial run
+        try:
+            runs = []
+            for workers in [1, 2]:
+                MatchEngine(self.db).find_trial_matches(workers=workers, uri=MONGO_URI)
+                runs.append(sorted(json.dumps(match, sort_keys=True, default=str)
+                                   for match in self.db.trial_match.find({}, {'_id': 0})))
+        finally:
+            self.db.trial.delete_many({'protocol_no': {'$in': protocol_nos}})
+            self.db.trial_match.drop()
+
+        assert runs[0] and runs[0] == runs[1]
+        assert all('"sort_order"' in match for match in runs[0])
+
+    def test_incremental_matching(self):
+
+        protocol_nos = self._insert_trials()
+
+        # a copy of a sample with a PIK3CA mutation, which matches 00-002 until its genomic documents are edited
+        pik3ca = {'TRUE_HUGO_SYMBOL': 'PIK3CA', 'VARIANT_CATEGORY': 'MUTATION'}
+        sample_id = self.db.genomic.find_one(pik3ca)['SAMPLE_ID']
+        clone = dict(self.db.clinical.find_one({'SAMPLE_ID': sample_id}), _id=ObjectId(), SAMPLE_ID='TCGA-INCR-TEST',
+                     MRN='INCR-TEST')
+        self.db.clinical.insert_one(clone)
+        self.db.genomic.insert_many([dict(g, _id=ObjectId(), SAMPLE_ID=clone['SAMPLE_ID'], CLINICAL_ID=clone['_id'])
+                                     for g in self.db.genomic.find({'SAMPLE_ID': sample_id})])
+
+        try:
+            me = MatchEngine(self.db)
+            me.find_trial_matches()
+            assert self.db.trial_match.count({'sample_id': clone['SAMPLE_ID'], 'protocol_no': '00-002'}) > 0
+
+            # a sample matching the edited trial, whose matches are sorted again, and a sample which is not
+            edited_samples = set(self.db.trial_match.distinct('sample_id', {'protocol_no': '00-001'}))
+            edited_samples.discard(clone['SAMPLE_ID'])
+            untouched = self.db.trial_match.find_one(
+                {'sample_id': {'$nin': list(edited_samples) + [clone['SAMPLE_ID']]}})['sample_id']
+            resorted = sorted(edited_samples)[0]
+            for sample in [resorted, untouched]:
+                self.db.trial_match.update_many({'sample_id': sample}, {'$set': {'sort_order': 99}})
+
+            # edit one trial and one sample
+            since = datetime.datetime.now()
+            self.db.trial.update_one({'protocol_no': '00-001'}, {'$set': {'_updated': datetime.datetime.now()}})
+            self.db.genomic.update_many({'SAMPLE_ID': clone['SAMPLE_ID']},
+                                        {'$set': {'TRUE_HUGO_SYMBOL': 'NONE', '_updated': datetime.datetime.now()}})
+
+            before = dict((match['_id'], match) for match in self.db.trial_match.find())
+            me.update_trial_matches(since=since)
+            after = dict((match['_id'], match) for match in self.db.trial_match.find())
+        finally:
+            self.db.trial.delete_many({'protocol_no': {'$in': protocol_nos}})
+            self.db.clinical.delete_one({'_id': clone['_id']})
+            self.db.genomic.delete_many({'SAMPLE_ID': clone['SAMPLE_ID']})
+            self.db.trial_match.drop()
+
+        # matches are upserted in place
+        assert set(after) == set(before)
+        for _id, match in after.items():
+            if match['sample_id'] == clone['SAMPLE_ID']:
+                assert match['is_disabled'] and match['_updated'] >= since
+            elif match['protocol_no'] == '00-001':
+                assert not match['is_disabled'] and match['_updated'] >= since
+            elif match['sample_id'] in edited_samples:
+                assert dict(match, sort_order=None) == dict(before[_id], sort_order=None)
+            else:
+                assert match == before[_id]
+
+        # only the samples of the edited trial and sample are sorted again
+        sort_orders = [m['sort_order'] for m in after.values() if m['sample_id'] == resorted]
+        assert sorted(sort_orders) == list(range(len(sort_orders)))
+        assert all(m['sort_order'] == 99 for m in after.values() if m['sample_id'] == untouched)
+
+    def test_compile_match_plan(self):
+
+        clause = {'and': [
+            {'genomic': {'hugo_symbol': 'BRAF'}},
+            {'or': [{'clinical': {'age_numerical': '>=18'}}, {'genomic': {'hugo_symbol': '!KRAS'}}]}
+        ]}
+        plan = compile_match_plan(clause)
+
+        # nodes are numbered breadth first, as in the match tree graph
+        assert plan.postorder == (2, 4, 5, 3, 1)
+        assert plan.leaves == (2, 4, 5)
+        assert plan.nodes[3].type == 'or' and plan.nodes[3].children == (4, 5)
+        assert plan.graph.nodes[5]['value'] == {'hugo_symbol': '!KRAS'}
+
+        # equal clauses share one plan, which is unaffected by later edits of the clause
+        assert compile_match_plan({'and': list(clause['and'])}) is plan
+        clause['and'][0]['genomic']['hugo_symbol'] = 'EGFR'
+        assert plan.nodes[2].value == {'hugo_symbol': 'BRAF'}
+        assert compile_match_plan(clause) is not plan
+
+    def test_sv_comment_genes(self):
+
+        # genes are found wherever the old regex search found them, synonyms resolve to their hugo symbol
+        genes = sv_comment_genes('EML4-ALK fusion; HER-2/neu and lkb1 rearranged')
+        for gene in ['EML4', 'ALK', 'EML4-ALK', 'HER-2/NEU', 'LKB1', 'STK11']:
+            assert gene in genes, gene
+        assert 'EML' not in genes
+        assert sv_comment_genes(None) == []
+
+        # backfilled documents are found by the SV query of the v1 engine
+        self.db.genomic.insert_one({'SAMPLE_ID': 'TCGA-OR-TEST1', 'VARIANT_CATEGORY': 'SV',
+                                    'STRUCTURAL_VARIANT_COMMENT': 'tmp6654 EML4-ALK fusion'})
+        backfill_sv_genes(self.db)
+        me = MatchEngine(self.db)
+        g, neg, sv = me.prepare_genomic_criteria({'hugo_symbol': 'alk', 'variant_category': 'Structural Variation'})
+        assert sv and not neg
+        assert self.db.genomic.find_one(dict(g, STRUCTURAL_VARIANT_COMMENT='tmp6654 EML4-ALK fusion')) is not None
+        self.db.genomic.delete_many({'STRUCTURAL_VARIANT_COMMENT': 'tmp6654 EML4-ALK fusion'})
+
+    def test_protein_change_prefix(self):
+
+        # the prefix matches the protein changes the wildcard regex ^p\.R132[ACDEFGHIKLMNPQRSTVWY]$ matched
+        assert protein_change_prefix('p.R132H') == 'P.R132'
+        assert protein_change_prefix('p.r132c') == 'P.R132'
+        assert protein_change_prefix('p.R132*') is None
+        assert protein_change_prefix('c.394C>T') is None
+        assert protein_change_prefix(None) is None
+        assert wildcard_prefix('R132') == wildcard_prefix('p.R132') == 'P.R132'
+
     def test_get_cancer_type_weight(self):
 
         ct = "Breast"
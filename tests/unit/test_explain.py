@@ -0,0 +1,43 @@
+import re
+import unittest
+
+from matchminer.matchengine_v1.explain import plan_stages, leaf_flags, COLLECTION_SCAN, UNINDEXED_REGEX, \
+    BROAD_NEGATION, LARGE_NIN
+
+
+def stats(stages, docs_examined=0):
+    return {'stages': stages, 'keys_examined': 0, 'docs_examined': docs_examined, 'documents': 0, 'millis': 0}
+
+
+class TestExplain(unittest.TestCase):
+
+    def test_plan_stages(self):
+
+        plan = {'stage': 'FETCH', 'inputStage': {'stage': 'OR', 'inputStages': [
+            {'stage': 'IXSCAN'}, {'stage': 'COLLSCAN'}]}}
+        assert plan_stages(plan) == ['FETCH', 'OR', 'IXSCAN', 'COLLSCAN']
+        assert plan_stages({}) == []
+
+    def test_leaf_flags(self):
+
+        # indexed equality
+        g = {'$and': [{'TRUE_HUGO_SYMBOL': {'$eq': 'BRAF'}}, {'WILDTYPE': False}]}
+        assert leaf_flags(g, False, stats(['FETCH', 'IXSCAN'], 10), 1000) == []
+
+        # wildcard protein changes are anchored prefixes, which Mongo answers from an index
+        g = {'TRUE_PROTEIN_CHANGE': {'$regex': '^p.V600[A-Z]'}}
+        assert leaf_flags(g, False, stats(['FETCH', 'IXSCAN'], 10), 1000) == []
+
+        # structural variant searches are case insensitive and unanchored
+        g = {'STRUCTURAL_VARIANT_COMMENT': {'$in': [re.compile('(.*\\WALK\\W.*)', re.IGNORECASE)]}}
+        assert leaf_flags(g, False, stats(['FETCH', 'IXSCAN'], 10), 1000) == [UNINDEXED_REGEX]
+        assert leaf_flags(g, False, stats(['COLLSCAN'], 1000), 1000) == [COLLECTION_SCAN, UNINDEXED_REGEX]
+
+        # negative leaves run their positive query, which is broad when it examines most of the collection
+        g = {'TRUE_HUGO_SYMBOL': {'$eq': 'TP53'}}
+        assert leaf_flags(g, True, stats(['FETCH', 'IXSCAN'], 600), 1000) == [BROAD_NEGATION]
+        assert leaf_flags(g, True, stats(['FETCH', 'IXSCAN'], 400), 1000) == []
+
+        # negated oncotree expansions
+        c = {'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': {'$nin': ['Diagnosis %d' % i for i in range(200)]}}
+        assert leaf_flags(c, False, stats(['COLLSCAN'], 1000), 1000) == [COLLECTION_SCAN, LARGE_NIN]
@@ -0,0 +1,52 @@
+import unittest
+
+from matchminer.filter_dedup import filter_hash, group_filters, copy_match, copy_matches, COPY_HASH_PREFIX
+
+
+def kras_filter(_id, team_id, genes=('KRAS', 'NRAS'), status=1):
+    match = [{'and': [{'clinical': {'ONCOTREE_PRIMARY_DIAGNOSIS_NAME': 'Non-Small Cell Lung Cancer'}},
+                      {'or': [{'genomic': {'TRUE_HUGO_SYMBOL': gene}} for gene in genes]}]}]
+    return {'_id': _id, 'TEAM_ID': team_id, 'USER_ID': 'user%d' % _id, 'status': status,
+            'protocol_id': 'P-%d' % _id, 'label': 'KRAS', 'match': match}
+
+
+class TestFilterDedup(unittest.TestCase):
+
+    def test_filter_hash(self):
+
+        # the order of clauses is irrelevant
+        kras = filter_hash(kras_filter(1, 't1')['match'])
+        assert kras == filter_hash(kras_filter(2, 't2', ('NRAS', 'KRAS'))['match'])
+        assert kras != filter_hash(kras_filter(2, 't2', ('KRAS',))['match'])
+
+    def test_group_filters(self):
+
+        filters = [kras_filter(3, 't3'), kras_filter(1, 't1'), kras_filter(2, 't2', ('KRAS',)),
+                   kras_filter(4, 't4', status=0)]
+        groups = group_filters(filters)
+        assert sorted(groups) == [1, 2, 4]
+        assert [item['_id'] for item in groups[1]] == [1, 3]
+
+        # a hash stored on the filter does not join it to another group
+        filters[2]['filter_hash'] = filter_hash(filters[0]['match'])
+        assert sorted(group_filters(filters)) == [1, 2, 4]
+
+    def test_copy_matches(self):
+
+        filters = [kras_filter(1, 't1'), kras_filter(2, 't2'), kras_filter(3, 't3', ('KRAS',))]
+        groups = group_filters(filters)
+        match = {'FILTER_ID': 1, 'TEAM_ID': 't1', 'USER_ID': 'user1', 'PROTOCOL_ID': 'P-1', 'FILTER_STATUS': 1,
+                 'EMAIL_SUBJECT': 'OncoPanel Trial Match (P-1)', 'SAMPLE_ID': 's1', 'MATCH_STATUS': 1, 'hash': 'h1'}
+        matches = {1: {'s1': [match]}, 3: {}}
+
+        copied = copy_matches(matches, groups)
+        assert list(copied) == [2]
+        copy = copied[2]['s1'][0]
+        assert copy['FILTER_ID'] == 2 and copy['TEAM_ID'] == 't2' and copy['USER_ID'] == 'user2'
+        assert copy['EMAIL_SUBJECT'] == 'OncoPanel Trial Match (P-2)'
+        assert copy['SAMPLE_ID'] == 's1' and copy['hash'].startswith(COPY_HASH_PREFIX)
+        assert matches == {1: {'s1': [match]}, 3: {}}
+
+        # copies only change with their content, not with their state in the match collection
+        stored = dict(match, _id='m1', _me_id='run1', is_disabled=False, MATCH_STATUS=0)
+        assert copy_match(stored, filters[1])['hash'] == copy['hash']
@@ -0,0 +1,28 @@
+import os
+import json
+import unittest
+
+import pandas as pd
+
+from matchminer.matchengine_v1.sort import add_sort_order
+
+TEST_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../', 'data'))
+
+
+class TestSort(unittest.TestCase):
+
+    def test_add_sort_order(self):
+
+        # match tables and the sort orders computed for them by the row by row add_sort_order it replaced,
+        # written by tests/benchmark_sort.py
+        with open(os.path.join(TEST_DIR, 'sort_order.json')) as f:
+            cases = json.load(f)
+
+        for case in cases:
+            df = pd.DataFrame(case['matches'])
+            assert add_sort_order(df)['sort_order'].tolist() == case['sort_order']
+
+    def test_add_sort_order_empty(self):
+
+        df = pd.DataFrame()
+        assert add_sort_order(df) is df